@@ -26,6 +26,9 @@ from pathlib import Path
 # for selecting a file from explorer
 from tkinter import filedialog, Tk
 
+# local cache for the parts of the remote rasters we already downloaded
+import range_cache
+
 def get_shapefile_list(starting_dir):
     shapefiles = []
     pattern = "*.shp"
@@ -98,16 +101,20 @@ def get_raster_and_clip_and_download(
         shape_name: str,
         band_name: str, 
         item: pystac.Item, 
-        polygon: shapely.Polygon
+        polygon: shapely.Polygon,
+        cache: range_cache.RangeCache = None
         ):
     """
     takes a band (e.g. red), a polygon in 4326 coords and a stac item,
     opens a raster of that item's band and clips it to the polygon,
-    then saves it as a .jp2-file
+    then saves it as a .jp2-file.
+    with a cache, the raster is read through it, so the parts of it
+    read in an earlier run are not downloaded again
     """
     band_url = item.assets[band_name].href
     clipped_raster = rioxarray.open_rasterio(
-        band_url, masked=True).rio.clip(
+        band_url, masked=True,
+        opener=cache.opener if cache else None).rio.clip(
             [polygon], crs="4326", from_disk=True)
     # for efficiency clip must directly take the output of
     # open_rasterio and from_disk must be True,
@@ -158,6 +165,7 @@ def demo():
     bands_of_interest = ["red", "green", "blue", "nir"]
     
     # workflow
+    cache = range_cache.RangeCache()
     starting_dir = choose_directory()
     os.chdir(starting_dir)
     shapefiles = get_shapefile_list(starting_dir)
@@ -168,7 +176,8 @@ def demo():
         stac_catalogue, collection, timeframe, polygon)
         for item in matching_items:
             for band in bands_of_interest:
-                get_raster_and_clip_and_download(shape_name, band, item, polygon)
+                get_raster_and_clip_and_download(shape_name, band, item, polygon, cache)
+    print(cache.report())
 
 demo()
 
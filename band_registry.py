@@ -0,0 +1,119 @@
+"""
+What the scripts know about every Sentinel-2 L2A band.
+
+output_layouts.py describes which bands go into which file, but the
+layouts themselves were written by hand, and nothing stopped a
+categorical band from being requested as UINT16 or a band name with a
+typo from reaching the service. The registry here holds one Band per
+name with its native resolution, the smallest Process API sample type
+that holds its DN values, the scale to get physical values from them
+and whether it is categorical (classes or flags, never resampled with
+anything but nearest neighbour).
+
+single_band_layout and stacked_layout turn a band selection such as
+BAND_NAMES into an OutputLayout, so the evalscript and responses only
+ever contain the selected bands, each with its own sample type: SCL,
+CLM or dataMask always come back as UINT8, whatever else is asked for.
+"""
+import dataclasses
+
+import output_layouts as ol
+
+
+@dataclasses.dataclass(frozen=True)
+class Band:
+    """
+    One band of the collection. resolution is the native resolution in
+    meters, the physical value is DN * scale. group is the file the band
+    goes into in a stacked layout.
+    """
+    name: str
+    resolution: float
+    sample_type: str = "UINT16"
+    scale: float = 1.0
+    categorical: bool = False
+    group: str = "bands"
+
+
+"""
+Sentinel-2 L2A. Reflectances have a scale of 1/10000 (products since
+baseline 04.00 additionally carry an offset of -1000, which the
+Process API already removes with units "DN"). CLP is the cloud
+probability scaled to 0-255, the angles are whole degrees.
+"""
+SENTINEL2_L2A = {band.name: band for band in [
+    Band("B01", 60, scale=0.0001),
+    Band("B02", 10, scale=0.0001),
+    Band("B03", 10, scale=0.0001),
+    Band("B04", 10, scale=0.0001),
+    Band("B05", 20, scale=0.0001),
+    Band("B06", 20, scale=0.0001),
+    Band("B07", 20, scale=0.0001),
+    Band("B08", 10, scale=0.0001),
+    Band("B8A", 20, scale=0.0001),
+    Band("B09", 60, scale=0.0001),
+    Band("B11", 20, scale=0.0001),
+    Band("B12", 20, scale=0.0001),
+    Band("AOT", 20, scale=0.001),
+    Band("WVP", 20, scale=0.001),
+    Band("SCL", 20, "UINT8", categorical=True, group="quality"),
+    Band("CLM", 160, "UINT8", categorical=True, group="quality"),
+    Band("CLP", 160, "UINT8", scale=1 / 255, group="quality"),
+    Band("CLD", 20, "UINT8", scale=0.01, group="quality"),
+    Band("SNW", 20, "UINT8", scale=0.01, group="quality"),
+    Band("dataMask", 10, "UINT8", categorical=True, group="quality"),
+    Band("sunAzimuthAngles", 5000, group="angles"),
+    Band("sunZenithAngles", 5000, group="angles"),
+    Band("viewAzimuthMean", 5000, group="angles"),
+    Band("viewZenithMean", 5000, group="angles"),
+]}
+
+
+def get_bands(names, registry: dict = SENTINEL2_L2A):
+    """
+    The Band of every name, in the given order. Unknown names raise a
+    ValueError before any request is made.
+    """
+    unknown = [name for name in names if name not in registry]
+    if unknown:
+        raise ValueError(f"Unknown bands {', '.join(unknown)}, expected some of {', '.join(registry)}")
+    return [registry[name] for name in names]
+
+
+def widest_sample_type(bands):
+    return max((band.sample_type for band in bands), key=ol.SAMPLE_TYPES.get)
+
+
+def single_band_layout(names, registry: dict = SENTINEL2_L2A):
+    """
+    One file per band, named after the band, each with the sample type
+    of its band.
+    """
+    return ol.OutputLayout([ol.OutputFile(band.name, [band.name], band.sample_type)
+                            for band in get_bands(names, registry)])
+
+
+def stacked_layout(names, registry: dict = SENTINEL2_L2A):
+    """
+    One file per group of the selected bands (bands, quality, angles),
+    in the order the groups first appear, with the widest sample type of
+    its bands.
+    """
+    groups = {}
+    for band in get_bands(names, registry):
+        groups.setdefault(band.group, []).append(band)
+    return ol.OutputLayout([ol.OutputFile(group, [band.name for band in bands], widest_sample_type(bands))
+                            for group, bands in groups.items()])
+
+
+"""
+All bands of optimized_script.py, split by what they need: the 12
+bands and AOT with 16 bits, the classification, masks and
+probabilities with 8 bits, the angles (whole degrees, as before) with
+16 bits.
+"""
+FULL = stacked_layout([
+    "B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12", "AOT",
+    "SCL", "CLM", "CLP", "CLD", "SNW", "dataMask",
+    "sunAzimuthAngles", "sunZenithAngles", "viewAzimuthMean", "viewZenithMean",
+])
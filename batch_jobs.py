@@ -0,0 +1,358 @@
+"""
+Season-scale downloads with the Sentinel Hub Batch Processing API (v2).
+
+The Process API loop sends at least one request per field and date.
+For the whole regional parcel layer over several years that is millions
+of requests. A batch job instead processes the union of all field
+geometries on a tiling grid (TILING_GRID, the 10 km UTM grid) and
+delivers one tif per grid tile and output to an object store.
+
+run_batch_job creates and starts a single job for the whole season: all
+fields and all their planned dates, with the date slot evalscript of
+multi_temporal.py (ORBIT mosaicking over the time range, one slot of
+bands per date). Batch Processing has no userdata output, so the slots
+are fixed by the planned dates and a tile without an acquisition on a
+date keeps 0 in that slot. The job is polled every POLL_INTERVAL seconds
+until it is finished, then every field's bbox is cut out of the
+delivered tiles for each of its dates, into its date folder and under
+the same file names as the Process API download
+(<scene id>_<output>.tif). Next to the outputs of the layout the job
+delivers COVERAGE, the dataMask of every date slot. A field date where
+it is 0 everywhere (no acquisition over the field, or no tile) is left
+out and planned again in the next run. The values of the outputs do not
+decide this: 0 is a valid value of categorical bands like CLM ("clear").
+
+The tiles lie on the same 10 m grid as the field bboxes (both are
+rounded to 10 m), so cutting is a window read as long as field and tile
+are in the same UTM zone; otherwise the tiles are warped to the field's
+CRS. The object store is given as an object with list(url prefix) and
+path(url), the path handed to rasterio: S3ObjectStore for a real bucket
+(needs boto3), LocalObjectStore for a directory standing in for one, as
+stub_api.StubServer(object_store=...) writes it.
+"""
+import dataclasses
+import logging
+import os
+import pathlib as pl
+import time
+import urllib.parse
+
+import pyproj
+import rasterio as rio
+import rasterio.merge
+import rasterio.warp
+import sentinelhub as sh
+import shapely
+from rasterio.vrt import WarpedVRT
+
+import multi_temporal as mt
+import output_layouts as ol
+import response_writer as rw
+
+logger = logging.getLogger("SHD.batch_jobs")
+
+TILING_GRID = 1
+POLL_INTERVAL = 60
+"""
+Where the jobs deliver their tiles, <requestId>, <tileName> and
+<outputId> are filled in by Sentinel Hub
+"""
+TILE_PATH = "<requestId>/<tileName>/<outputId>.tif"
+COVERAGE = ol.OutputFile("coverage", ["dataMask"], "UINT8")
+FINISHED = (sh.BatchRequestStatus.DONE, sh.BatchRequestStatus.FAILED, sh.BatchRequestStatus.STOPPED)
+
+
+def s3_credentials(iam_role_arn: str = None):
+    """
+    Credentials Sentinel Hub uses to write into the bucket: the IAM role
+    if given, otherwise the AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY of
+    the environment.
+    """
+    if iam_role_arn:
+        return {"iam_role_arn": iam_role_arn}
+    return {"access_key": os.environ.get("AWS_ACCESS_KEY_ID"),
+            "secret_access_key": os.environ.get("AWS_SECRET_ACCESS_KEY")}
+
+
+def split_url(url: str):
+    parts = urllib.parse.urlsplit(url)
+    return parts.netloc, parts.path.lstrip("/")
+
+
+class LocalObjectStore:
+    """
+    A directory standing in for a bucket: s3://bucket/key is
+    root/bucket/key.
+    """
+
+    def __init__(self, root: pl.Path):
+        self.root = pl.Path(root)
+
+    def path(self, url: str):
+        bucket, key = split_url(url)
+        return str(self.root.joinpath(bucket, key))
+
+    def list(self, url_prefix: str):
+        bucket, prefix = split_url(url_prefix)
+        folder = self.root.joinpath(bucket)
+        return sorted(f"s3://{bucket}/{path.relative_to(folder).as_posix()}"
+                      for path in folder.joinpath(prefix).rglob("*") if path.is_file())
+
+
+class S3ObjectStore:
+    """
+    An S3 bucket, listed with boto3 and read by GDAL (/vsis3/), both
+    with the usual AWS_* credentials from the environment.
+    """
+
+    def __init__(self):
+        import boto3
+
+        self.client = boto3.client("s3")
+
+    def path(self, url: str):
+        bucket, key = split_url(url)
+        return f"/vsis3/{bucket}/{key}"
+
+    def list(self, url_prefix: str):
+        bucket, prefix = split_url(url_prefix)
+        urls = []
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            urls.extend(f"s3://{bucket}/{entry['Key']}" for entry in page.get("Contents", []))
+        return urls
+
+
+@dataclasses.dataclass
+class BatchTarget:
+    """
+    One field of a batch job: its bbox (on the 10 m grid) and polygon in
+    its own CRS, and where its files go (<folder>/<prefix><output>.tif).
+    """
+    bbox: sh.BBox
+    geometry: shapely.Geometry
+    folder: pl.Path
+    prefix: str
+
+
+@dataclasses.dataclass
+class BatchJob:
+    """
+    The job of a season: targets_per_date is {date: [BatchTarget]}, its
+    sorted dates are the date slots of the outputs.
+    """
+    targets_per_date: dict
+    request: sh.BatchProcessRequest = None
+
+    @property
+    def dates(self):
+        return sorted(self.targets_per_date)
+
+    @property
+    def targets(self):
+        return [target for date_str in self.dates for target in self.targets_per_date[date_str]]
+
+    @property
+    def label(self):
+        return f"{self.dates[0]} to {self.dates[-1]} ({len(self.dates)} dates, {len(self.targets)} field dates)"
+
+
+def union_geometry(targets):
+    """
+    The union of the target polygons in EPSG:4326, as fields can lie in
+    different UTM zones.
+    """
+    geometries = []
+    for target in targets:
+        transformer = pyproj.Transformer.from_crs(target.bbox.crs.epsg, 4326, always_xy=True)
+        geometries.append(shapely.transform(target.geometry, transformer.transform, interleaved=False))
+    return shapely.union_all(geometries)
+
+
+def job_layout(layout: ol.OutputLayout):
+    """
+    layout with the COVERAGE output added.
+    """
+    return ol.OutputLayout([*layout.files, COVERAGE], layout.units)
+
+
+def process_request(job: BatchJob, layout: ol.OutputLayout, config: sh.SHConfig,
+                    data_collection=sh.DataCollection.SENTINEL2_L2A):
+    """
+    The Process API payload of job: all its dates over the union of its
+    fields, with the outputs of layout and COVERAGE. The output size comes
+    from the tiling grid, so the request has none.
+    """
+    dates = job.dates
+    layout = job_layout(layout)
+    request = sh.SentinelHubRequest(
+        evalscript=mt.date_slot_evalscript(layout, dates),
+        input_data=[
+            sh.SentinelHubRequest.input_data(
+                data_collection=data_collection,
+                time_interval=(dates[0], dates[-1]),
+                mosaicking_order="leastRecent"
+            )
+        ],
+        responses=layout.responses(),
+        geometry=sh.Geometry(union_geometry(job.targets), sh.CRS.WGS84),
+        config=config
+    )
+    return request.download_list[0].post_values
+
+
+def submit_job(client: sh.BatchProcessClient, job: BatchJob, layout: ol.OutputLayout,
+               config: sh.SHConfig, output_url: str, resolution: float, credentials: dict, **kwargs):
+    delivery = client.s3_specification(f"{output_url.rstrip('/')}/{TILE_PATH}", **credentials)
+    job.request = client.create(
+        process_request(job, layout, config, **kwargs),
+        input=client.tiling_grid_input(TILING_GRID, resolution),
+        output=client.raster_output(delivery, overwrite=True, cog_output=True),
+        description=f"digiman {job.label}"
+    )
+    client.start_job(job.request)
+    logger.info(f"Batch job {job.request.request_id} for {job.label} started")
+
+
+def wait_for_jobs(client: sh.BatchProcessClient, jobs, poll_interval: float = POLL_INTERVAL):
+    """
+    Poll the jobs until all of them are done, failed or stopped.
+    """
+    running = [job for job in jobs if job.request.status not in FINISHED]
+    while running:
+        time.sleep(poll_interval)
+        for job in running:
+            job.request = client.get_request(job.request)
+        running = [job for job in running if job.request.status not in FINISHED]
+        if running:
+            percentage = sum(job.request.completion_percentage for job in running) / len(running)
+            logger.info(f"Batch: {len(running)} jobs running, {percentage:.0f} % done")
+
+
+def tile_sources(store, output_url: str, request_id: str):
+    """
+    {output id: [tile path]} of the tiles a finished job delivered.
+    """
+    sources = {}
+    for url in store.list(f"{output_url.rstrip('/')}/{request_id}/"):
+        output_id = pl.PurePosixPath(urllib.parse.urlsplit(url).path).stem
+        sources.setdefault(output_id, []).append(store.path(url))
+    return sources
+
+
+def mosaic_target(datasets, target: BatchTarget, resolution: float, indexes=None):
+    """
+    Mosaic the bands indexes (1-based, all by default) of the field bbox
+    out of the tile datasets that overlap it. Returns (data, transform,
+    crs), or None if no tile overlaps the field.
+    """
+    crs = rio.crs.CRS.from_epsg(target.bbox.crs.epsg)
+    bounds = (target.bbox.min_x, target.bbox.min_y, target.bbox.max_x, target.bbox.max_y)
+    sources = []
+    for dataset in datasets:
+        left, bottom, right, top = rasterio.warp.transform_bounds(dataset.crs, crs, *dataset.bounds)
+        if left < bounds[2] and right > bounds[0] and bottom < bounds[3] and top > bounds[1]:
+            sources.append(dataset if dataset.crs == crs else WarpedVRT(dataset, crs=crs))
+    if not sources:
+        return None
+    data, transform = rasterio.merge.merge(sources, bounds=bounds, res=resolution, nodata=0, indexes=indexes)
+    return data, transform, crs
+
+
+def covered(datasets, target: BatchTarget, resolution: float, position: int):
+    """
+    Whether the COVERAGE tiles have data for any pixel of the field in
+    the date slot at position.
+    """
+    mosaic = mosaic_target(datasets, target, resolution, mt.date_band_indexes(1, position))
+    return mosaic is not None and bool(mosaic[0].any())
+
+
+def cut_target(datasets, target: BatchTarget, resolution: float, target_path: pl.Path, indexes=None):
+    """
+    Mosaic the bands indexes (1-based, all by default) of the field bbox
+    out of the tile datasets that overlap it and write them to
+    target_path through a temporary file. Like the Process API tifs the
+    file has no nodata value, 0 can be a valid value. Returns a
+    WrittenFile, or None if no tile overlaps the field.
+    """
+    mosaic = mosaic_target(datasets, target, resolution, indexes)
+    if mosaic is None:
+        return None
+    data, transform, crs = mosaic
+    profile = {
+        "driver": "GTiff", "width": data.shape[2], "height": data.shape[1], "count": data.shape[0],
+        "dtype": data.dtype, "crs": crs, "transform": transform,
+    }
+    tmp_path = target_path.with_name("." + target_path.name + ".part")
+    try:
+        with rio.open(tmp_path, "w", **profile) as crop:
+            crop.write(data)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return rw.describe_file(target_path)
+
+
+def cut_job(job: BatchJob, layout: ol.OutputLayout, store, output_url: str, resolution: float):
+    """
+    Cut every target of a finished job out of the date slot of its date
+    in the tiles. Returns {folder: [WrittenFile]}; a target is only in it
+    if COVERAGE has data for it on its date and every output could be
+    cut for it.
+    """
+    sources = tile_sources(store, output_url, job.request.request_id)
+    written = {}
+    datasets = {output_id: [rio.open(path) for path in paths] for output_id, paths in sources.items()}
+    try:
+        for position, date_str in enumerate(job.dates):
+            for target in job.targets_per_date[date_str]:
+                folder = pl.Path(target.folder)
+                if not covered(datasets.get(COVERAGE.id, []), target, resolution, position):
+                    logger.warning(f"{folder}: no data for {date_str} in the tiles of batch job "
+                                   f"{job.request.request_id}")
+                    continue
+                folder.mkdir(parents=True, exist_ok=True)
+                files = [cut_target(datasets.get(file.id, []), target, resolution,
+                                    folder.joinpath(f"{target.prefix}{file.id}.tif"),
+                                    mt.date_band_indexes(len(file.bands), position))
+                         for file in layout.files]
+                if all(files):
+                    written[folder] = files
+                else:
+                    for file in files:
+                        if file is not None:
+                            file.path.unlink(missing_ok=True)
+                    logger.warning(f"{folder}: no data for {date_str} in the tiles of batch job "
+                                   f"{job.request.request_id}")
+    finally:
+        for output_datasets in datasets.values():
+            for dataset in output_datasets:
+                dataset.close()
+    return written
+
+
+def run_batch_job(targets_per_date: dict, layout: ol.OutputLayout, config: sh.SHConfig, store,
+                  output_url: str, resolution: float = 10, poll_interval: float = POLL_INTERVAL,
+                  credentials: dict = None, **kwargs):
+    """
+    One batch job for all dates of targets_per_date ({date: [BatchTarget]}).
+    credentials are the s3_credentials the tiles are written with.
+    Returns {folder: [WrittenFile]} of all field dates cut from the job
+    if it finished with DONE.
+    """
+    if not targets_per_date:
+        return {}
+    credentials = credentials or s3_credentials()
+    client = sh.BatchProcessClient(config=config)
+    job = BatchJob(targets_per_date)
+    submit_job(client, job, layout, config, output_url, resolution, credentials, **kwargs)
+    wait_for_jobs(client, [job], poll_interval)
+
+    if job.request.status is not sh.BatchRequestStatus.DONE:
+        logger.error(f"Batch job {job.request.request_id} for {job.label}: "
+                     f"{job.request.status.value} {job.request.error or ''}")
+        return {}
+    written = cut_job(job, layout, store, output_url, resolution)
+    logger.info(f"Batch: {len(written)} of {len(job.targets)} field dates from job {job.request.request_id}")
+    return written
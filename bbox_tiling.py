@@ -0,0 +1,182 @@
+"""
+Split bboxes that are too large for a single Process API request and
+mosaic the tiles back into one file per band.
+
+Sentinel Hub refuses outputs larger than 2500 x 2500 px, i.e. 25 km at
+10 m/px. split_bbox cuts such a bbox into the smallest number of equally
+sized tiles that stay under the limit. The tile edges are whole pixels
+away from the bbox corner, so all tiles lie on the same pixel grid as
+the full bbox. download_tiled downloads at most max_workers tiles at a
+time and writes each tile into its window of the output tifs as soon
+as it arrives, so only the tiles in flight are held in memory, never
+the whole mosaic.
+"""
+import concurrent.futures as cf
+import dataclasses
+import itertools
+import logging
+import math
+import os
+import pathlib as pl
+
+import rasterio as rio
+import rasterio.transform
+import sentinelhub as sh
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
+
+import response_writer as rw
+
+logger = logging.getLogger("SHD.bbox_tiling")
+
+MAX_PIXELS = 2500
+
+
+@dataclasses.dataclass
+class Tile:
+    """
+    One part of a split bbox with its pixel offset and size within
+    the full output.
+    """
+    bbox: sh.BBox
+    col_off: int
+    row_off: int
+    width: int
+    height: int
+
+
+def needs_split(size, max_pixels: int = MAX_PIXELS):
+    return size[0] > max_pixels or size[1] > max_pixels
+
+
+def split_bbox(bbox: sh.BBox, resolution: float, max_pixels: int = MAX_PIXELS):
+    """
+    Cut bbox into a grid of tiles of at most max_pixels x max_pixels.
+    The bbox must already be rounded to the resolution (as done with
+    round_coordinates in the scripts). Returns a list of Tiles, row by
+    row from the top left.
+    """
+    width = round((bbox.max_x - bbox.min_x) / resolution)
+    height = round((bbox.max_y - bbox.min_y) / resolution)
+    columns = math.ceil(width / max_pixels)
+    rows = math.ceil(height / max_pixels)
+    tile_width = math.ceil(width / columns)
+    tile_height = math.ceil(height / rows)
+
+    tiles = []
+    for row_off in range(0, height, tile_height):
+        for col_off in range(0, width, tile_width):
+            tile_w = min(tile_width, width - col_off)
+            tile_h = min(tile_height, height - row_off)
+            min_x = bbox.min_x + col_off * resolution
+            max_y = bbox.max_y - row_off * resolution
+            tile_bbox = sh.BBox(
+                (min_x, max_y - tile_h * resolution, min_x + tile_w * resolution, max_y),
+                crs=bbox.crs
+            )
+            tiles.append(Tile(tile_bbox, col_off, row_off, tile_w, tile_h))
+    return tiles
+
+
+class Mosaic:
+    """
+    The output tifs of a tiled download, one per band (tar member). Each
+    file is created on the first tile that contains its band, with the
+    size and georeference of the full bbox, and written as a hidden
+    .part file that is renamed once all tiles are in.
+    """
+
+    def __init__(self, bbox: sh.BBox, resolution: float, target_folder: pl.Path, prefix: str = ""):
+        self.width = round((bbox.max_x - bbox.min_x) / resolution)
+        self.height = round((bbox.max_y - bbox.min_y) / resolution)
+        self.transform = rasterio.transform.from_origin(bbox.min_x, bbox.max_y, resolution, resolution)
+        self.crs = f"EPSG:{bbox.crs.epsg}"
+        self.target_folder = pl.Path(target_folder)
+        self.prefix = prefix
+        self.datasets = {}
+
+    def dataset(self, name: str, tile_dataset):
+        if name not in self.datasets:
+            profile = tile_dataset.profile.copy()
+            profile.update(
+                driver="GTiff", width=self.width, height=self.height,
+                transform=self.transform, crs=self.crs,
+                tiled=True, blockxsize=512, blockysize=512, compress="deflate"
+            )
+            part_path = self.target_folder.joinpath("." + self.prefix + name + ".part")
+            self.datasets[name] = rio.open(part_path, "w", **profile)
+        return self.datasets[name]
+
+    def add(self, tile: Tile, content: bytes, single_name: str):
+        """
+        Write the response of one tile (a tar with one tif per band, or
+        a single tif named single_name) into its window of the output
+        files.
+        """
+        members = rw.read_response_members(content, single_name)
+        window = Window(tile.col_off, tile.row_off, tile.width, tile.height)
+        for name, data in members:
+            with MemoryFile(data) as memfile, memfile.open() as tile_dataset:
+                self.dataset(name, tile_dataset).write(tile_dataset.read(), window=window)
+
+    def close(self):
+        """
+        Close all output files and move them to their final names.
+        Returns a list of WrittenFile.
+        """
+        written = []
+        for name, dataset in self.datasets.items():
+            part_path = pl.Path(dataset.name)
+            dataset.close()
+            final_path = self.target_folder.joinpath(self.prefix + name)
+            os.replace(part_path, final_path)
+            written.append(rw.describe_file(final_path))
+        self.datasets = {}
+        return written
+
+    def discard(self):
+        for dataset in self.datasets.values():
+            dataset.close()
+            pl.Path(dataset.name).unlink(missing_ok=True)
+        self.datasets = {}
+
+
+def download_tiled(make_request, bbox: sh.BBox, resolution: float, target_folder: pl.Path,
+                   prefix: str = "", max_workers: int = 4, max_pixels: int = MAX_PIXELS):
+    """
+    Download an oversized bbox in tiles and mosaic them into one tif per
+    band in target_folder, named <prefix><band>.tif like the untiled
+    download. make_request(tile_bbox, tile_size) must return the
+    SentinelHubRequest for one tile. Returns a list of WrittenFile.
+    """
+    target_folder = pl.Path(target_folder)
+    target_folder.mkdir(parents=True, exist_ok=True)
+    tiles = split_bbox(bbox, resolution, max_pixels)
+    logger.info(f"{prefix}: {len(tiles)} tiles")
+    mosaic = Mosaic(bbox, resolution, target_folder, prefix)
+
+    def download(tile: Tile):
+        request = make_request(tile.bbox, (tile.width, tile.height))
+        return rw.download_response(request), rw.response_name(request)
+
+    """
+    Only max_workers tiles are submitted at a time, the next one when a
+    finished tile has been written into the mosaic. Submitting all tiles
+    at once would keep the responses of every finished tile in memory
+    while the main thread is still writing the first ones.
+    """
+    remaining = iter(tiles)
+    try:
+        with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(download, tile): tile for tile in itertools.islice(remaining, max_workers)}
+            while futures:
+                finished, _ = cf.wait(futures, return_when=cf.FIRST_COMPLETED)
+                for future in finished:
+                    mosaic.add(futures.pop(future), *future.result())
+                    tile = next(remaining, None)
+                    if tile is not None:
+                        futures[executor.submit(download, tile)] = tile
+        return mosaic.close()
+    except BaseException:
+        mosaic.discard()
+        raise
@@ -0,0 +1,217 @@
+"""
+On-disk cache for SentinelHubCatalog searches.
+
+A search is identified by its collection, bbox and CRS, filter and
+fields. For each such key the cache remembers which days have already
+been searched and which features were found on them, in a small SQLite
+file. Searching a time window then only sends catalog requests for the
+days that are missing, merged into as few contiguous date ranges as
+possible. Days close to today may still get new or reprocessed scenes,
+so their results expire after recent_ttl and are searched again.
+
+search_fields searches several neighbouring bboxes (the fields of a
+cluster) together, but keeps the days and features per bbox: adding
+or removing a field of a cluster does not throw away what is cached
+for the others, only the days the new field is missing are searched,
+over its bbox alone.
+"""
+import datetime as dt
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+import numpy as np
+import sentinelhub as sh
+import shapely
+import shapely.geometry
+
+logger = logging.getLogger("SHD.catalog_cache")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coverage (
+    key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (key, day)
+);
+CREATE TABLE IF NOT EXISTS features (
+    key TEXT NOT NULL,
+    id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    datetime TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    PRIMARY KEY (key, id)
+);
+CREATE INDEX IF NOT EXISTS features_day ON features (key, day);
+"""
+
+
+def to_date(value):
+    """
+    Turn a date string (YYYY-MM-DD, optionally with a time) or a
+    date/datetime object into a datetime.date.
+    """
+    if isinstance(value, dt.datetime):
+        return value.date()
+    if isinstance(value, dt.date):
+        return value
+    return dt.date.fromisoformat(str(value)[:10])
+
+
+def group_days(days):
+    """
+    Merge a sorted list of dates into (first, last) ranges of
+    consecutive days.
+    """
+    ranges = []
+    for day in days:
+        if ranges and day - ranges[-1][1] == dt.timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(day_range) for day_range in ranges]
+
+
+def intersecting(features, bbox):
+    """
+    The features whose footprint intersects bbox. Features without
+    footprint are kept.
+    """
+    if not features or any("geometry" not in feature for feature in features):
+        return features
+    area = sh.Geometry(bbox.geometry, bbox.crs).transform(sh.CRS.WGS84).geometry
+    footprints = np.array([shapely.geometry.shape(feature["geometry"]) for feature in features])
+    return [feature for feature, hit in zip(features, shapely.intersects(footprints, area)) if hit]
+
+
+def search_key(collection, bbox, filter=None, fields=None):
+    """
+    Build the cache key of a search. Everything that changes the result
+    apart from the time window goes into it.
+    """
+    key = {
+        "collection": getattr(collection, "catalog_id", None) or str(collection),
+        "bbox": [round(coordinate, 6) for coordinate in bbox],
+        "crs": str(bbox.crs.epsg),
+        "filter": filter,
+        "fields": fields,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class CatalogCache:
+    """
+    Cache for SentinelHubCatalog.search results stored in the SQLite
+    file at path. Days within recent_days of today are searched again
+    once their results are older than recent_ttl.
+    """
+
+    def __init__(self, path, recent_days: int = 30,
+                 recent_ttl: dt.timedelta = dt.timedelta(hours=12)):
+        self.path = str(path)
+        self.recent_days = recent_days
+        self.recent_ttl = recent_ttl
+        self.requests_sent = 0
+        with self.connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def missing_days(self, connection, key: str, start: dt.date, end: dt.date):
+        """
+        Return the days between start and end (inclusive) that have not
+        been searched yet or whose results have expired.
+        """
+        fetched = dict(connection.execute(
+            "SELECT day, fetched_at FROM coverage WHERE key = ? AND day BETWEEN ? AND ?",
+            (key, start.isoformat(), end.isoformat())
+        ))
+        recent_start = dt.date.today() - dt.timedelta(days=self.recent_days)
+        expired_before = time.time() - self.recent_ttl.total_seconds()
+        missing = []
+        day = start
+        while day <= end:
+            fetched_at = fetched.get(day.isoformat())
+            if fetched_at is None or (day >= recent_start and fetched_at < expired_before):
+                missing.append(day)
+            day += dt.timedelta(days=1)
+        return missing
+
+    def store(self, connection, key: str, first: dt.date, last: dt.date, features):
+        """
+        Replace the cached features for the days first to last with the
+        result of a fresh search and mark those days as covered.
+        """
+        now = time.time()
+        connection.execute(
+            "DELETE FROM features WHERE key = ? AND day BETWEEN ? AND ?",
+            (key, first.isoformat(), last.isoformat())
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)",
+            [(key, feature["id"], feature["properties"]["datetime"][:10],
+              feature["properties"]["datetime"], json.dumps(feature))
+             for feature in features]
+        )
+        days = []
+        day = first
+        while day <= last:
+            days.append((key, day.isoformat(), now))
+            day += dt.timedelta(days=1)
+        connection.executemany("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?)", days)
+
+    def features(self, connection, key: str, start: dt.date, end: dt.date):
+        rows = connection.execute(
+            "SELECT feature FROM features WHERE key = ? AND day BETWEEN ? AND ? "
+            "ORDER BY datetime, id",
+            (key, start.isoformat(), end.isoformat())
+        )
+        return [json.loads(feature) for feature, in rows]
+
+    def search(self, catalog, collection, bbox, time, filter=None, fields=None):
+        """
+        Drop-in replacement for catalog.search(collection, bbox=bbox,
+        time=time, filter=filter, fields=fields) that returns a list of
+        features sorted by datetime. Only the missing days of the time
+        window are requested from the catalog.
+        """
+        return self.search_fields(catalog, collection, [bbox], time, filter, fields)[0]
+
+    def search_fields(self, catalog, collection, bboxes, time, filter=None, fields=None):
+        """
+        Search the bboxes (all in the same crs) together and return the
+        features of each, sorted by datetime. Every range of days missing
+        for any of them is requested once, over the bbox around the
+        bboxes missing it, and each of those bboxes keeps the features
+        whose footprint ("geometry", if included) intersects it.
+        """
+        if fields is not None and "properties.datetime" not in fields.get("include", ["properties.datetime"]):
+            fields = {**fields, "include": [*fields["include"], "properties.datetime"]}
+        keys = [search_key(collection, bbox, filter, fields) for bbox in bboxes]
+        start, end = to_date(time[0]), to_date(time[1])
+
+        with self.connect() as connection:
+            missing = [set(self.missing_days(connection, key, start, end)) for key in keys]
+            for first, last in group_days(sorted(set().union(*missing))):
+                searched = [index for index, days in enumerate(missing)
+                            if any(first <= day <= last for day in days)]
+                search_bbox = sh.BBox(tuple(shapely.total_bounds([bboxes[index].geometry for index in searched])),
+                                      crs=bboxes[searched[0]].crs)
+                features = list(catalog.search(
+                    collection,
+                    bbox=search_bbox,
+                    time=(first.isoformat(), last.isoformat()),
+                    filter=filter,
+                    fields=fields
+                ))
+                self.requests_sent += 1
+                logger.debug(f"Catalog search {first} - {last} for {len(searched)} bboxes: "
+                             f"{len(features)} features")
+                for index in searched:
+                    self.store(connection, keys[index], first, last,
+                               intersecting(features, bboxes[index]))
+
+            return [self.features(connection, key, start, end) for key in keys]
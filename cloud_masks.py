@@ -0,0 +1,257 @@
+"""
+OmniCloudMask over all newly downloaded field rasters.
+
+ocm_experiments.py runs predict_from_load_func on a whole SAFE product.
+For the SentinelHub downloads we have many small field rasters instead,
+often a few dozen pixels wide. One predict call per file would run the
+model on mostly padding and pay its overhead for every file. Here:
+
+- the fields of one scene are grouped into areas: fields closer than
+  AREA_GAP are put on one canvas (on the common 10 m grid), so pixels
+  shared by overlapping or neighbouring fields are predicted once and
+  every field gets the context around it;
+- the areas are packed into atlases of ATLAS_SIZE x ATLAS_SIZE pixels
+  (shelf packing, PADDING nodata pixels between areas), and each atlas
+  is one predict_from_array call, whose patches run through the model
+  batch_size at a time on the CPU;
+- each field's window is cut out of its area's mask and written as
+  <scene id>_ocm.tif (UINT8: 0 clear, 1 thick cloud, 2 thin cloud,
+  3 cloud shadow, 255 outside / no data) next to its band files.
+
+OmniCloudMask takes red, green and NIR (B04, B03, B8A), which have to be
+in the output layout. Date folders that already have a mask are
+skipped. omnicloudmask (and torch) are only imported when masks are
+actually computed.
+"""
+import dataclasses
+import logging
+import pathlib as pl
+
+import numpy as np
+import rasterio as rio
+import sentinelhub as sh
+from rasterio.windows import Window
+
+import field_clusters as fc
+import output_layouts as ol
+import response_writer as rw
+
+logger = logging.getLogger("SHD.cloud_masks")
+
+OCM_BANDS = ["B04", "B03", "B8A"]
+AREA_GAP = 320  # Meter
+ATLAS_SIZE = 2048
+PADDING = 32
+BATCH_SIZE = 8
+"""
+Patch size OmniCloudMask is run with at most, and at least: its model
+downsamples by 32, smaller atlases are padded up to MIN_PATCH_SIZE with
+no data.
+"""
+MAX_PATCH_SIZE = 1000
+MIN_PATCH_SIZE = 64
+NODATA = 255
+MASK_SUFFIX = "ocm"
+
+
+@dataclasses.dataclass
+class MaskTarget:
+    """
+    The files of one downloaded field date.
+    """
+    folder: pl.Path
+    scene_id: str
+    files: list
+
+    @property
+    def mask_path(self):
+        return self.folder.joinpath(f"{self.scene_id}_{MASK_SUFFIX}.tif")
+
+
+@dataclasses.dataclass
+class FieldRaster:
+    target: MaskTarget
+    data: np.ndarray
+    transform: object
+    crs: object
+
+    @property
+    def bbox(self):
+        height, width = self.data.shape[1:]
+        left, top = self.transform.c, self.transform.f
+        return sh.BBox((left, top + height * self.transform.e, left + width * self.transform.a, top),
+                       sh.CRS(self.crs.to_epsg()))
+
+
+@dataclasses.dataclass
+class Area:
+    """
+    The canvas of a group of fields of one scene. col_off/row_off are its
+    position in its atlas once it is packed.
+    """
+    fields: list
+    data: np.ndarray
+    transform: object
+    col_off: int = 0
+    row_off: int = 0
+
+    def window(self, field: FieldRaster):
+        col = round((field.transform.c - self.transform.c) / self.transform.a)
+        row = round((field.transform.f - self.transform.f) / self.transform.e)
+        return Window(col, row, field.data.shape[2], field.data.shape[1])
+
+
+def read_ocm_bands(target: MaskTarget, layout: ol.OutputLayout):
+    """
+    Red, green and NIR of a field date as (3, height, width), with the
+    transform and crs of its files. None if a band is missing.
+    """
+    bands = {}
+    transform = crs = None
+    for path in target.files:
+        names = layout.band_names(path) or []
+        wanted = [(index, name) for index, name in enumerate(names) if name in OCM_BANDS]
+        if not wanted:
+            continue
+        with rio.open(path) as dataset:
+            transform, crs = dataset.transform, dataset.crs
+            for index, name in wanted:
+                bands[name] = dataset.read(index + 1)
+    if len(bands) < len(OCM_BANDS):
+        return None
+    return FieldRaster(target, np.stack([bands[name] for name in OCM_BANDS]), transform, crs)
+
+
+def build_areas(fields):
+    """
+    Put fields of one scene that lie within AREA_GAP of each other on a
+    common canvas.
+    """
+    areas = []
+    for cluster in fc.cluster_fields([field.bbox for field in fields], max_distance=AREA_GAP):
+        members = [fields[index] for index in cluster.members]
+        first = members[0].transform
+        left = min(field.transform.c for field in members)
+        top = max(field.transform.f for field in members)
+        right = max(field.transform.c + field.data.shape[2] * first.a for field in members)
+        bottom = min(field.transform.f + field.data.shape[1] * first.e for field in members)
+        width = round((right - left) / first.a)
+        height = round((bottom - top) / first.e)
+        transform = rio.transform.from_origin(left, top, first.a, -first.e)
+        area = Area(members, np.zeros((3, height, width), dtype=members[0].data.dtype), transform)
+        for field in members:
+            window = area.window(field)
+            area.data[:, window.row_off:window.row_off + window.height,
+                      window.col_off:window.col_off + window.width] = field.data
+        areas.append(area)
+    return areas
+
+
+def pack_areas(areas, atlas_size: int = ATLAS_SIZE, padding: int = PADDING):
+    """
+    Shelf packing: sort the areas by height and place them in rows from
+    left to right, a new row when one is full, a new atlas when it is.
+    Areas larger than atlas_size get an atlas of their own. Returns a
+    list of (atlas shape, [Area]) with col_off/row_off set.
+    """
+    atlases = []
+    current = []
+    x = y = row_height = 0
+    for area in sorted(areas, key=lambda area: area.data.shape[1], reverse=True):
+        height, width = area.data.shape[1] + padding, area.data.shape[2] + padding
+        if height > atlas_size or width > atlas_size:
+            area.col_off = area.row_off = 0
+            atlases.append(((height, width), [area]))
+            continue
+        if x + width > atlas_size:
+            x, y, row_height = 0, y + row_height, 0
+        if y + height > atlas_size:
+            atlases.append(((atlas_size, atlas_size), current))
+            current, x, y, row_height = [], 0, 0, 0
+        area.col_off, area.row_off = x, y
+        current.append(area)
+        x += width
+        row_height = max(row_height, height)
+    if current:
+        used_height = max(area.row_off + area.data.shape[1] + padding for area in current)
+        used_width = max(area.col_off + area.data.shape[2] + padding for area in current)
+        atlases.append(((used_height, used_width), current))
+    return atlases
+
+
+def predict_atlas(shape, areas, batch_size: int = BATCH_SIZE):
+    """
+    Run OmniCloudMask once over all areas of an atlas and return every
+    area's mask, NODATA where the area has no data.
+    """
+    from omnicloudmask import predict_from_array
+
+    shape = tuple(max(side, MIN_PATCH_SIZE) for side in shape)
+    atlas = np.zeros((3, *shape), dtype=np.float32)
+    for area in areas:
+        atlas[:, area.row_off:area.row_off + area.data.shape[1],
+              area.col_off:area.col_off + area.data.shape[2]] = area.data
+    patch_size = min(MAX_PATCH_SIZE, *shape)
+    mask = predict_from_array(
+        atlas, patch_size=patch_size, patch_overlap=min(300, patch_size // 4), batch_size=batch_size,
+        inference_device="cpu", mosaic_device="cpu", no_data_value=0
+    )[0].astype(np.uint8)
+
+    masks = []
+    for area in areas:
+        area_mask = mask[area.row_off:area.row_off + area.data.shape[1],
+                         area.col_off:area.col_off + area.data.shape[2]].copy()
+        area_mask[(area.data == 0).all(axis=0)] = NODATA
+        masks.append(area_mask)
+    return masks
+
+
+def write_mask(field: FieldRaster, mask: np.ndarray):
+    profile = {
+        "driver": "GTiff", "width": mask.shape[1], "height": mask.shape[0], "count": 1,
+        "dtype": "uint8", "crs": field.crs, "transform": field.transform, "nodata": NODATA,
+        "compress": "deflate",
+    }
+    path = field.target.mask_path
+    tmp_path = path.with_name("." + path.name + ".part")
+    try:
+        with rio.open(tmp_path, "w", **profile) as dataset:
+            dataset.write(mask, 1)
+        tmp_path.replace(path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return rw.describe_file(path)
+
+
+def mask_downloads(targets, layout: ol.OutputLayout, batch_size: int = BATCH_SIZE,
+                   atlas_size: int = ATLAS_SIZE):
+    """
+    Compute and write the cloud masks of all targets (MaskTarget) that
+    have none yet. Returns the list of WrittenFile of the masks.
+    """
+    if not set(OCM_BANDS) <= set(layout.input_bands):
+        logger.warning(f"Cloud masks need {', '.join(OCM_BANDS)} in the output layout, skipped")
+        return []
+    scenes = {}
+    for target in targets:
+        if target.mask_path.exists() or not target.folder.exists():
+            continue
+        field = read_ocm_bands(target, layout)
+        if field is None:
+            logger.warning(f"{target.folder}: bands for the cloud mask missing")
+            continue
+        scenes.setdefault((target.scene_id, field.crs.to_epsg()), []).append(field)
+
+    areas = [area for fields in scenes.values() for area in build_areas(fields)]
+    atlases = pack_areas(areas, atlas_size)
+    logger.info(f"Cloud masks: {sum(len(area.fields) for area in areas)} field dates in {len(areas)} "
+                f"areas, {len(atlases)} model runs")
+    written = []
+    for shape, atlas_areas in atlases:
+        for area, area_mask in zip(atlas_areas, predict_atlas(shape, atlas_areas, batch_size)):
+            for field in area.fields:
+                window = area.window(field)
+                written.append(write_mask(field, area_mask[window.row_off:window.row_off + window.height,
+                                                           window.col_off:window.col_off + window.width]))
+    return written
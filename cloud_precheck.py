@@ -0,0 +1,225 @@
+"""
+Per-field cloud pre-check before the full resolution download.
+
+The catalog search only filters on eo:cloud_cover, which is the cloud
+cover of the whole 110 x 110 km tile. A field under a single cloud in an
+otherwise clear tile is still downloaded with all bands at 10 m. The
+pre-check sends one small request per candidate (field, date) first:
+SCL, CLM and dataMask as UINT8 at PRECHECK_RESOLUTION (60 m), a few
+dozen pixels for a normal field. The valid fraction is the share of
+pixels inside the field polygon that have data, no cloud in CLM and no
+cloud, cloud shadow, saturated or no-data class in SCL. Dates below
+min_valid_fraction are dropped before the expensive request is made.
+
+All pre-check requests are sent in one go through a
+SentinelHubDownloadClient with max_threads requests at a time; a
+pre-check that fails keeps its date. The fractions are kept in a small
+json lines file, so a rerun (or one with another threshold) does not
+check the same scene again.
+
+Processing units are estimated with the Sentinel Hub formula: output
+pixels / 512², at least 0.01, times input bands / 3, times 2 for
+FLOAT32 output. The report compares what the pre-check cost with the
+estimated units and bytes of the downloads it dropped.
+"""
+import dataclasses
+import json
+import logging
+import pathlib as pl
+import threading
+
+import numpy as np
+import rasterio.features
+import sentinelhub as sh
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+
+import output_layouts as ol
+
+logger = logging.getLogger("SHD.cloud_precheck")
+
+PRECHECK_RESOLUTION = 60
+MIN_VALID_FRACTION = 0.5
+"""
+SCL classes that are no usable observation of the ground: no data,
+saturated or defective, cloud shadow, cloud medium and high
+probability, thin cirrus
+"""
+INVALID_SCL = (0, 1, 3, 8, 9, 10)
+LAYOUT = ol.OutputLayout([ol.OutputFile("default", ["SCL", "CLM", "dataMask"], "UINT8")])
+
+
+def processing_units(size, input_bands: int, float32: bool = False):
+    """
+    Estimated processing units of a Process API request with an output
+    of size (width, height) pixels.
+    """
+    width, height = size
+    units = max(width * height / 512 ** 2, 0.01) * input_bands / 3
+    return units * 2 if float32 else units
+
+
+def layout_processing_units(size, layout: ol.OutputLayout):
+    float32 = any(file.sample_type == "FLOAT32" for file in layout.files)
+    return processing_units(size, len(layout.input_bands), float32)
+
+
+def layout_bytes(size, layout: ol.OutputLayout):
+    """
+    Uncompressed size of the output of a request with this layout.
+    """
+    return size[0] * size[1] * layout.bytes_per_pixel
+
+
+def valid_fraction(data: np.ndarray, transform, geometry):
+    """
+    Share of the pixels inside geometry that are valid in data (SCL,
+    CLM, dataMask). Every pixel the polygon touches counts, so small
+    fields still get a pixel at 60 m. 0.0 if no pixel is inside.
+    """
+    scl, clm, data_mask = data
+    inside = rasterio.features.geometry_mask([geometry], scl.shape, transform, invert=True,
+                                             all_touched=True)
+    if not inside.any():
+        return 0.0
+    valid = (data_mask == 1) & (clm == 0) & ~np.isin(scl, INVALID_SCL)
+    return float(valid[inside].mean())
+
+
+def precheck_size(bbox: sh.BBox, resolution: float = PRECHECK_RESOLUTION):
+    width, height = sh.bbox_to_dimensions(bbox, resolution)
+    return max(width, 1), max(height, 1)
+
+
+def create_precheck_request(date_str: str, bbox: sh.BBox, config: sh.SHConfig,
+                            resolution: float = PRECHECK_RESOLUTION,
+                            data_collection=sh.DataCollection.SENTINEL2_L2A):
+    return sh.SentinelHubRequest(
+        evalscript=LAYOUT.evalscript(),
+        input_data=[
+            sh.SentinelHubRequest.input_data(
+                data_collection=data_collection,
+                time_interval=(date_str, date_str),
+                mosaicking_order="leastRecent"
+            )
+        ],
+        responses=LAYOUT.responses(),
+        bbox=bbox,
+        size=precheck_size(bbox, resolution),
+        config=config
+    )
+
+
+@dataclasses.dataclass
+class Candidate:
+    """
+    One (field, date) that is about to be downloaded. geometry is the
+    field polygon in the CRS of bbox, size the size of the full download.
+    """
+    field_key: str
+    date_str: str
+    scene_id: str
+    bbox: sh.BBox
+    geometry: object
+    size: tuple
+
+
+@dataclasses.dataclass
+class PrecheckReport:
+    checked: int = 0
+    cached: int = 0
+    failed: int = 0
+    dropped: int = 0
+    precheck_units: float = 0.0
+    saved_units: float = 0.0
+    saved_bytes: int = 0
+
+    def summary(self):
+        return (f"Cloud pre-check: {self.dropped} of {self.checked + self.cached} dates dropped "
+                f"({self.cached} known from earlier runs, {self.failed} failed), "
+                f"cost {self.precheck_units:.2f} PU, saved about {self.saved_units:.2f} PU "
+                f"and {self.saved_bytes / 1e6:.1f} MB")
+
+
+class CloudPrecheck:
+    """
+    Valid fractions per (field key, date, scene id), kept in the json
+    lines file at path.
+    """
+
+    def __init__(self, path: pl.Path, config: sh.SHConfig,
+                 min_valid_fraction: float = MIN_VALID_FRACTION,
+                 resolution: float = PRECHECK_RESOLUTION, max_threads: int = 4,
+                 data_collection=sh.DataCollection.SENTINEL2_L2A):
+        self.path = pl.Path(path)
+        self.config = config
+        self.min_valid_fraction = min_valid_fraction
+        self.resolution = resolution
+        self.max_threads = max_threads
+        self.data_collection = data_collection
+        self.lock = threading.Lock()
+        self.fractions = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.fractions[(entry["field"], entry["date"], entry["scene_id"])] = entry["valid"]
+
+    def record(self, candidate: Candidate, fraction: float):
+        self.fractions[(candidate.field_key, candidate.date_str, candidate.scene_id)] = fraction
+        line = json.dumps({"field": candidate.field_key, "date": candidate.date_str,
+                           "scene_id": candidate.scene_id, "valid": round(fraction, 4)})
+        with self.lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
+    def fraction_from_response(self, content: bytes, candidate: Candidate):
+        with MemoryFile(content) as memfile, memfile.open() as dataset:
+            data = dataset.read()
+            transform = from_bounds(*candidate.bbox, dataset.width, dataset.height)
+        return valid_fraction(data, transform, candidate.geometry)
+
+    def check(self, candidates, layout: ol.OutputLayout):
+        """
+        Return the candidates worth downloading with layout and a
+        PrecheckReport. Fractions not known yet are requested all at once.
+        """
+        report = PrecheckReport()
+        unknown = [candidate for candidate in candidates
+                   if (candidate.field_key, candidate.date_str, candidate.scene_id) not in self.fractions]
+        report.cached = len(candidates) - len(unknown)
+        report.checked = len(unknown)
+
+        requests = [create_precheck_request(candidate.date_str, candidate.bbox, self.config,
+                                            self.resolution, self.data_collection)
+                    for candidate in unknown]
+        client = sh.SentinelHubDownloadClient(config=self.config, raise_download_errors=False)
+        responses = client.download([request.download_list[0] for request in requests],
+                                    max_threads=self.max_threads, decode_data=False)
+        for candidate, response in zip(unknown, responses):
+            report.precheck_units += layout_processing_units(
+                precheck_size(candidate.bbox, self.resolution), LAYOUT)
+            if response is None:
+                report.failed += 1
+                continue
+            try:
+                fraction = self.fraction_from_response(getattr(response, "content", response), candidate)
+            except Exception as e:
+                logger.warning(f"{candidate.field_key} {candidate.date_str}: pre-check unreadable ({e!r})")
+                report.failed += 1
+                continue
+            self.record(candidate, fraction)
+
+        keep = []
+        for candidate in candidates:
+            fraction = self.fractions.get((candidate.field_key, candidate.date_str, candidate.scene_id))
+            if fraction is not None and fraction < self.min_valid_fraction:
+                logger.info(f"{candidate.field_key} {candidate.date_str}: {fraction:.0%} valid, skipped")
+                report.dropped += 1
+                report.saved_units += layout_processing_units(candidate.size, layout)
+                report.saved_bytes += layout_bytes(candidate.size, layout)
+            else:
+                keep.append(candidate)
+        return keep, report
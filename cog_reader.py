@@ -0,0 +1,384 @@
+"""
+Minimal asynchronous reader for Cloud Optimized GeoTIFFs over HTTP.
+
+rioxarray.open_rasterio opens every band through GDAL's /vsicurl/, each
+call with its own connections and its own header requests, which cannot
+be shared between threads. This reader only needs an async source of
+byte ranges (HttpRangeSource wraps one httpx.AsyncClient for that), so
+all bands of all scenes can go over one connection pool.
+
+Only what the Sentinel-2 COGs need is supported: tiled, single sample
+per pixel, uncompressed or deflate with or without horizontal predictor,
+georeferenced with ModelPixelScale/ModelTiepoint and an EPSG code in the
+GeoKeyDirectory. Only the full resolution image (the first IFD) is read.
+Sparse tiles (TileByteCounts 0, nothing stored) are not fetched but
+filled with nodata, as GDAL does.
+read_window fetches the tiles overlapping a pixel window, merging tiles
+that lie close together in the file into one range request; read_windows
+does the same for the union of the tiles of several windows.
+"""
+import asyncio
+import dataclasses
+import struct
+import zlib
+
+import numpy as np
+from affine import Affine
+from rasterio.windows import Window
+
+"""
+Bytes fetched for the header first. Sentinel-2 COGs have their IFDs and
+tile offsets within the first 16 KB, anything beyond is fetched on demand.
+"""
+HEADER_SIZE = 64 * 1024
+"""
+Tiles whose byte ranges are at most this far apart are fetched with one
+request, the bytes in between are thrown away.
+"""
+MERGE_GAP = 64 * 1024
+
+TAG_NAMES = {
+    256: "width", 257: "height", 258: "bits_per_sample", 259: "compression",
+    277: "samples_per_pixel", 284: "planar_configuration", 317: "predictor",
+    322: "tile_width", 323: "tile_height", 324: "tile_offsets",
+    325: "tile_byte_counts", 339: "sample_format", 33550: "pixel_scale",
+    33922: "tiepoint", 34735: "geo_keys", 42113: "nodata",
+}
+"""
+TIFF field types: struct format and size in bytes
+"""
+FIELD_TYPES = {
+    1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8),
+    6: ("b", 1), 7: ("B", 1), 8: ("h", 2), 9: ("i", 4), 10: ("ii", 8),
+    11: ("f", 4), 12: ("d", 8), 16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8),
+}
+SAMPLE_FORMATS = {1: "u", 2: "i", 3: "f"}
+DEFLATE = (8, 32946)
+
+
+class NeedMoreBytes(Exception):
+    """
+    Raised by the header parser when the header buffer ends before
+    the given offset.
+    """
+
+    def __init__(self, end: int):
+        super().__init__(end)
+        self.end = end
+
+
+class HttpRangeSource:
+    """
+    Byte ranges of the file at href, fetched with an httpx.AsyncClient.
+    At most as many requests as semaphore allows are in flight at once
+    (across all sources sharing it). If given, the coroutine function
+    sign_href(href) is awaited right before every request, so each one
+    goes out with a current signature. requests and bytes_read count what went over the wire.
+    """
+
+    def __init__(self, client, href: str, semaphore: asyncio.Semaphore = None, sign_href=None):
+        self.client = client
+        self.href = href
+        self.semaphore = semaphore or asyncio.Semaphore(8)
+        self.sign_href = sign_href
+        self.requests = 0
+        self.bytes_read = 0
+
+    async def head(self):
+        """
+        ETag (None if the server sends none) and size of the file.
+        """
+        href = await self.sign_href(self.href) if self.sign_href else self.href
+        async with self.semaphore:
+            response = await self.client.head(href)
+        response.raise_for_status()
+        self.requests += 1
+        return response.headers.get("ETag"), int(response.headers["Content-Length"])
+
+    async def read(self, start: int, end: int):
+        """
+        Return the bytes start (inclusive) to end (exclusive). May return
+        less at the end of the file.
+        """
+        href = await self.sign_href(self.href) if self.sign_href else self.href
+        async with self.semaphore:
+            response = await self.client.get(href, headers={"Range": f"bytes={start}-{end - 1}"})
+        response.raise_for_status()
+        self.requests += 1
+        self.bytes_read += len(response.content)
+        if response.status_code == 200:
+            return response.content[start:end]
+        return response.content
+
+
+@dataclasses.dataclass
+class CogInfo:
+    """
+    What is needed from the header of the first IFD to read tiles.
+    """
+    width: int
+    height: int
+    tile_width: int
+    tile_height: int
+    dtype: np.dtype
+    compression: int
+    predictor: int
+    tile_offsets: tuple
+    tile_byte_counts: tuple
+    transform: Affine
+    epsg: int
+    nodata: float = None
+
+    @property
+    def tiles_across(self):
+        return -(-self.width // self.tile_width)
+
+
+def parse_ifd(buffer: bytes, offset: int, byteorder: str, bigtiff: bool):
+    """
+    Parse the IFD at offset into a dict of {tag name: tuple of values}
+    for the tags in TAG_NAMES. Raises NeedMoreBytes if buffer is too short.
+    """
+    count_format, entry_size, value_size = ("Q", 20, 8) if bigtiff else ("H", 12, 4)
+    count_size = struct.calcsize(count_format)
+    if offset + count_size > len(buffer):
+        raise NeedMoreBytes(offset + count_size)
+    (n_entries,) = struct.unpack_from(byteorder + count_format, buffer, offset)
+    entries_end = offset + count_size + n_entries * entry_size
+    if entries_end > len(buffer):
+        raise NeedMoreBytes(entries_end + value_size)
+
+    tags = {}
+    for index in range(n_entries):
+        entry = offset + count_size + index * entry_size
+        if bigtiff:
+            tag, field_type, count = struct.unpack_from(byteorder + "HHQ", buffer, entry)
+        else:
+            tag, field_type, count = struct.unpack_from(byteorder + "HHI", buffer, entry)
+        if tag not in TAG_NAMES:
+            continue
+        value_format, item_size = FIELD_TYPES[field_type]
+        size = item_size * count
+        value_offset = entry + entry_size - value_size
+        if size > value_size:
+            (value_offset,) = struct.unpack_from(byteorder + ("Q" if bigtiff else "I"), buffer, value_offset)
+            if value_offset + size > len(buffer):
+                raise NeedMoreBytes(value_offset + size)
+        if field_type == 2:
+            values = (buffer[value_offset:value_offset + count].rstrip(b"\0").decode(),)
+        else:
+            n_values = count * len(value_format)
+            values = struct.unpack_from(f"{byteorder}{n_values}{value_format[0]}", buffer, value_offset)
+        tags[TAG_NAMES[tag]] = values
+    return tags
+
+
+def parse_header(buffer: bytes):
+    """
+    Parse the TIFF header and first IFD in buffer into a CogInfo.
+    Raises NeedMoreBytes if buffer is too short.
+    """
+    if len(buffer) < 16:
+        raise NeedMoreBytes(16)
+    byteorder = {b"II": "<", b"MM": ">"}.get(buffer[:2])
+    if byteorder is None:
+        raise ValueError("not a TIFF file")
+    (version,) = struct.unpack_from(byteorder + "H", buffer, 2)
+    bigtiff = version == 43
+    if bigtiff:
+        (ifd_offset,) = struct.unpack_from(byteorder + "Q", buffer, 8)
+    else:
+        (ifd_offset,) = struct.unpack_from(byteorder + "I", buffer, 4)
+    tags = parse_ifd(buffer, ifd_offset, byteorder, bigtiff)
+
+    if "tile_offsets" not in tags:
+        raise ValueError("only tiled TIFFs are supported")
+    if tags.get("samples_per_pixel", (1,))[0] != 1:
+        raise ValueError("only single band TIFFs are supported")
+    compression = tags.get("compression", (1,))[0]
+    predictor = tags.get("predictor", (1,))[0]
+    if compression not in (1, *DEFLATE) or predictor not in (1, 2):
+        raise ValueError(f"unsupported compression {compression} / predictor {predictor}")
+
+    bits = tags["bits_per_sample"][0]
+    kind = SAMPLE_FORMATS[tags.get("sample_format", (1,))[0]]
+    dtype = np.dtype(f"{byteorder}{kind}{bits // 8}")
+    scale_x, scale_y = tags["pixel_scale"][:2]
+    i, j, _, x, y, _ = tags["tiepoint"][:6]
+    transform = Affine(scale_x, 0.0, x - i * scale_x, 0.0, -scale_y, y + j * scale_y)
+    nodata = float(tags["nodata"][0]) if tags.get("nodata", ("",))[0].strip() else None
+
+    return CogInfo(
+        width=tags["width"][0], height=tags["height"][0],
+        tile_width=tags["tile_width"][0], tile_height=tags["tile_height"][0],
+        dtype=dtype, compression=compression, predictor=predictor,
+        tile_offsets=tags["tile_offsets"], tile_byte_counts=tags["tile_byte_counts"],
+        transform=transform, epsg=geokeys_epsg(tags.get("geo_keys", ())), nodata=nodata
+    )
+
+
+def geokeys_epsg(geo_keys):
+    """
+    The EPSG code of the projected (3072) or geographic (2048) CRS
+    in a GeoKeyDirectory.
+    """
+    keys = {geo_keys[index]: geo_keys[index + 3] for index in range(4, len(geo_keys) - 3, 4)}
+    return keys.get(3072) or keys.get(2048)
+
+
+def empty_tile(info: CogInfo):
+    """
+    The tile of a sparse file where nothing is stored: all nodata (0 if
+    the file has none).
+    """
+    return np.full((info.tile_height, info.tile_width), info.nodata or 0, dtype=info.dtype.newbyteorder("="))
+
+
+def decode_tile(info: CogInfo, data: bytes):
+    """
+    Decompress one tile into a (tile_height, tile_width) array. An empty
+    (sparse) tile is returned filled with nodata.
+    """
+    if not data:
+        return empty_tile(info)
+    if info.compression in DEFLATE:
+        data = zlib.decompress(data)
+    tile = np.frombuffer(data, dtype=info.dtype).reshape(info.tile_height, info.tile_width)
+    if info.predictor == 2:
+        tile = np.cumsum(tile, axis=1, dtype=info.dtype)
+    return tile.astype(info.dtype.newbyteorder("="), copy=False)
+
+
+def merge_ranges(ranges, max_gap: int = MERGE_GAP):
+    """
+    Group (start, end, key) byte ranges, sorted by start, into
+    (start, end, [(start, end, key)]) requests covering ranges that are
+    at most max_gap apart.
+    """
+    merged = []
+    for start, end, key in sorted(ranges):
+        if merged and start - merged[-1][1] <= max_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][2].append((start, end, key))
+        else:
+            merged.append([start, end, [(start, end, key)]])
+    return merged
+
+
+class CogReader:
+    """
+    A COG opened from a range source (anything with an async
+    read(start, end) method). Create it with await CogReader.open(source).
+    """
+
+    def __init__(self, source, info: CogInfo):
+        self.source = source
+        self.info = info
+
+    @classmethod
+    async def open(cls, source, header_size: int = HEADER_SIZE):
+        buffer = await source.read(0, header_size)
+        while True:
+            try:
+                return cls(source, parse_header(buffer))
+            except NeedMoreBytes as e:
+                if len(buffer) < header_size:
+                    raise ValueError("TIFF header is truncated") from e
+                header_size = max(e.end, 2 * header_size)
+                buffer += await source.read(len(buffer), header_size)
+
+    @property
+    def transform(self):
+        return self.info.transform
+
+    @property
+    def epsg(self):
+        return self.info.epsg
+
+    def window_from_bounds(self, bounds):
+        """
+        The pixel window covering bounds (minx, miny, maxx, maxy, in the
+        crs of the COG), cut to the image.
+        """
+        inverse = ~self.info.transform
+        col_min, row_min = inverse @ (bounds[0], bounds[3])
+        col_max, row_max = inverse @ (bounds[2], bounds[1])
+        col_off, row_off = max(int(np.floor(col_min)), 0), max(int(np.floor(row_min)), 0)
+        col_end = min(int(np.ceil(col_max)), self.info.width)
+        row_end = min(int(np.ceil(row_max)), self.info.height)
+        return Window(col_off, row_off, max(col_end - col_off, 0), max(row_end - row_off, 0))
+
+    def window_tiles(self, window: Window):
+        """
+        Indices (row, col) of all tiles overlapping the window.
+        """
+        info = self.info
+        rows = range(int(window.row_off) // info.tile_height,
+                     -(-int(window.row_off + window.height) // info.tile_height))
+        cols = range(int(window.col_off) // info.tile_width,
+                     -(-int(window.col_off + window.width) // info.tile_width))
+        return [(row, col) for row in rows for col in cols]
+
+    async def read_tiles(self, tiles):
+        """
+        Fetch and decode the given (row, col) tiles. Neighbouring tiles
+        are fetched together, sparse tiles not at all. Returns
+        {(row, col): array}.
+        """
+        info = self.info
+        ranges = []
+        sparse = {}
+        for row, col in tiles:
+            index = row * info.tiles_across + col
+            start = info.tile_offsets[index]
+            if info.tile_byte_counts[index] == 0:
+                sparse[(row, col)] = empty_tile(info)
+                continue
+            ranges.append((start, start + info.tile_byte_counts[index], (row, col)))
+
+        requests = merge_ranges(ranges)
+        contents = await asyncio.gather(*(self.source.read(start, end) for start, end, _ in requests))
+        raw_tiles = {
+            key: content[tile_start - start:tile_end - start]
+            for (start, _, members), content in zip(requests, contents)
+            for tile_start, tile_end, key in members
+        }
+        decoded = await asyncio.to_thread(
+            lambda: {key: decode_tile(info, data) for key, data in raw_tiles.items()})
+        return {**decoded, **sparse}
+
+    def assemble(self, tiles: dict, window: Window):
+        """
+        Put the pixels of window together from decoded tiles (as returned
+        by read_tiles, which must include all tiles of the window).
+        """
+        info = self.info
+        col_off, row_off = int(window.col_off), int(window.row_off)
+        width, height = int(window.width), int(window.height)
+        data = np.zeros((height, width), dtype=info.dtype.newbyteorder("="))
+        for row, col in self.window_tiles(window):
+            tile = tiles[(row, col)]
+            tile_row, tile_col = row * info.tile_height, col * info.tile_width
+            top, left = max(row_off, tile_row), max(col_off, tile_col)
+            bottom = min(row_off + height, tile_row + info.tile_height)
+            right = min(col_off + width, tile_col + info.tile_width)
+            data[top - row_off:bottom - row_off, left - col_off:right - col_off] = \
+                tile[top - tile_row:bottom - tile_row, left - tile_col:right - tile_col]
+        return data
+
+    async def read_window(self, window: Window):
+        """
+        Read the pixels of window (which must lie within the image)
+        into a (height, width) array.
+        """
+        return self.assemble(await self.read_tiles(self.window_tiles(window)), window)
+
+    async def read_windows(self, windows):
+        """
+        Read several windows with one batch of range requests for the
+        union of their tiles, so tiles shared by windows are fetched and
+        decoded only once. Returns a list of arrays.
+        """
+        tiles = sorted({tile for window in windows for tile in self.window_tiles(window)})
+        decoded = await self.read_tiles(tiles)
+        return [self.assemble(decoded, window) for window in windows]
@@ -1,4 +1,3 @@
-import geopandas as gpd
 from sentinelhub import (MimeType, SHConfig, SentinelHubCatalog, Geometry, DataCollection, SentinelHubRequest)
 import os
 import shutil
@@ -6,6 +5,9 @@ import tarfile
 from tkinter import Tk, filedialog, Label, Button
 from tkcalendar import DateEntry
 
+import field_clusters as fc
+import field_registry as fr
+
 ### Variablen setzen
 
 # Test-Dateien für schnelle Durchläufe
@@ -136,18 +138,53 @@ function evaluatePixel(sample) {
 }
 """
 
+### Katalog-Suche für alle Shapefiles
+
+# Statt einer Katalog-Anfrage pro Shapefile werden benachbarte Felder zu Clustern zusammengefasst
+# und jeder Cluster nur einmal (mit der BBox um alle seine Felder) abgefragt.
+# Über die Footprints der gefundenen Items wird zurückgerechnet, welche Felder sie abdecken.
+def search_item_dates_clustered(fields, start_date, end_date, config, max_distance=5000):
+    
+    # Geometrien aller Felder aus der Feld-Tabelle (field_registry.read_fields) nehmen
+    geometries = {
+        field.path: Geometry(field.geometry, crs=int(field.epsg))
+        for field in fields.itertuples() if field.features == 1
+    }
+    
+    # Ein Katalog für alle Anfragen
+    catalog = SentinelHubCatalog(config=config)
+    
+    def search(cluster_bbox):
+        return catalog.search(
+            DataCollection.SENTINEL2_L2A,
+            bbox=cluster_bbox,
+            time=(start_date, end_date),
+            # Datum und Footprint des Items für die Zuordnung zu den Feldern
+            fields={
+                "include": ["id", "properties.datetime", "geometry"],
+                "exclude": []
+            }
+        )
+    
+    shapefile_list = list(geometries)
+    clusters = fc.cluster_fields(list(geometries.values()), max_distance=max_distance)
+    items_per_field = fc.search_clusters(clusters, search)
+    
+    # Pro Shapefile die sortierte Liste der Daten (ohne Uhrzeit) zurückgeben
+    return {
+        shapefile_list[index]: sorted({item['properties']['datetime'][:10] for item in items})
+        for index, items in items_per_field.items()
+    }
+
 ### Download-Funktion
-def download_sentinelhub_bands(shapefile_path, start_date, end_date, input_root, output_root, config):
+# field ist eine Zeile der Feld-Tabelle aus field_registry.read_fields
+# item_date_list kann aus search_item_dates_clustered übergeben werden, sonst wird der Katalog pro Shapefile abgefragt
+def download_sentinelhub_bands(field, start_date, end_date, input_root, output_root, config, item_date_list=None):
     
-    # Shapefile einlesen
-    try:
-        gdf = gpd.read_file(shapefile_path).to_crs("EPSG:4326")
-    except Exception as e:
-        print(f"⚠️ Fehler beim Laden von {shapefile_path}: {e}")
-        return
+    shapefile_path = field.path
     # Shapefiles mit mehr als einem Polygon werden übersprungen
-    if len(gdf) != 1:
-        print(f"⚠️ Überspringe {shapefile_path}: enthält {len(gdf)} Features (erwartet 1).")
+    if field.features != 1:
+        print(f"⚠️ Überspringe {shapefile_path}: enthält {field.features} Features (erwartet 1).")
         return
 
     # Output-Ordner erstellen
@@ -156,26 +193,27 @@ def download_sentinelhub_bands(shapefile_path, start_date, end_date, input_root,
     
     ### SentinelHub-Abfrage
     
-    # Polygon aus Shapefile zu SentinelHub-Geometry-Objekt konvertieren
-    geometry = Geometry(gdf.geometry[0], crs=4326)
+    # Polygon (in seiner UTM-Zone) zu SentinelHub-Geometry-Objekt konvertieren
+    geometry = Geometry(field.geometry, crs=int(field.epsg))
 
-    # SentinelHub Catalog erstellen
-    catalog = SentinelHubCatalog(config=config)
-    
-    # Katalog-Anfrage formulieren
-    search_iterator = catalog.search(
-        DataCollection.SENTINEL2_L2A,
-        geometry=geometry,
-        time=(start_date, end_date),
-        # Uns interessiert nur das Datum des Items
-        fields={
-            "include": ["properties.datetime"],
-            "exclude": []
-        }
-    )
-    
-    # Liste mit Daten der verfügbaren Items erstellen und dabei Uhrzeit (Ab Zeichen 11) abschneiden
-    item_date_list = sorted({item['properties']['datetime'][:10] for item in search_iterator})
+    if item_date_list is None:
+        # SentinelHub Catalog erstellen
+        catalog = SentinelHubCatalog(config=config)
+        
+        # Katalog-Anfrage formulieren
+        search_iterator = catalog.search(
+            DataCollection.SENTINEL2_L2A,
+            geometry=geometry,
+            time=(start_date, end_date),
+            # Uns interessiert nur das Datum des Items
+            fields={
+                "include": ["properties.datetime"],
+                "exclude": []
+            }
+        )
+        
+        # Liste mit Daten der verfügbaren Items erstellen und dabei Uhrzeit (Ab Zeichen 11) abschneiden
+        item_date_list = sorted({item['properties']['datetime'][:10] for item in search_iterator})
     
     
     for item_date in item_date_list:
@@ -212,7 +250,11 @@ def download_sentinelhub_bands(shapefile_path, start_date, end_date, input_root,
         
 def main():
     shapefiles = find_shapefiles(TEST_INPUT_FOLDER)
-    for shapefile in shapefiles:
-        download_sentinelhub_bands(shapefile, TEST_START_DATE, TEST_END_DATE, TEST_INPUT_FOLDER, TEST_OUTPUT_FOLDER, config)
+    # Alle Shapefiles auf einmal einlesen, nicht lesbare werden übersprungen
+    fields = fr.read_fields(shapefiles, TEST_INPUT_FOLDER)
+    item_dates = search_item_dates_clustered(fields, TEST_START_DATE, TEST_END_DATE, config)
+    for field in fields.itertuples():
+        download_sentinelhub_bands(field, TEST_START_DATE, TEST_END_DATE, TEST_INPUT_FOLDER, TEST_OUTPUT_FOLDER, config,
+                                   item_date_list=item_dates.get(field.path))
 
 main()
\ No newline at end of file
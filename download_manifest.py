@@ -0,0 +1,157 @@
+"""
+Journal of the completed downloads.
+
+The scripts used to create the date folder before the download and to
+skip every date whose folder exists. A crash during a request left an
+empty (or half filled) folder behind that was skipped in every later run,
+and the check cost one stat per date on the network drive.
+
+The manifest is an append-only JSON lines file instead. A line is only
+added after all tifs of a (field, date) have been written under their
+final names (which happens atomically, see response_writer.py), and
+records the scene id, bands, output layout, sizes and sha256 checksums
+of the files. It is read into memory once at the start; resume and skip
+decisions are then only lookups in a dict. A (field, date) only counts
+as done if its recorded layout covers the layout of the current run, so
+a rerun with other bands downloads the date again. A line cut off by a crash is ignored when
+reading, so that download simply counts as not done, and the file is
+compacted right away so the next line does not get appended to it.
+compact() rewrites the file with one line per (field, date) through a
+temporary file that is renamed over the old one.
+"""
+import datetime as dt
+import json
+import logging
+import os
+import pathlib as pl
+import threading
+
+logger = logging.getLogger("SHD.download_manifest")
+
+
+def layout_record(layout):
+    """
+    What the manifest keeps of an output_layouts.OutputLayout: the units
+    and the bands and sample type of every file id.
+    """
+    return {
+        "units": layout.units,
+        "outputs": {file.id: {"bands": list(file.bands), "sample_type": file.sample_type} for file in layout.files}
+    }
+
+
+class DownloadManifest:
+    """
+    The completed downloads in the JSON lines file at path, keyed by
+    (field, date). field is any string identifying the field, e.g. the
+    output folder relative to the output base folder. layout is the
+    OutputLayout of the run; it is recorded with every download and a
+    (field, date) is only "in" the manifest if its recording covers it.
+    """
+
+    def __init__(self, path: pl.Path, layout=None):
+        self.path = pl.Path(path)
+        self.layout = layout
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        if not self.path.exists():
+            return
+        skipped = 0
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                    key = (entry["field"], entry["date"])
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    """
+                    A line cut off by a crash, or one that parses but
+                    is not a whole entry (e.g. only "{}" was written).
+                    """
+                    skipped += 1
+                    continue
+                self.entries[key] = entry
+        if skipped:
+            logger.warning(f"{self.path.name}: {skipped} unreadable or incomplete lines ignored")
+            self.compact()
+        logger.info(f"{self.path.name}: {len(self.entries)} downloads done")
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and self.covers(entry)
+
+    def covers(self, entry: dict):
+        """
+        Whether the files of entry hold every file of the run's layout,
+        with the same bands, sample type and units. Entries written
+        before the layout was recorded only know their file ids, which
+        identify the content of single band files only.
+        """
+        if self.layout is None:
+            return True
+        recorded = entry.get("layout")
+        if recorded is None:
+            return all(len(file.bands) == 1 and file.id in entry.get("bands", []) for file in self.layout.files)
+        requested = layout_record(self.layout)
+        return recorded["units"] == requested["units"] and all(
+            recorded["outputs"].get(file_id) == output for file_id, output in requested["outputs"].items())
+
+    def get(self, field: str, date_str: str):
+        return self.entries.get((field, date_str))
+
+    def record(self, field: str, date_str: str, scene_id: str, written):
+        """
+        Add a completed download with its list of WrittenFile. The line
+        is flushed and synced before the entry counts as done. If the
+        date was recorded before from the same scene and in the same
+        units, the files and outputs of that earlier download are kept
+        next to the new ones (e.g. B04 from a first run, B08 from a
+        rerun with other bands).
+        """
+        files = [{"name": pl.Path(file.path).name, "size": file.size, "sha256": file.sha256}
+                 for file in written]
+        layout = layout_record(self.layout) if self.layout is not None else None
+        with self.lock:
+            previous = self.entries.get((field, date_str))
+        if (previous is not None and layout is not None and previous.get("layout") is not None
+                and previous["scene_id"] == scene_id and previous["layout"]["units"] == layout["units"]):
+            names = {file["name"] for file in files}
+            files = [file for file in previous["files"] if file["name"] not in names] + files
+            layout["outputs"] = {**previous["layout"]["outputs"], **layout["outputs"]}
+        entry = {
+            "field": field,
+            "date": date_str,
+            "scene_id": scene_id,
+            "bands": [pl.Path(file["name"]).stem.removeprefix(scene_id + "_") for file in files],
+            "layout": layout,
+            "files": files,
+            "finished_at": dt.datetime.now().replace(microsecond=0).isoformat()
+        }
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.entries[(field, date_str)] = entry
+        return entry
+
+    def compact(self):
+        """
+        Rewrite the manifest with only the latest entry per (field, date).
+        """
+        with self.lock:
+            tmp_path = self.path.with_name("." + self.path.name + ".part")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as file:
+                    for entry in self.entries.values():
+                        file.write(json.dumps(entry) + "\n")
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
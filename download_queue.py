@@ -0,0 +1,178 @@
+"""
+A small scheduler for running many SentinelHub downloads at once.
+
+The download scripts first expand every (shapefile, scene date) pair into
+a single list of DownloadJobs and hand that list to run_download_queue.
+The queue keeps at most max_workers requests in flight over all fields,
+runs the jobs of one field strictly in the order they were added and
+retries requests that failed with a 429 (rate limit) or 5xx status with
+an exponential backoff.
+"""
+import collections
+import concurrent.futures as cf
+import dataclasses
+import logging
+import random
+import time
+from typing import Any, Callable
+
+logger = logging.getLogger("SHD.download_queue")
+
+"""
+HTTP status codes after which a request is worth repeating. Everything
+else (400 for a broken evalscript, 401 for wrong credentials, ...) fails
+straight away.
+"""
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+@dataclasses.dataclass
+class DownloadJob:
+    """
+    One unit of work for the queue. field_key groups the jobs that must
+    run one after another (usually the shapefile path), label is only used
+    for the log output and run does the actual download.
+    """
+    field_key: str
+    label: str
+    run: Callable[[], Any]
+
+
+@dataclasses.dataclass
+class QueueStats:
+    """
+    Counters collected by run_download_queue, mainly to compare the
+    throughput of different concurrency settings.
+    """
+    done: int = 0
+    failed: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    @property
+    def jobs_per_second(self) -> float:
+        return self.done / self.seconds if self.seconds else 0.0
+
+
+def get_status_code(exception: BaseException):
+    """
+    Dig the HTTP status code out of an exception raised by sentinelhub
+    (DownloadFailedException keeps the requests exception in
+    request_exception) or by requests itself. Returns None if there is none.
+    """
+    while exception is not None:
+        for candidate in (getattr(exception, "request_exception", None), exception):
+            response = getattr(candidate, "response", None)
+            status_code = getattr(response, "status_code", None)
+            if status_code is not None:
+                return status_code
+        exception = exception.__cause__ or exception.__context__
+    return None
+
+
+def get_retry_after(exception: BaseException):
+    """
+    Return the Retry-After header of a 429 response in seconds, if the
+    server sent one. Sentinel Hub sends it in milliseconds.
+    """
+    request_exception = getattr(exception, "request_exception", exception)
+    response = getattr(request_exception, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After")) / 1000
+    except (TypeError, ValueError):
+        return None
+
+
+def run_with_backoff(job: DownloadJob, max_retries: int = 5,
+                     backoff_base: float = 1.0, backoff_max: float = 60.0):
+    """
+    Run a single job. On a retryable status code wait backoff_base * 2^n
+    seconds (plus some jitter, or whatever the server asked for via
+    Retry-After) and try again, at most max_retries times.
+    Returns the result of the job and the number of retries needed.
+    """
+    retries = 0
+    while True:
+        try:
+            return job.run(), retries
+        except Exception as e:
+            status_code = get_status_code(e)
+            if status_code not in RETRY_STATUS_CODES or retries >= max_retries:
+                raise
+            delay = get_retry_after(e)
+            if delay is None:
+                delay = min(backoff_max, backoff_base * 2 ** retries)
+                delay *= random.uniform(0.5, 1.0)
+            retries += 1
+            logger.info(f"{job.label}: HTTP {status_code}, retry {retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def report_error(job: DownloadJob, exception: BaseException,
+                 on_error: Callable[[DownloadJob, BaseException], None] | None):
+    """
+    Pass a failed job to on_error, or log it. An error raised by on_error
+    itself is only logged, it must not stop the queue.
+    """
+    if on_error is None:
+        logger.error(f"{job.label}: Failed ({exception})")
+        return
+    try:
+        on_error(job, exception)
+    except Exception as e:
+        logger.error(f"{job.label}: Failed ({exception}), error handler failed too ({e})")
+
+
+def run_download_queue(jobs, max_workers: int = 4, max_retries: int = 5,
+                       backoff_base: float = 1.0,
+                       on_done: Callable[[DownloadJob, Any], None] | None = None,
+                       on_error: Callable[[DownloadJob, BaseException], None] | None = None):
+    """
+    Run all jobs with at most max_workers of them in flight.
+
+    Jobs are grouped by their field_key. Only one job per field runs at a
+    time and the jobs of a field keep their order, while the fields
+    themselves are served round robin, so a single field with many dates
+    does not block all the others. A failing job is logged (or passed to
+    on_error) and does not stop the remaining jobs of its field. The same
+    goes for a job whose on_done raises: it counts as failed and the
+    queue carries on with the jobs still in flight.
+    """
+    pending = collections.OrderedDict()
+    for job in jobs:
+        pending.setdefault(job.field_key, collections.deque()).append(job)
+    ready = collections.deque(pending)
+    running = {}
+    stats = QueueStats()
+    start = time.perf_counter()
+
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or running:
+            while ready and len(running) < max_workers:
+                field_key = ready.popleft()
+                job = pending[field_key].popleft()
+                future = executor.submit(run_with_backoff, job, max_retries, backoff_base)
+                running[future] = job
+
+            finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                try:
+                    result, retries = future.result()
+                    stats.retries += retries
+                    if on_done is not None:
+                        on_done(job, result)
+                except Exception as e:
+                    stats.failed += 1
+                    report_error(job, e, on_error)
+                else:
+                    stats.done += 1
+                if pending[job.field_key]:
+                    ready.append(job.field_key)
+
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"Queue: {stats.done} done, {stats.failed} failed, "
+                f"{stats.retries} retries in {stats.seconds:.1f}s "
+                f"({stats.jobs_per_second:.2f} jobs/s)")
+    return stats
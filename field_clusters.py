@@ -0,0 +1,154 @@
+"""
+Search the catalog once per group of neighbouring fields instead of
+once per field.
+
+Most fields of one betrieb lie in the same one or two Sentinel-2 tiles,
+so searching every shapefile separately mostly returns the same scenes
+over and over. cluster_fields groups fields whose bboxes lie within
+max_distance of each other (in the same UTM zone). search_clusters then
+sends one catalog search per cluster with the bbox around all of its
+fields and hands every scene back to the fields its footprint actually
+intersects, using a shapely STRtree. search_fields_by_cluster leaves
+that to a search over the fields' own bboxes instead (see
+CatalogCache.search_fields), so the results can be cached per field
+and do not depend on which other fields are in the cluster.
+"""
+import dataclasses
+import logging
+
+import numpy as np
+import sentinelhub as sh
+import shapely
+import shapely.geometry
+
+logger = logging.getLogger("SHD.field_clusters")
+
+
+@dataclasses.dataclass
+class FieldCluster:
+    """
+    A group of fields that are searched together. members are the
+    indices of the fields in the list given to cluster_fields,
+    geometries their shapes in the cluster's UTM crs.
+    """
+    crs: sh.CRS
+    members: list
+    geometries: list
+
+    @property
+    def bbox(self):
+        """
+        The bbox around all fields of the cluster, used for the search.
+        """
+        bounds = shapely.total_bounds(np.array(self.geometries))
+        return sh.BBox(bbox=tuple(bounds), crs=self.crs)
+
+    @property
+    def member_bboxes(self):
+        """
+        The bbox of every field of the cluster, in the cluster's crs.
+        """
+        return [sh.BBox(bbox=tuple(shapely.bounds(geometry)), crs=self.crs) for geometry in self.geometries]
+
+
+def to_utm(geometry):
+    """
+    Return a sh.BBox or sh.Geometry as sh.Geometry in a UTM crs. Shapes
+    that are in a UTM crs already keep it, everything else is moved into
+    the UTM zone of its centroid.
+    """
+    if isinstance(geometry, sh.BBox):
+        geometry = sh.Geometry(geometry.geometry, geometry.crs)
+    if geometry.crs.is_utm():
+        return geometry
+    wgs84_geometry = geometry.transform(sh.CRS.WGS84)
+    centroid = wgs84_geometry.geometry.centroid
+    return wgs84_geometry.transform(sh.CRS.get_utm_from_wgs84(centroid.x, centroid.y))
+
+
+def cluster_fields(geometries, max_distance: float = 5000.0):
+    """
+    Group fields (sh.BBox or sh.Geometry, any crs) into FieldClusters.
+    Two fields end up in the same cluster if their bboxes are less than
+    max_distance meters apart, directly or through other fields in
+    between. Fields in different UTM zones are never clustered together.
+    """
+    by_crs = {}
+    for index, geometry in enumerate(geometries):
+        utm_geometry = to_utm(geometry)
+        by_crs.setdefault(utm_geometry.crs, []).append((index, utm_geometry.geometry))
+
+    clusters = []
+    for crs, fields in by_crs.items():
+        indices = [index for index, _ in fields]
+        shapes = np.array([shape for _, shape in fields])
+        """
+        Buffer the field bboxes by half the distance and merge the
+        overlapping ones. Each part of the union is one cluster, the
+        STRtree finds the fields belonging to it.
+        """
+        buffered = shapely.buffer(shapely.envelope(shapes), max_distance / 2, join_style="mitre")
+        merged = shapely.get_parts(shapely.union_all(buffered))
+        tree = shapely.STRtree(buffered)
+        for part in merged:
+            members = sorted(tree.query(part, predicate="intersects"))
+            clusters.append(FieldCluster(
+                crs=crs,
+                members=[indices[member] for member in members],
+                geometries=[shapes[member] for member in members]
+            ))
+    logger.info(f"{len(geometries)} fields in {len(clusters)} clusters")
+    return clusters
+
+
+def scene_footprint(scene: dict, crs: sh.CRS):
+    """
+    Return the footprint of a catalog feature as a shapely geometry in
+    crs. Catalog footprints are GeoJSON in WGS84.
+    """
+    footprint = shapely.geometry.shape(scene["geometry"])
+    return sh.Geometry(footprint, sh.CRS.WGS84).transform(crs).geometry
+
+
+def assign_scenes(cluster: FieldCluster, scenes):
+    """
+    Hand the catalog features found for a cluster to the fields whose
+    geometry intersects the scene footprint. Returns a dict of
+    {field index: [scenes]}, keeping the order of the scenes.
+    """
+    assigned = {member: [] for member in cluster.members}
+    if not scenes:
+        return assigned
+    footprints = [scene_footprint(scene, cluster.crs) for scene in scenes]
+    tree = shapely.STRtree(footprints)
+    field_indices, scene_indices = tree.query(np.array(cluster.geometries), predicate="intersects")
+    for field_index, scene_index in sorted(zip(field_indices, scene_indices), key=lambda pair: pair[1]):
+        assigned[cluster.members[field_index]].append(scenes[scene_index])
+    return assigned
+
+
+def search_clusters(clusters, search):
+    """
+    Run search(bbox) once for every cluster and assign the returned
+    features (which must include their "geometry") to the fields.
+    Returns a dict of {field index: [scenes]} over all clusters.
+    """
+    scenes_per_field = {}
+    for cluster in clusters:
+        scenes = list(search(cluster.bbox))
+        scenes_per_field.update(assign_scenes(cluster, scenes))
+    logger.info(f"{len(clusters)} catalog searches for {len(scenes_per_field)} fields")
+    return scenes_per_field
+
+
+def search_fields_by_cluster(clusters, search_fields):
+    """
+    Run search_fields(member bboxes) once for every cluster, which must
+    return the features of each member bbox. Returns a dict of
+    {field index: [scenes]} over all clusters.
+    """
+    scenes_per_field = {}
+    for cluster in clusters:
+        scenes_per_field.update(zip(cluster.members, search_fields(cluster.member_bboxes)))
+    logger.info(f"{len(clusters)} cluster searches for {len(scenes_per_field)} fields")
+    return scenes_per_field
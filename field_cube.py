@@ -0,0 +1,190 @@
+"""
+Per-field datacube output in Zarr.
+
+Writing one GeoTIFF per band, date and field leaves tens of thousands of
+small files on the share, and every time series analysis has to open
+all of them again. A FieldCube keeps all downloads of a field in one
+Zarr store with a single array "data" of time x band x y x x.
+
+The chunks are chosen for reading time series: TIME_CHUNK dates of one
+band and up to SPACE_CHUNK x SPACE_CHUNK pixels, which for most fields
+is the whole field, so the series of a band is a handful of chunks. A
+new date grows the time axis by one (only the metadata changes) and
+writes into the last time chunk of each band, earlier chunks are never
+rewritten. A band that is not in the cube yet grows the band axis the
+same way. Dates are appended in the order they arrive, dates and scene
+ids are kept in the group attributes; to_xarray returns the cube sorted
+by date.
+
+All data written to one cube must be on the same grid (shape, transform
+and crs are stored with the first write). The dtype of the cube is that
+of the first write too, the common dtype of all tifs of a response or
+date folder (uint8 quality bands next to uint16 bands give uint16, a
+FLOAT32 output gives float32). Later data must fit into it without
+loss, otherwise write_band raises instead of truncating it. Data can
+come from response tifs (append_response / append_files) or from
+arrays, e.g. a clipped rioxarray DataArray (write_band).
+"""
+import contextlib
+import pathlib as pl
+import threading
+
+import numpy as np
+import rasterio as rio
+import zarr
+from affine import Affine
+from rasterio.io import MemoryFile
+
+import pixel_sampler as ps
+import response_writer as rw
+
+TIME_CHUNK = 16
+SPACE_CHUNK = 256
+COMPRESSOR = zarr.codecs.BloscCodec(cname="zstd", clevel=5, shuffle="bitshuffle")
+
+
+def file_band_names(path, dataset, layout=None):
+    names = layout.band_names(path) if layout is not None else None
+    return names or ps.band_names(path, dataset)
+
+
+class FieldCube:
+    """
+    The Zarr cube at path, created on the first write. dtype fixes the
+    dtype of a new cube instead of taking it from the data.
+    """
+
+    def __init__(self, path: pl.Path, dtype: str = None, fill_value=0):
+        self.path = pl.Path(path)
+        self.dtype = dtype
+        self.fill_value = fill_value
+        self.lock = threading.Lock()
+        self.group = zarr.open_group(self.path, mode="a")
+
+    @property
+    def dates(self):
+        return list(self.group.attrs.get("dates", []))
+
+    @property
+    def bands(self):
+        return list(self.group.attrs.get("bands", []))
+
+    def has(self, date_str: str, band: str = None):
+        """
+        Whether the cube has the date (and the band for that date).
+        """
+        if date_str not in self.dates:
+            return False
+        return band is None or band in self.group.attrs.get("written", {}).get(date_str, [])
+
+    def create(self, shape, transform: Affine, crs, dtype):
+        height, width = shape
+        self.group.create_array(
+            "data", shape=(0, 0, height, width),
+            chunks=(TIME_CHUNK, 1, min(SPACE_CHUNK, height), min(SPACE_CHUNK, width)),
+            dtype=self.dtype or dtype, fill_value=self.fill_value, compressors=COMPRESSOR,
+            dimension_names=["time", "band", "y", "x"]
+        )
+        self.group.attrs.update({
+            "transform": list(transform)[:6], "crs": str(crs), "nodata": self.fill_value,
+            "dates": [], "scene_ids": [], "bands": [], "written": {},
+        })
+
+    def check_grid(self, shape, transform: Affine, crs):
+        data = self.group["data"]
+        if tuple(shape) != data.shape[2:] or not transform.almost_equals(
+                Affine(*self.group.attrs["transform"])) or str(crs) != self.group.attrs["crs"]:
+            raise ValueError(f"{self.path.name}: data is not on the grid of the cube "
+                             f"({tuple(shape)} {transform} vs. {data.shape[2:]})")
+
+    def write_band(self, date_str: str, scene_id: str, band: str, data: np.ndarray,
+                   transform: Affine, crs, dtype=None):
+        """
+        Write one band of one date. Adds the date and the band to the
+        cube if they are new. A new cube gets dtype, or the dtype of data.
+        """
+        data = np.asarray(data)
+        if data.ndim == 3:
+            data = data[0]
+        with self.lock:
+            if "data" not in self.group:
+                self.create(data.shape, transform, crs, dtype or data.dtype)
+            self.check_grid(data.shape, transform, crs)
+            array = self.group["data"]
+            if not np.can_cast(data.dtype, array.dtype):
+                raise ValueError(f"{self.path.name}: {band} ({data.dtype}) does not fit into "
+                                 f"the {array.dtype} cube")
+            attrs = self.group.attrs.asdict()
+
+            if date_str not in attrs["dates"]:
+                attrs["dates"].append(date_str)
+                attrs["scene_ids"].append(scene_id)
+            if band not in attrs["bands"]:
+                attrs["bands"].append(band)
+            time_index = attrs["dates"].index(date_str)
+            band_index = attrs["bands"].index(band)
+            shape = (len(attrs["dates"]), len(attrs["bands"]), *array.shape[2:])
+            if shape != array.shape:
+                array.resize(shape)
+
+            array[time_index, band_index] = data.astype(array.dtype, copy=False)
+            written = attrs["written"].setdefault(date_str, [])
+            if band not in written:
+                written.append(band)
+            self.group.attrs.update(attrs)
+
+    def append_files(self, date_str: str, scene_id: str, paths, layout=None):
+        """
+        Write the band tifs of one date, band names as in
+        pixel_sampler.band_names (scene_id_B02.tif -> B02), or as in the
+        output_layouts.OutputLayout the files were downloaded with.
+        """
+        with contextlib.ExitStack() as stack:
+            datasets = [stack.enter_context(rio.open(path)) for path in paths]
+            self.append_datasets(date_str, scene_id, list(zip(paths, datasets)), layout)
+
+    def append_response(self, content: bytes, date_str: str, scene_id: str, single_name: str, layout=None):
+        """
+        Write all band tifs of a Process API response held in memory. A
+        single tif response is named single_name (see
+        response_writer.response_name).
+        """
+        with contextlib.ExitStack() as stack:
+            datasets = [(name, stack.enter_context(stack.enter_context(MemoryFile(data)).open()))
+                        for name, data in rw.read_response_members(content, single_name)]
+            self.append_datasets(date_str, scene_id, datasets, layout)
+
+    def append_datasets(self, date_str: str, scene_id: str, datasets, layout=None):
+        """
+        Write the bands of the open (name, dataset) pairs of one date. A
+        new cube gets the common dtype of all of them.
+        """
+        dtype = np.result_type(*(dataset.dtypes[0] for _, dataset in datasets)) if datasets else None
+        for name, dataset in datasets:
+            for band, data in zip(file_band_names(name, dataset, layout), dataset.read()):
+                self.write_band(date_str, scene_id, band, data, dataset.transform, dataset.crs, dtype)
+
+    def to_xarray(self):
+        """
+        The cube as xarray DataArray with time, band, y and x coordinates,
+        sorted by date.
+        """
+        import pandas as pd
+        import xarray as xr
+
+        attrs = self.group.attrs.asdict()
+        array = self.group["data"]
+        transform = Affine(*attrs["transform"])
+        height, width = array.shape[2:]
+        cube = xr.DataArray(
+            array[:], dims=("time", "band", "y", "x"),
+            coords={
+                "time": pd.to_datetime(attrs["dates"]),
+                "band": attrs["bands"],
+                "scene_id": ("time", attrs["scene_ids"]),
+                "y": transform.f + transform.e * (np.arange(height) + 0.5),
+                "x": transform.c + transform.a * (np.arange(width) + 0.5),
+            },
+            attrs={"crs": attrs["crs"], "nodata": attrs["nodata"]}
+        )
+        return cube.sortby("time")
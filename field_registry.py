@@ -0,0 +1,135 @@
+"""
+All shapefiles of a run as one table.
+
+The scripts prepared every shapefile on its own: read it, estimate its
+UTM zone, reproject it, unite its features and compute the bbox. Here
+read_fields reads all shapefiles with pyogrio, max_workers at a time
+(threads: reading is I/O on the network drive, and the flat scripts
+cannot be re-imported by the worker processes of a process pool),
+reprojects them with one to_crs per (source crs, UTM zone) group, and
+computes the buffered bboxes rounded to the resolution grid and the
+pixel sizes of all fields at once with shapely and numpy.
+
+The result is a GeoDataFrame with one row per shapefile: path, key
+(path relative to the input folder without suffix), betrieb, epsg,
+number of features, the features themselves (zones), the bbox
+(min_x, min_y, max_x, max_y), width and height, and the union of the
+features as geometry. The fields lie in different UTM zones, so the
+geometry column has no crs of its own; every row is in its epsg.
+"""
+import concurrent.futures
+import logging
+import pathlib as pl
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+
+logger = logging.getLogger("SHD.field_registry")
+
+BUFFER = 100.0  # Meter
+MAX_WORKERS = 8
+
+
+def read_shapefile(path: pl.Path):
+    """
+    The features of a shapefile, None if it cannot be read.
+    """
+    try:
+        return pyogrio.read_dataframe(path)
+    except Exception as e:
+        logger.warning(f"{path}: not readable ({e!r}), skipped")
+        return None
+
+
+def utm_epsg(lon, lat):
+    """
+    EPSG codes of the WGS84 UTM zones of the points (lon, lat).
+    """
+    zone = np.clip(np.floor((np.asarray(lon) + 180) / 6).astype(int) + 1, 1, 60)
+    return np.where(np.asarray(lat) >= 0, 32600, 32700) + zone
+
+
+def field_bounds(geometries, resolution: float = 10, buffer: float = BUFFER):
+    """
+    Bboxes (n, 4) of the geometries, buffered by buffer meters and with
+    their edges rounded to the resolution grid, and their pixel sizes
+    (n, 2) as width and height.
+    """
+    bounds = shapely.bounds(np.asarray(geometries)) + np.array([-buffer, -buffer, buffer, buffer])
+    bounds = np.round(bounds / resolution) * resolution
+    sizes = np.round((bounds[:, 2:] - bounds[:, :2]) / resolution).astype(int)
+    return bounds, sizes
+
+
+def to_utm(features: gpd.GeoDataFrame):
+    """
+    Move the features (with a "field" column) into the UTM zone of their
+    field. Fields in a projected crs with an EPSG code keep it (the bboxes
+    and sizes are computed in meters, and the requests need the code).
+    Everything else, geographic crs like EPSG:4326, EPSG:4258 or CRS84
+    and custom crs without a code, goes via WGS84 into the zone of the
+    center of its bounds. Returns the features with an "epsg" column and
+    no crs.
+    """
+    source_epsg = features.crs.to_epsg()
+    if features.crs.is_projected and source_epsg is not None:
+        return pd.DataFrame({"field": features["field"].to_numpy(), "epsg": source_epsg,
+                             "geometry": features.geometry.to_numpy()})
+    features = features.to_crs(4326)
+    bounds = pd.DataFrame(shapely.bounds(features.geometry.to_numpy()), columns=["min_x", "min_y", "max_x", "max_y"])
+    bounds = bounds.groupby(features["field"].to_numpy()).agg(
+        {"min_x": "min", "min_y": "min", "max_x": "max", "max_y": "max"})
+    zones = pd.Series(utm_epsg((bounds["min_x"] + bounds["max_x"]) / 2, (bounds["min_y"] + bounds["max_y"]) / 2),
+                      index=bounds.index)
+    epsg = zones.reindex(features["field"].to_numpy()).to_numpy()
+    parts = []
+    for zone in np.unique(epsg):
+        group = features[epsg == zone]
+        parts.append(pd.DataFrame({"field": group["field"].to_numpy(), "epsg": zone,
+                                   "geometry": group.geometry.to_crs(int(zone)).to_numpy()}))
+    return pd.concat(parts, ignore_index=True)
+
+
+def read_fields(paths, input_folder: pl.Path, resolution: float = 10, buffer: float = BUFFER,
+                max_workers: int = MAX_WORKERS):
+    """
+    Read the shapefiles at paths into one GeoDataFrame of fields, see
+    above. Unreadable shapefiles and shapefiles without features or crs
+    are logged and left out.
+    """
+    paths = [pl.Path(path) for path in paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(read_shapefile, paths))
+
+    by_crs = {}
+    for index, (path, frame) in enumerate(zip(paths, frames)):
+        if frame is None:
+            continue
+        if frame.empty or frame.crs is None:
+            logger.warning(f"{path}: no features or no crs, skipped")
+            continue
+        by_crs.setdefault(frame.crs, []).append(frame.geometry.to_frame("geometry").assign(field=index))
+    if not by_crs:
+        return gpd.GeoDataFrame(columns=["path", "key", "betrieb", "epsg", "features", "zones", "min_x",
+                                         "min_y", "max_x", "max_y", "width", "height", "geometry"])
+    features = pd.concat(
+        [to_utm(gpd.GeoDataFrame(pd.concat(group, ignore_index=True), crs=crs)) for crs, group in by_crs.items()],
+        ignore_index=True
+    ).sort_values("field", kind="stable")
+
+    grouped = features.groupby("field", sort=True)
+    fields = grouped.agg(epsg=("epsg", "first"), features=("geometry", "size"))
+    fields["zones"] = grouped["geometry"].agg(list)
+    fields["geometry"] = [shapely.union_all(zones) for zones in fields["zones"]]
+    bounds, sizes = field_bounds(fields["geometry"].to_numpy(), resolution, buffer)
+    fields[["min_x", "min_y", "max_x", "max_y"]] = bounds
+    fields[["width", "height"]] = sizes
+    relpaths = [paths[index].relative_to(input_folder) for index in fields.index]
+    fields.insert(0, "path", [paths[index] for index in fields.index])
+    fields.insert(1, "key", [relpath.with_suffix("").as_posix() for relpath in relpaths])
+    fields.insert(2, "betrieb", [relpath.parts[0] for relpath in relpaths])
+    logger.info(f"{len(fields)} of {len(paths)} shapefiles read")
+    return gpd.GeoDataFrame(fields.reset_index(drop=True), geometry="geometry")
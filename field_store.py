@@ -0,0 +1,200 @@
+"""
+Preprocessed field records that survive between runs.
+
+Before the first request every run used to read every shapefile with
+geopandas, estimate its UTM zone, reproject it, union its features and
+compute the rounded bbox and pixel size, which with thousands of
+shapefiles on the network drive takes minutes. Shapefiles hardly ever
+change, so FieldStore keeps the result in a GeoParquet file: one row
+per shapefile with its UTM EPSG code, union geometry, features (zones),
+the rounded and buffered bbox, the pixel size and the name of the
+betrieb.
+
+A row is used as it is if the modification times and sizes of the
+shapefile's files (.shp, .shx, .dbf, .prj, .cpg) are the ones it was
+made from. If they differ, the files are hashed: the same content (e.g.
+a copied folder) only updates the stamp, anything else is read again,
+all of them together with field_registry.read_fields.
+Another resolution or buffer recomputes bbox and size from the stored
+geometry without opening the shapefile.
+
+The geometry column of the file is in EPSG:4326, so the store can be
+opened in QGIS; the exact UTM geometries the downloads use are kept as
+WKB next to it.
+"""
+import dataclasses
+import hashlib
+import logging
+import os
+import pathlib as pl
+
+import geopandas as gpd
+import pandas as pd
+import sentinelhub as sh
+import shapely
+
+import field_registry as fr
+
+logger = logging.getLogger("SHD.field_store")
+
+SHAPEFILE_SUFFIXES = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+CHUNK_SIZE = 1024 * 1024
+
+
+@dataclasses.dataclass
+class FieldRecord:
+    """
+    A shapefile prepared for the download. key is its path relative to
+    the input folder without suffix, geometry the union of its features
+    and zones the features themselves, both in the UTM crs of bbox.
+    """
+    path: pl.Path
+    key: str
+    betrieb: str
+    epsg: int
+    geometry: shapely.Geometry
+    zones: list
+    bbox: sh.BBox
+    size: tuple
+
+
+def shapefile_parts(shapefile_path: pl.Path):
+    """
+    The files that make up a shapefile, as far as they exist.
+    """
+    shapefile_path = pl.Path(shapefile_path)
+    return [path for path in (shapefile_path.with_suffix(suffix) for suffix in SHAPEFILE_SUFFIXES)
+            if path.exists()]
+
+
+def file_stamp(shapefile_path: pl.Path):
+    """
+    Modification time and size of every file of the shapefile, as one
+    string. Only needs a stat per file.
+    """
+    parts = []
+    for path in shapefile_parts(shapefile_path):
+        stat = path.stat()
+        parts.append(f"{path.suffix}:{stat.st_mtime_ns}:{stat.st_size}")
+    return ";".join(parts)
+
+
+def content_hash(shapefile_path: pl.Path):
+    sha256 = hashlib.sha256()
+    for path in shapefile_parts(shapefile_path):
+        sha256.update(path.suffix.encode())
+        with open(path, "rb") as file:
+            while chunk := file.read(CHUNK_SIZE):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class FieldStore:
+    """
+    Field records of the shapefiles below input_folder, kept in the
+    GeoParquet file at path. Call save() once all fields are read.
+    """
+
+    def __init__(self, path: pl.Path, input_folder: pl.Path, resolution: float = 10,
+                 buffer: float = fr.BUFFER, max_workers: int = fr.MAX_WORKERS):
+        self.path = pl.Path(path)
+        self.input_folder = pl.Path(input_folder)
+        self.resolution = resolution
+        self.buffer = buffer
+        self.max_workers = max_workers
+        self.rows = {}
+        self.changed = False
+        self.counts = {"cached": 0, "hashed": 0, "read": 0}
+        if self.path.exists():
+            table = gpd.read_parquet(self.path)
+            self.rows = {row["key"]: row for row in table.drop(columns="geometry").to_dict("records")}
+
+    def record(self, row: dict):
+        epsg = int(row["epsg"])
+        geometry = shapely.from_wkb(row["utm_wkb"])
+        if row["resolution"] == self.resolution and row["buffer"] == self.buffer:
+            bbox = sh.BBox((row["min_x"], row["min_y"], row["max_x"], row["max_y"]), crs=sh.CRS(epsg))
+            size = (int(row["width"]), int(row["height"]))
+        else:
+            bounds, sizes = fr.field_bounds([geometry], self.resolution, self.buffer)
+            bbox, size = sh.BBox(tuple(bounds[0]), crs=sh.CRS(epsg)), tuple(int(value) for value in sizes[0])
+            self.update(row, bbox, size)
+        return FieldRecord(
+            path=self.input_folder.joinpath(row["key"] + ".shp"),
+            key=row["key"],
+            betrieb=row["betrieb"],
+            epsg=epsg,
+            geometry=geometry,
+            zones=list(shapely.get_parts(shapely.from_wkb(row["zones_wkb"]))),
+            bbox=bbox,
+            size=size
+        )
+
+    def update(self, row: dict, bbox: sh.BBox, size):
+        row.update(min_x=bbox.min_x, min_y=bbox.min_y, max_x=bbox.max_x, max_y=bbox.max_y,
+                   width=size[0], height=size[1], resolution=self.resolution, buffer=self.buffer)
+        self.changed = True
+
+    def get_many(self, shapefile_paths):
+        """
+        The FieldRecords of the shapefiles, in their order. Only the
+        shapefiles that changed since they were stored are read, all at
+        once; unreadable ones are logged and missing from the list.
+        """
+        records = {}
+        to_read = {}
+        for shapefile_path in map(pl.Path, shapefile_paths):
+            key = shapefile_path.relative_to(self.input_folder).with_suffix("").as_posix()
+            stamp = file_stamp(shapefile_path)
+            row = self.rows.get(key)
+            if row is not None and row["stamp"] == stamp:
+                self.counts["cached"] += 1
+                records[shapefile_path] = self.record(row)
+                continue
+            sha256 = content_hash(shapefile_path)
+            if row is not None and row["sha256"] == sha256:
+                self.counts["hashed"] += 1
+                row["stamp"] = stamp
+                self.changed = True
+                records[shapefile_path] = self.record(row)
+                continue
+            to_read[shapefile_path] = (stamp, sha256)
+
+        if to_read:
+            fields = fr.read_fields(list(to_read), self.input_folder, self.resolution, self.buffer,
+                                    self.max_workers)
+            self.counts["read"] += len(fields)
+            for field in fields.itertuples():
+                stamp, sha256 = to_read[field.path]
+                row = {
+                    "key": field.key, "betrieb": field.betrieb, "epsg": int(field.epsg), "stamp": stamp,
+                    "sha256": sha256, "utm_wkb": shapely.to_wkb(field.geometry),
+                    "zones_wkb": shapely.to_wkb(shapely.GeometryCollection(field.zones)),
+                }
+                self.update(row, sh.BBox((field.min_x, field.min_y, field.max_x, field.max_y),
+                                         crs=sh.CRS(int(field.epsg))), (field.width, field.height))
+                self.rows[field.key] = row
+                records[field.path] = self.record(row)
+        return [records[path] for path in map(pl.Path, shapefile_paths) if path in records]
+
+    def save(self):
+        """
+        Write the store through a temporary file, if anything changed.
+        """
+        logger.info(f"{self.path.name}: {self.counts['cached']} fields unchanged, "
+                    f"{self.counts['hashed']} touched but unchanged, {self.counts['read']} read")
+        if not self.changed:
+            return
+        table = pd.DataFrame(list(self.rows.values()))
+        wgs84 = [gpd.GeoSeries(shapely.from_wkb(group["utm_wkb"].to_numpy()), index=group.index,
+                               crs=int(epsg)).to_crs(4326)
+                 for epsg, group in table.groupby("epsg")]
+        table = gpd.GeoDataFrame(table, geometry=pd.concat(wgs84).reindex(table.index), crs=4326)
+        tmp_path = self.path.with_name("." + self.path.name + ".part")
+        try:
+            table.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self.changed = False
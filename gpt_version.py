@@ -1,15 +1,33 @@
+import argparse
 import os
-import geopandas as gpd
-import rioxarray
-from pystac_client import Client
-from planetary_computer import sign
-from tkinter import Tk, filedialog, Button
-from tkcalendar import DateEntry
-from tqdm import tqdm
 import datetime
+import glob
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+
+# geopandas, rioxarray, pystac_client, die Module von stac_engine und
+# tkinter/tkcalendar werden erst in den Funktionen importiert, die sie
+# brauchen: --help, ein Import dieses Moduls (z.B. durch einen
+# Worker-Prozess) und ein Lauf ohne --gui laden sie nicht.
+
+# Alle Shapefiles und Szenen gleichzeitig über einen gemeinsamen
+# HTTP-Client laden (stac_engine.py), höchstens MAX_IN_FLIGHT Requests
+# auf einmal. False = alter Ablauf, Shapefile für Shapefile.
+USE_ASYNC_ENGINE = True
+MAX_IN_FLIGHT = 32
+# Bereits geladene Teile der COGs lokal zwischenspeichern (range_cache.py),
+# ein erneuter Lauf oder ein Nachbarfeld lädt sie nicht noch einmal.
+USE_RANGE_CACHE = True
+# Bänder statt als einzelne Tifs in einen Zarr-Datenwürfel pro Feld
+# schreiben (field_cube.py), einen pro Auflösung: <feld>-data/cube_10m.zarr
+WRITE_CUBE = False
+
+cubes = {}
+cubes_lock = threading.Lock()
 
 def select_folder(title="Ordner auswählen"):
+    from tkinter import Tk, filedialog
     root = Tk()
     root.attributes('-topmost', True)
     root.withdraw()
@@ -18,7 +36,8 @@ def select_folder(title="Ordner auswählen"):
     return folder_selected
 
 def get_date(title="Datum auswählen"):
-    from tkinter import Label
+    from tkinter import Tk, Button, Label
+    from tkcalendar import DateEntry
     root = Tk()
     root.title(title)
     root.attributes('-topmost', True)
@@ -47,6 +66,10 @@ def get_feld_id(gdf, shapefile_path):
             return val.replace(" ", "_")
     return os.path.splitext(os.path.basename(shapefile_path))[0]
 
+def get_betrieb(shapefile_path, input_root):
+    betrieb = os.path.normpath(shapefile_path).split(os.sep)[len(os.path.normpath(input_root).split(os.sep))]
+    return betrieb.replace(" ", "_")
+
 def create_output_dir(input_root, output_root, shapefile_path, date_obj):
     rel_path = os.path.relpath(shapefile_path, input_root)
     base_path = os.path.splitext(rel_path)[0]
@@ -54,16 +77,46 @@ def create_output_dir(input_root, output_root, shapefile_path, date_obj):
     out_dir = os.path.join(output_root, base_path + "-data", date_str)
     return out_dir
 
-def download_band(band_code, href, out_path, gdf, shapefile_path, date_str):
+def field_data_dir(input_root, output_root, shapefile_path):
+    rel_path = os.path.relpath(shapefile_path, input_root)
+    return os.path.join(output_root, os.path.splitext(rel_path)[0] + "-data")
+
+def get_cube(path):
+    import field_cube
+    with cubes_lock:
+        if path not in cubes:
+            cubes[path] = field_cube.FieldCube(path)
+        return cubes[path]
+
+def write_to_cube(input_root, output_root, shapefile_path, item_id, item_datetime, band_code_lower,
+                  data, transform, crs):
+    # Bänder mit 10, 20 und 60 m liegen auf verschiedenen Rastern,
+    # daher ein Würfel pro Auflösung
+    resolution = abs(transform.a)
+    path = os.path.join(field_data_dir(input_root, output_root, shapefile_path), f"cube_{resolution:g}m.zarr")
+    get_cube(path).write_band(item_datetime[:10], item_id, band_code_lower, data, transform, crs)
+
+def in_cube(input_root, output_root, shapefile_path, item_datetime, band_code_lower):
+    paths = glob.glob(os.path.join(field_data_dir(input_root, output_root, shapefile_path), "cube_*m.zarr"))
+    return any(get_cube(path).has(item_datetime[:10], band_code_lower) for path in paths)
+
+def download_band(band_code, href, out_path, gdf, shapefile_path, date_str, write_band=None):
+    import rioxarray
     try:
         print(f"⬇️ {os.path.basename(out_path)}")
         da = rioxarray.open_rasterio(href, masked=True).squeeze()
         clipped = da.rio.clip(gdf.geometry.values, gdf.crs, drop=True)
-        clipped.rio.to_raster(out_path)
+        if write_band is not None:
+            write_band(band_code, clipped.fillna(0).values, clipped.rio.transform(), clipped.rio.crs)
+        else:
+            clipped.rio.to_raster(out_path)
     except Exception as e:
         print(f"⚠️ Fehler bei {band_code} ({shapefile_path}): {e}")
 
-def download_stac_images(shapefile_path, start_date, end_date, input_root, output_root):
+def download_stac_images(shapefile_path, start_date, end_date, input_root, output_root, token_cache):
+    import geopandas as gpd
+    from pystac_client import Client
+    from tqdm import tqdm
     try:
         gdf = gpd.read_file(shapefile_path).to_crs("EPSG:4326")
     except Exception as e:
@@ -92,18 +145,25 @@ def download_stac_images(shapefile_path, start_date, end_date, input_root, outpu
         print(f"   - {item.id} vom {item.datetime.date()}")
 
     feld_id = get_feld_id(gdf, shapefile_path)
-    betrieb = os.path.normpath(shapefile_path).split(os.sep)[len(os.path.normpath(input_root).split(os.sep))]
-    betrieb = betrieb.replace(" ", "_")
+    betrieb = get_betrieb(shapefile_path, input_root)
+
+    # Alle Szenen auf einmal signieren, der SAS-Token wird nur einmal
+    # pro Container geholt (pc_signing.py)
+    signed_items = token_cache.sign_items(items)
 
-    for item in tqdm(items, desc=f"{os.path.basename(shapefile_path)}", leave=False):
-        signed_item = sign(item)
+    for item, signed_item in tqdm(list(zip(items, signed_items)), desc=f"{os.path.basename(shapefile_path)}", leave=False):
         date_obj = item.datetime.date()
         date_str = date_obj.strftime("%Y%m%d")
 
         print(f"⬇️ Download der Szene {item.id} vom {date_obj}")
 
         out_dir = create_output_dir(input_root, output_root, shapefile_path, date_obj)
-        os.makedirs(out_dir, exist_ok=True)
+        item_datetime = item.datetime.isoformat()
+        write_band = None
+        if WRITE_CUBE:
+            write_band = partial(write_to_cube, input_root, output_root, shapefile_path, item.id, item_datetime)
+        else:
+            os.makedirs(out_dir, exist_ok=True)
 
         bands_to_download = {
             key: asset for key, asset in signed_item.assets.items()
@@ -116,7 +176,11 @@ def download_stac_images(shapefile_path, start_date, end_date, input_root, outpu
             tif_name = f"{betrieb}-{feld_id}-{date_str}-{band_code_lower}.tif"
             tif_name = tif_name.replace(" ", "_")
             out_path = os.path.join(out_dir, tif_name)
-            if not os.path.exists(out_path):
+            if WRITE_CUBE:
+                done = in_cube(input_root, output_root, shapefile_path, item_datetime, band_code_lower)
+            else:
+                done = os.path.exists(out_path)
+            if not done:
                 planned_downloads.append((band_code_lower, asset.href, out_path))
 
         if not planned_downloads:
@@ -125,12 +189,46 @@ def download_stac_images(shapefile_path, start_date, end_date, input_root, outpu
 
         with ThreadPoolExecutor(max_workers=5) as executor:
             futures = [
-                executor.submit(download_band, band_code, href, out_path, gdf, shapefile_path, date_str)
+                executor.submit(download_band, band_code, href, out_path, gdf, shapefile_path, date_str, write_band)
                 for band_code, href, out_path in planned_downloads
             ]
             for future in as_completed(futures):
                 pass
 
+def band_out_path(input_root, output_root, shapefile_path, betrieb, feld_id, item_datetime, band_code_lower):
+    date_obj = datetime.date.fromisoformat(item_datetime[:10])
+    date_str = date_obj.strftime("%Y%m%d")
+    out_dir = create_output_dir(input_root, output_root, shapefile_path, date_obj)
+    tif_name = f"{betrieb}-{feld_id}-{date_str}-{band_code_lower}.tif".replace(" ", "_")
+    return os.path.join(out_dir, tif_name)
+
+def create_field_task(shapefile_path, input_root, output_root):
+    """Gleiche Prüfungen und Dateinamen wie download_stac_images, aber als
+    Auftrag für stac_engine statt sofortigem Download."""
+    import geopandas as gpd
+    import stac_engine
+    try:
+        gdf = gpd.read_file(shapefile_path).to_crs("EPSG:4326")
+    except Exception as e:
+        print(f"⚠️ Fehler beim Laden von {shapefile_path}: {e}")
+        return None
+
+    if len(gdf) != 1:
+        print(f"⚠️ Überspringe {shapefile_path}: enthält {len(gdf)} Features (erwartet 1).")
+        return None
+
+    feld_id = get_feld_id(gdf, shapefile_path)
+    betrieb = get_betrieb(shapefile_path, input_root)
+    task = stac_engine.FieldTask(
+        name=os.path.basename(shapefile_path),
+        geometry=gdf.geometry[0],
+        out_path=partial(band_out_path, input_root, output_root, shapefile_path, betrieb, feld_id)
+    )
+    if WRITE_CUBE:
+        task.write_band = partial(write_to_cube, input_root, output_root, shapefile_path)
+        task.is_done = partial(in_cube, input_root, output_root, shapefile_path)
+    return task
+
 def find_shapefiles(folder):
     shapefiles = []
     for root, dirs, files in os.walk(folder):
@@ -139,23 +237,49 @@ def find_shapefiles(folder):
                 shapefiles.append(os.path.join(root, file))
     return shapefiles
 
-def main():
-    print("📂 Bitte Eingabe-Ordner mit Shapefiles wählen...")
-    input_root = select_folder("Input-Ordner auswählen")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Sentinel-2 L2A Bänder für alle Shapefiles eines Ordners vom Planetary Computer laden.")
+    parser.add_argument("--input", help="Eingabe-Ordner mit Shapefiles")
+    parser.add_argument("--output", help="Ausgabe-Ordner")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, help="Startdatum, JJJJ-MM-TT")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, help="Enddatum, JJJJ-MM-TT")
+    parser.add_argument("--gui", action="store_true",
+                        help="fehlende Ordner und Daten mit Dialogfenstern abfragen (braucht tkcalendar)")
+    args = parser.parse_args(argv)
+    if not args.gui:
+        missing = [f"--{name}" for name in ("input", "output", "start", "end") if getattr(args, name) is None]
+        if missing:
+            parser.error(f"{', '.join(missing)} fehlt (oder --gui für die Dialogfenster)")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    input_root = args.input
+    if not input_root:
+        print("📂 Bitte Eingabe-Ordner mit Shapefiles wählen...")
+        input_root = select_folder("Input-Ordner auswählen")
     if not input_root:
         print("❌ Kein Eingabeordner gewählt, Programm beendet.")
         return
 
-    print("📁 Bitte Ausgabe-Ordner auswählen...")
-    output_root = select_folder("Output-Ordner auswählen")
+    output_root = args.output
+    if not output_root:
+        print("📁 Bitte Ausgabe-Ordner auswählen...")
+        output_root = select_folder("Output-Ordner auswählen")
     if not output_root:
         print("❌ Kein Ausgabeordner gewählt, Programm beendet.")
         return
 
-    print("📅 Startdatum auswählen...")
-    start_date = get_date("Startdatum")
-    print("📅 Enddatum auswählen...")
-    end_date = get_date("Enddatum")
+    start_date = args.start
+    if not start_date:
+        print("📅 Startdatum auswählen...")
+        start_date = get_date("Startdatum")
+    end_date = args.end
+    if not end_date:
+        print("📅 Enddatum auswählen...")
+        end_date = get_date("Enddatum")
     if not start_date or not end_date:
         print("❌ Kein Zeitraum gewählt, Programm beendet.")
         return
@@ -170,8 +294,29 @@ def main():
     shapefiles = find_shapefiles(input_root)
     print(f"🔍 Gefundene Shapefiles: {len(shapefiles)}")
 
+    import pc_signing
+    import range_cache
+    import stac_engine
+    from tqdm import tqdm
+
+    token_cache = pc_signing.TokenCache()
+
+    if USE_ASYNC_ENGINE:
+        tasks = [create_field_task(shp, input_root, output_root) for shp in shapefiles]
+        tasks = [task for task in tasks if task is not None]
+        cache = range_cache.RangeCache() if USE_RANGE_CACHE else None
+        stats = stac_engine.download_all(
+            tasks, start_date_str, end_date_str,
+            max_in_flight=MAX_IN_FLIGHT, signer=token_cache, cache=cache
+        )
+        print(f"✔️ {stats.files} Bänder geladen, {stats.skipped} übersprungen, {stats.failed} Fehler "
+              f"({stats.bytes_read / 1e6:.1f} MB in {stats.seconds:.1f} s)")
+        if cache is not None:
+            print(f"ℹ️ {cache.report()}")
+        return
+
     for shp in tqdm(shapefiles, desc="🔄 Verarbeitung", unit="Shape"):
-        download_stac_images(shp, start_date_str, end_date_str, input_root, output_root)
+        download_stac_images(shp, start_date_str, end_date_str, input_root, output_root, token_cache)
 
 if __name__ == "__main__":
     main()
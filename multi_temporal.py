@@ -0,0 +1,274 @@
+"""
+All dates of a field in one Process API request.
+
+The download loop sends one request per field and date with
+time_interval=(date, date), so a field with 40 usable dates in a season
+costs 40 round trips, each with its own authentication, queueing and
+tar. The evalscript generated here uses ORBIT mosaicking instead: the
+request covers the whole time range of the field's planned dates,
+preProcessScenes drops every orbit that is not one of them, and every
+output file gets the bands of all remaining acquisitions one after
+another (date by date, the bands of the layout file within each date).
+The dates themselves come back in a userdata.json output, in the order
+of the stacked bands.
+
+split_response cuts the stack apart into the usual per-date files
+(<date folder>/<scene id>_<output>.tif), so everything after the
+download cannot tell the difference. A planned date the service had no
+data for is missing from the result and is tried again in the next run.
+
+date_slot_evalscript is the variant for Batch Processing, which has no
+userdata output and needs the same bands in every tile: each output has
+a fixed slot of bands per date, filled with 0 (no data) where a tile
+had no acquisition on that date.
+
+chunk_targets keeps each request under max_bytes of uncompressed
+response and max_units estimated processing units (a multi-temporal
+request is charged per acquisition): the dates of a field are split into
+consecutive chunks of as many dates as fit.
+"""
+import dataclasses
+import json
+import logging
+import os
+import pathlib as pl
+
+import rasterio as rio
+import sentinelhub as sh
+from rasterio.io import MemoryFile
+
+import cloud_precheck as cp
+import output_layouts as ol
+import response_writer as rw
+
+logger = logging.getLogger("SHD.multi_temporal")
+
+MAX_RESPONSE_BYTES = 256 * 1024 * 1024
+MAX_REQUEST_UNITS = 200
+USERDATA = "userdata"
+
+
+@dataclasses.dataclass
+class DateTarget:
+    date_str: str
+    scene_id: str
+    folder: pl.Path
+
+
+@dataclasses.dataclass
+class TimeSeriesChunk:
+    """
+    Consecutive dates of one field that are downloaded together.
+    """
+    bbox: sh.BBox
+    size: tuple
+    targets: list
+
+    @property
+    def dates(self):
+        return [target.date_str for target in self.targets]
+
+    @property
+    def time_interval(self):
+        return self.targets[0].date_str, self.targets[-1].date_str
+
+
+def dates_per_request(size, layout: ol.OutputLayout, max_bytes: int = MAX_RESPONSE_BYTES,
+                      max_units: float = MAX_REQUEST_UNITS):
+    """
+    How many dates of a field of size (width, height) fit into one
+    request, at least one.
+    """
+    by_bytes = max_bytes // cp.layout_bytes(size, layout)
+    by_units = int(max_units // cp.layout_processing_units(size, layout))
+    return max(min(by_bytes, by_units), 1)
+
+
+def chunk_targets(targets, bbox: sh.BBox, size, layout: ol.OutputLayout, **kwargs):
+    """
+    Split the DateTargets of one field into TimeSeriesChunks, sorted by
+    date. kwargs are the limits of dates_per_request.
+    """
+    targets = sorted(targets, key=lambda target: target.date_str)
+    count = dates_per_request(size, layout, **kwargs)
+    return [TimeSeriesChunk(bbox, size, targets[start:start + count])
+            for start in range(0, len(targets), count)]
+
+
+def date_band_indexes(band_count: int, position: int):
+    """
+    The bands (1-based) of the date at position in a stack of band_count
+    bands per date.
+    """
+    return list(range(position * band_count + 1, (position + 1) * band_count + 1))
+
+
+def orbit_setup(layout: ol.OutputLayout, dates, slots: int = 1):
+    """
+    DATES, setup and preProcessScenes of the multi-temporal evalscripts:
+    ORBIT mosaicking, one orbit per date of dates. Each output is
+    declared with slots times the bands of its file.
+    """
+    input_bands = ",\n".join(f'                "{band}"' for band in layout.input_bands)
+    outputs = ",\n".join(
+        f'            {{ id: "{file.id}", bands: {len(file.bands) * slots}, sampleType: "{file.sample_type}" }}'
+        for file in layout.files)
+    return f"""
+var DATES = {json.dumps(sorted(dates))};
+function setup() {{
+    return {{
+        input: [{{
+            bands: [
+{input_bands}
+            ],
+            units: "{layout.units}"
+        }}],
+        output: [
+{outputs}
+        ],
+        mosaicking: "ORBIT"
+    }};
+}}
+function preProcessScenes(collections) {{
+    var seen = {{}};
+    collections.scenes.orbits = collections.scenes.orbits.filter(function (orbit) {{
+        var date = orbit.dateFrom.slice(0, 10);
+        if (DATES.indexOf(date) < 0 || seen[date]) {{
+            return false;
+        }}
+        seen[date] = true;
+        return true;
+    }});
+    return collections;
+}}
+"""
+
+
+def multi_temporal_evalscript(layout: ol.OutputLayout, dates):
+    """
+    The evalscript of layout for all acquisitions on dates, one orbit
+    per date.
+    """
+    results = ", ".join(f'"{file.id}": []' for file in layout.files)
+    pushes = "\n".join(
+        f'        result["{file.id}"].push({", ".join(f"samples[i].{band}" for band in file.bands)});'
+        for file in layout.files)
+    return orbit_setup(layout, dates) + f"""function updateOutput(outputs, collection) {{
+    var scenes = collection.scenes.orbits || collection.scenes;
+    Object.values(outputs).forEach(function (output) {{
+        output.bands = output.bands * scenes.length;
+    }});
+}}
+function updateOutputMetadata(scenes, inputMetadata, outputMetadata) {{
+    outputMetadata.userData = {{
+        dates: scenes.orbits.map(function (orbit) {{ return orbit.dateFrom.slice(0, 10); }})
+    }};
+}}
+function evaluatePixel(samples) {{
+    var result = {{ {results} }};
+    for (var i = 0; i < samples.length; i++) {{
+{pushes}
+    }}
+    return result;
+}}
+"""
+
+
+def date_slot_evalscript(layout: ol.OutputLayout, dates):
+    """
+    The evalscript of layout with len(dates) bands slots per output: the
+    bands of the acquisition on dates[i] go to slot i, slots without an
+    acquisition stay 0.
+    """
+    results = ", ".join(
+        f'"{file.id}": new Array({len(file.bands) * len(dates)}).fill(0)' for file in layout.files)
+    assignments = "\n".join(
+        f'        result["{file.id}"][slot * {len(file.bands)} + {index}] = samples[i].{band};'
+        for file in layout.files for index, band in enumerate(file.bands))
+    return orbit_setup(layout, dates, len(dates)) + f"""function evaluatePixel(samples, scenes) {{
+    var result = {{ {results} }};
+    for (var i = 0; i < samples.length; i++) {{
+        var slot = DATES.indexOf(scenes.orbits[i].dateFrom.slice(0, 10));
+{assignments}
+    }}
+    return result;
+}}
+"""
+
+
+def create_request(chunk: TimeSeriesChunk, layout: ol.OutputLayout, config: sh.SHConfig,
+                   data_collection=sh.DataCollection.SENTINEL2_L2A):
+    return sh.SentinelHubRequest(
+        evalscript=multi_temporal_evalscript(layout, chunk.dates),
+        input_data=[
+            sh.SentinelHubRequest.input_data(
+                data_collection=data_collection,
+                time_interval=chunk.time_interval,
+                mosaicking_order="leastRecent"
+            )
+        ],
+        responses=layout.responses() + [sh.SentinelHubRequest.output_response(USERDATA, sh.MimeType.JSON)],
+        bbox=chunk.bbox,
+        size=chunk.size,
+        config=config
+    )
+
+
+def write_bands(dataset, indexes, target_path: pl.Path):
+    """
+    Write the bands indexes (1-based) of an open dataset as their own
+    GeoTIFF, through a temporary file that is renamed to target_path.
+    """
+    profile = dataset.profile.copy()
+    profile.update(driver="GTiff", count=len(indexes))
+    for key in ("blockxsize", "blockysize", "tiled"):
+        profile.pop(key, None)
+    tmp_path = target_path.with_name("." + target_path.name + ".part")
+    try:
+        with rio.open(tmp_path, "w", **profile) as date_file:
+            date_file.write(dataset.read(indexes))
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return rw.describe_file(target_path)
+
+
+def split_response(content: bytes, chunk: TimeSeriesChunk, layout: ol.OutputLayout):
+    """
+    Write the stacked outputs of a multi-temporal response as one file
+    per date and output. Returns {date folder: [WrittenFile]}.
+    """
+    members = dict(rw.read_response_members(content, f"{USERDATA}.json"))
+    dates = json.loads(members.pop(f"{USERDATA}.json"))["dates"]
+    targets = {target.date_str: target for target in chunk.targets}
+    missing = sorted(set(targets) - set(dates))
+    if missing:
+        logger.warning(f"{repr(chunk.bbox)}: no acquisition for {', '.join(missing)}")
+
+    written = {}
+    for file in layout.files:
+        with MemoryFile(members[f"{file.id}.tif"]) as memfile, memfile.open() as dataset:
+            band_count = len(file.bands)
+            if dataset.count != band_count * len(dates):
+                raise ValueError(f"{file.id}.tif has {dataset.count} bands, expected "
+                                 f"{band_count} for each of {len(dates)} dates")
+            for position, date_str in enumerate(dates):
+                target = targets.get(date_str)
+                if target is None:
+                    continue
+                folder = pl.Path(target.folder)
+                folder.mkdir(parents=True, exist_ok=True)
+                indexes = date_band_indexes(band_count, position)
+                written.setdefault(folder, []).append(
+                    write_bands(dataset, indexes, folder.joinpath(f"{target.scene_id}_{file.id}.tif")))
+    return written
+
+
+def download_chunk(chunk: TimeSeriesChunk, layout: ol.OutputLayout, config: sh.SHConfig, **kwargs):
+    """
+    Download all dates of a chunk with one request and split them into
+    their date folders. Returns {date folder: [WrittenFile]}.
+    """
+    request = create_request(chunk, layout, config, **kwargs)
+    return split_response(rw.download_response(request), chunk, layout)
@@ -8,6 +8,8 @@ import datetime as dt
 import logging
 import sys
 
+import band_registry as br
+
 ### Helper functions
 """
 A callable for the bbox edge rounding.
@@ -33,6 +35,7 @@ OUTPUT_FOLDER = r"M:\IT-Projekte\digiman local\digiman_data\test_output"
 START_DATE = '2020-08-16'
 END_DATE = '2020-08-16'
 RESOLUTION = 10
+OUTPUT_LAYOUT = br.FULL
 
 """
 Create Path-Objects.
@@ -78,92 +81,16 @@ variables SH_CLIENT_ID and SH_CLIENT_SECRET
 config = sh.SHConfig()
 
 """
-Evalscript for sentinelhub request, specifying input
-and output and function to be applied. Is given an 
-array of strings specifying the bands we want (not arbitrary).
-Output an array of javascript objects (denoted by {}),
-specifying AT LEAST the number of bands.
-evaluatePixel takes as a parameter a single pixel from our scene
-(handled by the POST-Request) and MUST return an array of values,
-not objects.
-"""
-evalscript = """
-function setup() {
-    return {
-        input: [{
-            bands: [
-                 "viewZenithMean",
-                 "sunAzimuthAngles",
-                 "CLD",
-                 "B04",
-                 "B01",
-                 "B07",
-                 "B09",
-                 "AOT",
-                 "dataMask",
-                 "sunZenithAngles",
-                 "CLP",
-                 "SCL",
-                 "B08",
-                 "B11",
-                 "B05",
-                 "B02",
-                 "viewAzimuthMean",
-                 "CLM",
-                 "SNW",
-                 "B12",
-                 "B8A",
-                 "B06",
-                 "B03"
-            ],
-            units: "DN"
-        }],
-        output:
-            [{id: "default", bands: 23, sampleType: "UINT16" }]
-    };
-}
-function evaluatePixel(sample) {
-    return {
-        default: [
-            sample.B01,
-            sample.B02,
-            sample.B03,
-            sample.B04,
-            sample.B05,
-            sample.B06,
-            sample.B07,
-            sample.B08,
-            sample.B8A,
-            sample.B09,
-            sample.B11,
-            sample.B12,
-            sample.AOT,
-            sample.CLD,
-            sample.CLM,
-            sample.CLP,
-            sample.SCL,
-            sample.SNW,
-            sample.dataMask,
-            sample.sunAzimuthAngles,
-            sample.sunZenithAngles,
-            sample.viewAzimuthMean,
-            sample.viewZenithMean
-        ]
-    };
-}
-"""
-
-"""
-responses is an array of strings to be used in the
-POST-Request, specifying the name and filetype of the
-responses. the name must match an id from the output
-section of the evalscript. The output_response function
-generates such a string for us. We don't have to use all
-outputs from the evalscript. Thus the evalscript can provide
-all bands, but we could create a separate response for each one.
+The evalscript for the sentinelhub request and the matching responses
+are generated from OUTPUT_LAYOUT (see band_registry.py). br.FULL
+downloads the same 23 bands as the old single UINT16 stack, but as
+three files: the 12 bands and AOT with UINT16 (bands.tif), SCL, CLM,
+CLP, CLD, SNW and dataMask with UINT8 (quality.tif) and the angles with
+UINT16 (angles.tif). The name of every response must match an id from
+the output section of the evalscript.
 """
-responses = [
-    sh.SentinelHubRequest.output_response("default", sh.MimeType.TIFF)]
+evalscript = OUTPUT_LAYOUT.evalscript()
+responses = OUTPUT_LAYOUT.responses()
 
 ### Iterate over found shapefiles
 for shapefile_path in shapefile_list:
@@ -0,0 +1,157 @@
+"""
+Declarative output layouts for Process API requests.
+
+The scripts used to spell out their evalscript and the matching list of
+output_response by hand: one UINT16 file per band, or one UINT16 stack
+of all 23 bands. Categorical and mask bands (SCL, CLM, CLP, dataMask)
+never need more than 8 bits, but were sent and stored with 16.
+
+An OutputLayout is a list of OutputFile: the file id (the response is
+written as <prefix><id>.tif), the bands it contains, in that order, and
+their sample type. The evalscript (input bands, output definitions and
+evaluatePixel) and the responses for the request are generated from it,
+so they can never disagree. layout.band_names(path) tells the bands of a
+written file, as the response tifs carry no band descriptions.
+
+Layouts for a band selection are built from the band registry
+(band_registry.single_band_layout / stacked_layout), which knows the
+sample type of every band.
+"""
+import dataclasses
+import json
+import pathlib as pl
+
+import sentinelhub as sh
+
+"""
+Bytes per pixel and band of the Process API sample types.
+"""
+SAMPLE_TYPES = {"UINT8": 1, "UINT16": 2, "FLOAT32": 4}
+
+
+@dataclasses.dataclass
+class OutputFile:
+    id: str
+    bands: list
+    sample_type: str = "UINT16"
+
+    def __post_init__(self):
+        if self.sample_type not in SAMPLE_TYPES:
+            raise ValueError(f"{self.id}: unknown sample type {self.sample_type}, "
+                             f"expected one of {', '.join(SAMPLE_TYPES)}")
+        if not self.bands:
+            raise ValueError(f"{self.id}: no bands")
+
+
+@dataclasses.dataclass
+class OutputLayout:
+    """
+    The files a request returns. units are the units of the input bands
+    ("DN" for the raw integer values).
+    """
+    files: list
+    units: str = "DN"
+
+    def __post_init__(self):
+        ids = [file.id for file in self.files]
+        if len(set(ids)) != len(ids):
+            raise ValueError(f"File ids must be unique: {ids}")
+
+    @property
+    def input_bands(self):
+        """
+        All bands of all files, each once, in the order they first appear.
+        """
+        return list(dict.fromkeys(band for file in self.files for band in file.bands))
+
+    @property
+    def bytes_per_pixel(self):
+        return sum(len(file.bands) * SAMPLE_TYPES[file.sample_type] for file in self.files)
+
+    def evalscript(self, tile_path: str = None):
+        """
+        With tile_path (see scene_planner.tile_path) only the tiles whose
+        dataPath contains it are used (TILE mosaicking), pixels outside
+        of them are 0.
+        """
+        input_bands = ",\n".join(f'                "{band}"' for band in self.input_bands)
+        outputs = ",\n".join(
+            f'            {{ id: "{file.id}", bands: {len(file.bands)}, sampleType: "{file.sample_type}" }}'
+            for file in self.files)
+        samples = ",\n".join(
+            f"        {file.id}: [{', '.join(f'sample.{band}' for band in file.bands)}]"
+            for file in self.files)
+        if tile_path is not None:
+            return self.tile_evalscript(tile_path, input_bands, outputs, samples)
+        return f"""
+function setup() {{
+    return {{
+        input: [{{
+            bands: [
+{input_bands}
+            ],
+            units: "{self.units}"
+        }}],
+        output: [
+{outputs}
+        ]
+    }};
+}}
+function evaluatePixel(sample) {{
+    return {{
+{samples}
+    }};
+}}
+"""
+
+    def tile_evalscript(self, tile_path: str, input_bands: str, outputs: str, samples: str):
+        empty = ",\n".join(f"            {file.id}: [{', '.join('0' for _ in file.bands)}]"
+                            for file in self.files)
+        return f"""
+var TILE_PATH = {json.dumps(tile_path)};
+function setup() {{
+    return {{
+        input: [{{
+            bands: [
+{input_bands}
+            ],
+            units: "{self.units}"
+        }}],
+        output: [
+{outputs}
+        ],
+        mosaicking: "TILE"
+    }};
+}}
+function preProcessScenes(collections) {{
+    collections.scenes.tiles = collections.scenes.tiles.filter(function (tile) {{
+        return tile.dataPath.indexOf(TILE_PATH) >= 0;
+    }});
+    return collections;
+}}
+function evaluatePixel(samples) {{
+    var sample = samples[0];
+    if (sample === undefined) {{
+        return {{
+{empty}
+        }};
+    }}
+    return {{
+{samples}
+    }};
+}}
+"""
+
+    def responses(self, mime_type: sh.MimeType = sh.MimeType.TIFF):
+        return [sh.SentinelHubRequest.output_response(file.id, mime_type) for file in self.files]
+
+    def band_names(self, path: pl.Path):
+        """
+        The bands of a file written from this layout, named
+        <prefix><file id>.tif, or None if the name matches no file.
+        """
+        stem = pl.Path(path).stem
+        for file in self.files:
+            if stem == file.id or stem.endswith("_" + file.id):
+                return list(file.bands)
+        return None
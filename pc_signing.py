@@ -0,0 +1,187 @@
+"""
+Cached SAS tokens for signing Planetary Computer asset urls.
+
+planetary_computer.sign(item) is called for every single item, and the
+token behind it is fetched from the SAS endpoint whenever the library's
+own cache misses. With hundreds of scenes this adds latency and runs
+into the endpoint's rate limit. TokenCache keeps one token per storage
+account and container, the unit the endpoint hands them out for, until
+shortly before it expires:
+
+- within refresh_margin of the expiry the current token is still used,
+  but a new one is fetched in a background thread, so requests in flight
+  never wait for it and never go out with an expired signature;
+- only a token that has actually expired is fetched in the foreground,
+  and only once: callers asking for the same container at the same time
+  wait for that one request.
+
+sign_items signs a whole list of items (dicts or pystac Items) with one
+token request per container. sign_href signs a single url with the
+current token. sign_href_async does the same without blocking the event
+loop (a token that has to be fetched is fetched in a worker thread),
+stac_engine.py awaits it before every range request so long runs keep
+working past the lifetime of the first token.
+"""
+import asyncio
+import copy
+import datetime as dt
+import logging
+import threading
+import urllib.parse
+
+import httpx
+
+logger = logging.getLogger("SHD.pc_signing")
+
+PC_SAS_URL = "https://planetarycomputer.microsoft.com/api/sas/v1/token"
+SIGNED_HOSTS = (".blob.core.windows.net",)
+REFRESH_MARGIN = dt.timedelta(minutes=10)
+
+
+def container_key(href: str):
+    """
+    (storage account, container) of a blob storage url.
+    """
+    parts = urllib.parse.urlsplit(href)
+    return parts.hostname.split(".")[0], parts.path.lstrip("/").split("/")[0]
+
+
+def with_token(href: str, token: str):
+    """
+    href with token as query string (replacing an older one).
+    """
+    parts = urllib.parse.urlsplit(href)
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, token, ""))
+
+
+class TokenCache:
+    """
+    SAS tokens per (account, container), fetched from sas_url. Only urls
+    on one of signed_hosts are signed, all others are left as they are.
+    """
+
+    def __init__(self, sas_url: str = PC_SAS_URL, refresh_margin: dt.timedelta = REFRESH_MARGIN,
+                 signed_hosts=SIGNED_HOSTS, client: httpx.Client = None):
+        self.sas_url = sas_url.rstrip("/")
+        self.refresh_margin = refresh_margin
+        self.signed_hosts = tuple(signed_hosts)
+        self.client = client or httpx.Client(timeout=30.0)
+        self.tokens = {}
+        self.refreshing = set()
+        self.fetch_locks = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def fetch_token(self, key):
+        account, container = key
+        response = self.client.get(f"{self.sas_url}/{account}/{container}")
+        response.raise_for_status()
+        payload = response.json()
+        expiry = dt.datetime.fromisoformat(payload["msft:expiry"].replace("Z", "+00:00"))
+        with self.lock:
+            self.requests += 1
+            self.tokens[key] = (payload["token"], expiry)
+            self.refreshing.discard(key)
+        logger.debug(f"Token for {account}/{container} valid until {expiry.isoformat()}")
+        return payload["token"]
+
+    def refresh_in_background(self, key):
+        def refresh():
+            try:
+                self.fetch_token(key)
+            except Exception as e:
+                with self.lock:
+                    self.refreshing.discard(key)
+                logger.warning(f"Token refresh for {key[0]}/{key[1]} failed ({e!r})")
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def cached_token(self, key):
+        """
+        The cached token for key while it is valid, None otherwise. Once it
+        is within refresh_margin of its expiry, a new one is fetched in the
+        background.
+        """
+        now = dt.datetime.now(dt.timezone.utc)
+        with self.lock:
+            token, expiry = self.tokens.get(key, (None, None))
+            if token is None or now >= expiry:
+                return None
+            if now >= expiry - self.refresh_margin and key not in self.refreshing:
+                self.refreshing.add(key)
+                self.refresh_in_background(key)
+            return token
+
+    def get_token(self, key):
+        """
+        The token for key: the cached one while it is valid, else a new
+        one. Of several threads missing the same key only the first one
+        fetches it, the others wait for it and use the same token.
+        """
+        token = self.cached_token(key)
+        if token is not None:
+            return token
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(key, threading.Lock())
+        with fetch_lock:
+            token = self.cached_token(key)
+            if token is not None:
+                return token
+            return self.fetch_token(key)
+
+    async def get_token_async(self, key):
+        """
+        get_token for coroutines: a missing or expired token is fetched in
+        a worker thread, once for all coroutines waiting for it.
+        """
+        token = self.cached_token(key)
+        if token is not None:
+            return token
+        loop = asyncio.get_running_loop()
+        task = self.pending.get(key)
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(asyncio.to_thread(self.get_token, key))
+            self.pending[key] = task
+        return await asyncio.shield(task)
+
+    def should_sign(self, href: str):
+        hostname = urllib.parse.urlsplit(href).hostname or ""
+        return any(hostname.endswith(host) or hostname == host.lstrip(".") for host in self.signed_hosts)
+
+    def sign_href(self, href: str):
+        """
+        href with the current token as query string (replacing an older one).
+        """
+        if not self.should_sign(href):
+            return href
+        return with_token(href, self.get_token(container_key(href)))
+
+    async def sign_href_async(self, href: str):
+        """
+        sign_href without blocking the event loop.
+        """
+        if not self.should_sign(href):
+            return href
+        return with_token(href, await self.get_token_async(container_key(href)))
+
+    def sign_items(self, items):
+        """
+        Return signed copies of items (dicts or pystac Items), with one
+        token request per container for all of them.
+        """
+        signed = []
+        for item in items:
+            item = copy.deepcopy(item) if isinstance(item, dict) else item.clone()
+            assets = item["assets"] if isinstance(item, dict) else item.assets
+            for key, asset in assets.items():
+                if isinstance(asset, dict):
+                    if "href" in asset:
+                        asset["href"] = self.sign_href(asset["href"])
+                else:
+                    asset.href = self.sign_href(asset.href)
+            signed.append(item)
+        return signed
+
+    def close(self):
+        self.client.close()
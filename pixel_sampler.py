@@ -0,0 +1,111 @@
+"""
+Sample raster values at many points at once.
+
+The loop in raster_experiments.py reads the whole raster again for every
+pixel polygon, which gets quadratic in the raster size. Here every raster
+is read exactly once: all points are turned into row/col indices with
+one inverse affine transform over numpy arrays, and the values of every
+band for every point are gathered with fancy indexing. sample_stack does
+the same for a whole series of date folders, reading the files in
+parallel, and returns one table with a row per point and date.
+"""
+import concurrent.futures as cf
+import pathlib as pl
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import shapely
+
+
+def points_from_gdf(gdf, crs=None):
+    """
+    Return the x and y coordinates of the centroids of all geometries
+    of gdf as two numpy arrays, reprojected to crs if given.
+    """
+    if crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    coordinates = shapely.get_coordinates(shapely.centroid(gdf.geometry.values))
+    return coordinates[:, 0], coordinates[:, 1]
+
+
+def points_to_indices(transform, x, y):
+    """
+    Turn arrays of x/y coordinates into row/col indices of a raster
+    with the given affine transform, all points at once.
+    """
+    inverse = ~transform
+    cols = np.floor(inverse.a * x + inverse.b * y + inverse.c).astype(np.int64)
+    rows = np.floor(inverse.d * x + inverse.e * y + inverse.f).astype(np.int64)
+    return rows, cols
+
+
+def band_names(path: pl.Path, dataset):
+    """
+    Names for the bands of a raster: the band descriptions if it has
+    them, for single band files the part of the file name after the
+    last "_" (scene_id_B02.tif -> B02), otherwise B1, B2, ...
+    """
+    if all(dataset.descriptions):
+        return list(dataset.descriptions)
+    if dataset.count == 1:
+        return [pl.Path(path).stem.rsplit("_", 1)[-1]]
+    return [f"B{band}" for band in range(1, dataset.count + 1)]
+
+
+def sample_raster(path: pl.Path, x, y, layout=None):
+    """
+    Read the raster at path once and return the values of all its bands
+    at the points x/y as a dict of {band name: float32 array}. The bands
+    are named as in zonal_stats.file_band_names, so the generic B1, B2,
+    ... of a stack get its file id in front. Points outside the raster
+    get NaN.
+    """
+    """
+    zonal_stats imports this module for band_names.
+    """
+    import zonal_stats as zs
+
+    with rio.open(path) as dataset:
+        data = dataset.read()
+        rows, cols = points_to_indices(dataset.transform, x, y)
+        names = zs.file_band_names(path, dataset, layout)
+
+    inside = (rows >= 0) & (rows < data.shape[1]) & (cols >= 0) & (cols < data.shape[2])
+    values = np.full((data.shape[0], len(rows)), np.nan, dtype=np.float32)
+    values[:, inside] = data[:, rows[inside], cols[inside]]
+    return dict(zip(names, values))
+
+
+def sample_stack(gdf, date_folders, pattern: str = "*.tif", max_workers: int = 8, layout=None):
+    """
+    Sample all rasters matching pattern in each of the date_folders at
+    the centroids of the geometries of gdf. The files are read in
+    parallel. Returns a DataFrame with the columns point (index into
+    gdf), date (name of the date folder) and one column per band.
+    Raises a ValueError if two files of a date folder give the same
+    column, instead of letting one overwrite the other.
+    """
+    files = [(pl.Path(folder).name, path)
+             for folder in date_folders
+             for path in sorted(pl.Path(folder).glob(pattern))]
+    if not files:
+        return pd.DataFrame(columns=["point", "date"])
+    with rio.open(files[0][1]) as dataset:
+        x, y = points_from_gdf(gdf, dataset.crs)
+
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        samples = list(executor.map(lambda file: sample_raster(file[1], x, y, layout), files))
+
+    columns = {}
+    for (date, _), sample in zip(files, samples):
+        bands = columns.setdefault(date, {})
+        duplicates = sorted(set(bands) & set(sample))
+        if duplicates:
+            raise ValueError(f"{date}: columns from more than one file: {', '.join(duplicates)}")
+        bands.update(sample)
+    tables = [
+        pd.DataFrame({"point": np.arange(len(x)), "date": date, **bands})
+        for date, bands in columns.items()
+    ]
+    return pd.concat(tables, ignore_index=True)
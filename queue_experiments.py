@@ -0,0 +1,85 @@
+### Download-Queue-Experimente
+
+import sentinelhub as sh
+import pathlib as pl
+import tempfile
+import functools
+import logging
+import sys
+
+import download_queue as dq
+import stub_api
+
+"""
+Durchsatz der Download-Queue gegen die lokale Stub-Process-API messen.
+Jeder Request bekommt vom Stub künstlich LATENCY Sekunden Verzögerung,
+jeder FAIL_EVERY-te Request wird mit 503 beantwortet, um den Backoff
+mitzutesten. 40 Felder mit je 10 Terminen.
+Aufruf: python queue_experiments.py
+"""
+FIELDS = 40
+DATES = 10
+LATENCY = 0.2
+FAIL_EVERY = 25
+
+evalscript = """
+function setup() {
+    return {
+        input: [{ bands: ["B02", "B03"], units: "DN" }],
+        output: [
+            { id: "B02", bands: 1, sampleType: "UINT16" },
+            { id: "B03", bands: 1, sampleType: "UINT16" }
+        ]
+    };
+}
+function evaluatePixel(sample) {
+    return { B02: [sample.B02], B03: [sample.B03] };
+}
+"""
+responses = [
+    sh.SentinelHubRequest.output_response("B02", sh.MimeType.TIFF),
+    sh.SentinelHubRequest.output_response("B03", sh.MimeType.TIFF),
+]
+bbox = sh.BBox((690000, 5360000, 690500, 5360500), crs=sh.CRS(32632))
+
+
+def download(config, collection, date_str, data_folder):
+    request = sh.SentinelHubRequest(
+        evalscript=evalscript,
+        input_data=[sh.SentinelHubRequest.input_data(
+            data_collection=collection,
+            time_interval=(date_str, date_str))],
+        responses=responses,
+        bbox=bbox,
+        size=(50, 50),
+        config=config,
+        data_folder=data_folder
+    )
+    request.save_data()
+
+
+def main():
+    logging.getLogger("SHD").addHandler(logging.StreamHandler(sys.stdout))
+    logging.getLogger("SHD").setLevel(logging.INFO)
+
+    with stub_api.StubServer(latency=LATENCY, fail_every=FAIL_EVERY) as server, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        config = stub_api.stub_config(server)
+        collection = stub_api.stub_collection(server)
+        for max_workers in (1, 4, 16):
+            jobs = []
+            for field in range(FIELDS):
+                for day in range(1, DATES + 1):
+                    date_str = f"2025-06-{day:02d}"
+                    folder = pl.Path(tmp_dir, str(max_workers), str(field), date_str)
+                    jobs.append(dq.DownloadJob(
+                        field_key=str(field),
+                        label=f"{field} {date_str}",
+                        run=functools.partial(download, config, collection, date_str, folder)))
+            stats = dq.run_download_queue(jobs, max_workers=max_workers, backoff_base=0.1)
+            print(f"max_workers={max_workers}: {stats.jobs_per_second:.1f} Requests/s, "
+                  f"{stats.retries} Retries, {stats.failed} Fehler")
+
+
+if __name__ == "__main__":
+    main()
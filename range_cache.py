@@ -0,0 +1,381 @@
+"""
+Persistent cache for byte ranges of remote COGs.
+
+Rerunning a field, or adding a neighbouring one, reads mostly the same
+COG headers and internal tiles again. RangeCache keeps them on disk, in
+blocks of BLOCK_SIZE bytes, in one SQLite file (WAL mode, so several
+processes can use it at the same time). Blocks are keyed by the asset
+url without its query string, as the SAS signature of the Planetary
+Computer changes with every token, and by the block number. The file is
+bounded to max_bytes; when it grows beyond, the least recently used
+blocks are deleted.
+
+Next to the blocks of a url the cache keeps its ETag and size. Before a
+url is read for the first time in a run, they are asked for with one
+HEAD request; if the file was replaced (other ETag or size), its cached
+blocks are dropped instead of being served stale.
+
+CachedRangeSource wraps an async range source (cog_reader.HttpRangeSource)
+for stac_engine.py; its SQLite calls run in worker threads, so they do
+not block the event loop the range requests run on. CachedHttpFile is a seekable file object over http,
+which rasterio/rioxarray can read through the cache with the opener
+argument (see RangeCache.opener), for alphascript.py.
+"""
+import asyncio
+import dataclasses
+import logging
+import pathlib as pl
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import httpx
+
+logger = logging.getLogger("SHD.range_cache")
+
+BLOCK_SIZE = 64 * 1024
+MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_PATH = pl.Path.home().joinpath(".cache", "digiman", "cog_ranges.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    url TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (url, block)
+);
+CREATE INDEX IF NOT EXISTS blocks_last_used ON blocks (last_used);
+CREATE TABLE IF NOT EXISTS validators (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    size INTEGER NOT NULL
+);
+"""
+
+
+def stable_url(url: str):
+    """
+    The url without query string and fragment, e.g. without the SAS token.
+    """
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+
+
+def block_range(start: int, end: int, block_size: int = BLOCK_SIZE):
+    return range(start // block_size, -(-end // block_size))
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    bytes_saved: int = 0
+    bytes_fetched: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class RangeCache:
+    """
+    Block cache in the SQLite file at path, at most max_bytes large.
+    Every thread gets its own connection. The writes and total_bytes,
+    which eviction goes by, are kept together under write_lock. stats
+    counts the blocks found and fetched by this process.
+    """
+
+    def __init__(self, path: pl.Path = DEFAULT_PATH, max_bytes: int = MAX_BYTES,
+                 block_size: int = BLOCK_SIZE):
+        self.path = pl.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.stats = CacheStats()
+        self.local = threading.local()
+        self.stats_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+        self.total_bytes = self.stored_bytes()
+
+    def connection(self):
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return self.local.connection
+
+    def stored_bytes(self):
+        (total,) = self.connection().execute("SELECT COALESCE(SUM(size), 0) FROM blocks").fetchone()
+        return total
+
+    def get_blocks(self, url: str, blocks):
+        """
+        Return {block: bytes} for the given blocks of url that are cached,
+        and mark them as used.
+        """
+        blocks = list(blocks)
+        if not blocks:
+            return {}
+        url = stable_url(url)
+        connection = self.connection()
+        placeholders = ",".join("?" * len(blocks))
+        rows = connection.execute(
+            f"SELECT block, data FROM blocks WHERE url = ? AND block IN ({placeholders})",
+            (url, *blocks)
+        ).fetchall()
+        if rows:
+            with self.write_lock, connection:
+                connection.executemany(
+                    "UPDATE blocks SET last_used = ? WHERE url = ? AND block = ?",
+                    [(time.time(), url, block) for block, _ in rows])
+        return dict(rows)
+
+    def put_blocks(self, url: str, blocks: dict):
+        """
+        Store {block: bytes} for url, then evict if the cache is too large.
+        """
+        url = stable_url(url)
+        now = time.time()
+        with self.write_lock:
+            with self.connection() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO blocks (url, block, data, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                    [(url, block, data, len(data), now) for block, data in blocks.items()])
+            """
+            total_bytes only counts what this process added since the last
+            look at the real size, the sum is only taken again when it says
+            the cache is full
+            """
+            self.total_bytes += sum(len(data) for data in blocks.values())
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def validate(self, url: str, etag: str, size: int):
+        """
+        Compare the current ETag and size of url with the ones its blocks
+        were cached with. If they differ, the file was replaced: its
+        blocks are deleted. Returns False in that case.
+        """
+        url = stable_url(url)
+        with self.write_lock:
+            with self.connection() as connection:
+                row = connection.execute("SELECT etag, size FROM validators WHERE url = ?", (url,)).fetchone()
+                if row == (etag, size):
+                    return True
+                connection.execute("INSERT OR REPLACE INTO validators (url, etag, size) VALUES (?, ?, ?)",
+                                   (url, etag, size))
+                if row is None:
+                    return True
+                connection.execute("DELETE FROM blocks WHERE url = ?", (url,))
+            self.total_bytes = self.stored_bytes()
+        logger.info(f"{url}: changed (ETag {row[0]} -> {etag}), cached blocks dropped")
+        return False
+
+    def evict(self):
+        """
+        Delete the least recently used blocks until the cache is back
+        under 90 % of max_bytes. Called with write_lock held.
+        """
+        connection = self.connection()
+        total = self.total_bytes = self.stored_bytes()
+        if total <= self.max_bytes:
+            return
+        target = total - int(0.9 * self.max_bytes)
+        freed = 0
+        evicted = []
+        for url, block, size in connection.execute(
+                "SELECT url, block, size FROM blocks ORDER BY last_used"):
+            evicted.append((url, block))
+            freed += size
+            if freed >= target:
+                break
+        with connection:
+            connection.executemany("DELETE FROM blocks WHERE url = ? AND block = ?", evicted)
+        self.total_bytes -= freed
+        logger.info(f"Evicted {len(evicted)} blocks ({freed / 1e6:.1f} MB)")
+
+    def count(self, hits: int, misses: int, bytes_saved: int, bytes_fetched: int):
+        with self.stats_lock:
+            self.stats.hits += hits
+            self.stats.misses += misses
+            self.stats.bytes_saved += bytes_saved
+            self.stats.bytes_fetched += bytes_fetched
+
+    def read(self, url: str, start: int, end: int, fetch):
+        """
+        Return the bytes start to end of url, taking cached blocks from
+        the cache and fetching the missing ones with fetch(start, end),
+        one call per run of consecutive missing blocks.
+        """
+        blocks = block_range(start, end, self.block_size)
+        found = self.get_blocks(url, blocks)
+        fetched = {}
+        for run_start, run_end in missing_runs(blocks, found):
+            data = fetch(run_start * self.block_size, run_end * self.block_size)
+            fetched.update(split_blocks(data, run_start, run_end, self.block_size))
+        return self.finish_read(url, start, end, found, fetched)
+
+    def finish_read(self, url: str, start: int, end: int, found: dict, fetched: dict):
+        if fetched:
+            self.put_blocks(url, fetched)
+        self.count(len(found), len(fetched),
+                   sum(len(data) for data in found.values()),
+                   sum(len(data) for data in fetched.values()))
+        blocks = {**found, **fetched}
+        first = start // self.block_size
+        data = b"".join(blocks[block] for block in sorted(blocks))
+        offset = start - first * self.block_size
+        return data[offset:offset + end - start]
+
+    def opener(self, url: str, mode: str = "rb"):
+        """
+        For rasterio.open / rioxarray.open_rasterio(url, opener=cache.opener).
+        """
+        return CachedHttpFile(url, self)
+
+    def report(self):
+        stats = self.stats
+        message = (f"Range cache: {stats.hit_rate:.0%} hit rate ({stats.hits} of "
+                   f"{stats.hits + stats.misses} blocks), {stats.bytes_saved / 1e6:.1f} MB saved, "
+                   f"{stats.bytes_fetched / 1e6:.1f} MB fetched")
+        return message
+
+
+def missing_runs(blocks, found: dict):
+    """
+    Consecutive runs (first, end) of the blocks that are not in found.
+    """
+    runs = []
+    for block in blocks:
+        if block in found:
+            continue
+        if runs and runs[-1][1] == block:
+            runs[-1][1] = block + 1
+        else:
+            runs.append([block, block + 1])
+    return runs
+
+
+def split_blocks(data: bytes, run_start: int, run_end: int, block_size: int):
+    """
+    Cut fetched data starting at block run_start into blocks. The data
+    may end early at the end of the file; blocks beyond it are left out.
+    """
+    return {
+        block: data[(block - run_start) * block_size:(block - run_start + 1) * block_size]
+        for block in range(run_start, run_end)
+        if (block - run_start) * block_size < len(data)
+    }
+
+
+class CachedRangeSource:
+    """
+    An async range source (like cog_reader.HttpRangeSource) reading
+    through a RangeCache.
+    """
+
+    def __init__(self, source, cache: RangeCache):
+        self.source = source
+        self.cache = cache
+        self.validated = False
+        self.validated_lock = asyncio.Lock()
+
+    @property
+    def requests(self):
+        return self.source.requests
+
+    @property
+    def bytes_read(self):
+        return self.source.bytes_read
+
+    async def validate(self):
+        """
+        Check once that the cached blocks are still those of the remote
+        file (see RangeCache.validate).
+        """
+        async with self.validated_lock:
+            if not self.validated:
+                etag, size = await self.source.head()
+                await asyncio.to_thread(self.cache.validate, self.source.href, etag, size)
+                self.validated = True
+
+    async def read(self, start: int, end: int):
+        cache = self.cache
+        url = self.source.href
+        await self.validate()
+        blocks = block_range(start, end, cache.block_size)
+        found = await asyncio.to_thread(cache.get_blocks, url, blocks)
+        fetched = {}
+        for run_start, run_end in missing_runs(blocks, found):
+            data = await self.source.read(run_start * cache.block_size, run_end * cache.block_size)
+            fetched.update(split_blocks(data, run_start, run_end, cache.block_size))
+        return await asyncio.to_thread(cache.finish_read, url, start, end, found, fetched)
+
+
+class CachedHttpFile:
+    """
+    Read-only, seekable file object over http that reads through a
+    RangeCache. Size and ETag are asked for once with a HEAD request when
+    the file is opened, and checked against the cached blocks.
+    """
+
+    def __init__(self, url: str, cache: RangeCache, client: httpx.Client = None):
+        self.url = url
+        self.cache = cache
+        self.client = client or httpx.Client(timeout=60.0, follow_redirects=True)
+        self.position = 0
+        response = self.client.head(url)
+        if response.status_code == 404:
+            raise FileNotFoundError(url)
+        response.raise_for_status()
+        self.size = int(response.headers["Content-Length"])
+        cache.validate(url, response.headers.get("ETag"), self.size)
+
+    def fetch(self, start: int, end: int):
+        end = min(end, self.size)
+        response = self.client.get(self.url, headers={"Range": f"bytes={start}-{end - 1}"})
+        response.raise_for_status()
+        if response.status_code == 200:
+            return response.content[start:end]
+        return response.content
+
+    def read(self, size: int = -1):
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        if end <= self.position:
+            return b""
+        data = self.cache.read(self.url, self.position, end, self.fetch)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
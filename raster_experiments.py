@@ -5,6 +5,8 @@ import pathlib as pl
 import rasterstats as rs
 import time
 import rasterio as rio
+import pixel_sampler as ps
+import zonal_stats as zs
 
 """
 Pfade auf Laptop
@@ -38,21 +40,38 @@ Mit rasterstats: 51s für Freising Süd
 # print(rasterstats_time)
 
 """
-Mit rasterio.sample: 3s für Freising Süd?
-Kontrolle: Ist der gleiche Wert wie in QGIS an der x,y-Position
+Mit pixel_sampler: Raster wird nur einmal gelesen, alle Zentroide
+werden auf einmal in Zeile/Spalte umgerechnet und alle Bänder
+für alle Punkte per Fancy Indexing ausgelesen.
+Kontrolle: Werte an einzelnen x,y-Positionen mit QGIS vergleichen
 """
 start = time.time()
-rio_raster = rio.open(tif_12canal_path)
-pixelpolygon_gdf["B01"] = None
-for i in range(len(pixelpolygon_gdf.geometry)):
-    pixelpolygon = pixelpolygon_gdf.geometry[i]
-    x, y = pixelpolygon.centroid.x, pixelpolygon.centroid.y
-    row, col = rio_raster.index(x, y)
-    for band in range(1):
-        value = rio_raster.read()[band, row, col]
-        print(f"x: {x}, y: {y}, value of band {i+1}: {value}")
-        pixelpolygon_gdf.B01[i] = value
-    
+with rio.open(tif_12canal_path) as raster:
+    raster_crs = raster.crs
+x, y = ps.points_from_gdf(pixelpolygon_gdf, raster_crs)
+samples = ps.sample_raster(tif_12canal_path, x, y)
+for band_name, values in samples.items():
+    pixelpolygon_gdf[band_name] = values
 print(time.time() - start)
 
-test2 = rio_raster.read(2)
+"""
+Alle Datumsordner eines Felds in einem Durchgang, Dateien werden
+parallel gelesen. Ergebnis: Tabelle mit einer Zeile pro Pixel und Datum
+"""
+start = time.time()
+date_folders = [path for path in tif_path.parent.parent.iterdir() if path.is_dir()]
+stack_table = ps.sample_stack(pixelpolygon_gdf, date_folders)
+print(time.time() - start)
+
+"""
+Mit zonal_stats: Pixelpolygone werden einmal in ein Label-Raster
+gerastert (wird pro Geometrie und Raster gecacht), danach sind
+count, mean, min, max und std für alle Bänder nur noch Reduktionen
+"""
+start = time.time()
+zonal_table = zs.zonal_stats_files(pixelpolygon_gdf, [tif_12canal_path])
+print(time.time() - start)
+
+start = time.time()
+zonal_stack_table = zs.zonal_stats_stack(pixelpolygon_gdf, date_folders)
+print(time.time() - start)
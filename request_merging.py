@@ -0,0 +1,155 @@
+"""
+Download neighbouring small fields with one shared request.
+
+Most shapefiles are single fields of a few hectares, and each of them
+pays a full Process API round trip (plus the 100m buffer around it) on
+its own. merge_fields groups field bboxes of the same crs (and the same
+dates to download) into merged bboxes, as long as the merged bbox stays
+within the size limit of a request and is mostly covered by its fields. write_field_crops then cuts
+every field's bbox back out of the merged response, so the outputs look
+exactly like those of a separate request per field.
+
+All bboxes are expected to be rounded to the resolution already, so the
+fields and the merged bbox share one pixel grid and the crops are whole
+pixel windows without any resampling.
+"""
+import dataclasses
+import logging
+import os
+import pathlib as pl
+
+import rasterio as rio
+import sentinelhub as sh
+import shapely
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
+
+import response_writer as rw
+
+logger = logging.getLogger("SHD.request_merging")
+
+
+@dataclasses.dataclass
+class MergedRequest:
+    """
+    A bbox covering the bboxes of several fields. members are the
+    indices of the fields in the list given to merge_fields.
+    """
+    bbox: sh.BBox
+    members: list
+
+    def add(self, index: int, bbox: sh.BBox):
+        self.bbox = union_bbox(self.bbox, bbox)
+        self.members.append(index)
+
+
+def union_bbox(first: sh.BBox, second: sh.BBox):
+    return sh.BBox(
+        (min(first.min_x, second.min_x), min(first.min_y, second.min_y),
+         max(first.max_x, second.max_x), max(first.max_y, second.max_y)),
+        crs=first.crs
+    )
+
+
+def bbox_area(bbox: sh.BBox):
+    return (bbox.max_x - bbox.min_x) * (bbox.max_y - bbox.min_y)
+
+
+def merge_fields(bboxes, resolution: float = 10, max_pixels: int = 2500, min_fill: float = 0.5,
+                 dates=None):
+    """
+    Group the field bboxes into MergedRequests. A field is added to the
+    merged bbox that grows the least by it, as long as the result is at
+    most max_pixels wide and high and at least min_fill of its area is
+    covered by the union of the field bboxes (otherwise the request would
+    mostly download pixels between the fields). dates holds the dates
+    every field still needs (any hashable, e.g. a frozenset of (date,
+    planned scene id)); only fields with the same dates are merged, so no
+    request downloads the merged bbox for a date only some of its fields
+    need, or from a scene some of them did not plan. Fields that fit
+    nowhere start a new group.
+    """
+    max_extent = max_pixels * resolution
+    groups = []
+    group_dates = []
+    covered = []
+    order = sorted(range(len(bboxes)), key=lambda index: (str(bboxes[index].crs), bboxes[index].min_x))
+    for index in order:
+        bbox = bboxes[index]
+        field_dates = dates[index] if dates is not None else None
+        best, best_growth = None, None
+        for group_index, group in enumerate(groups):
+            if group.bbox.crs != bbox.crs or group_dates[group_index] != field_dates:
+                continue
+            merged = union_bbox(group.bbox, bbox)
+            if merged.max_x - merged.min_x > max_extent or merged.max_y - merged.min_y > max_extent:
+                continue
+            if shapely.union(covered[group_index], bbox.geometry).area / bbox_area(merged) < min_fill:
+                continue
+            growth = bbox_area(merged) - bbox_area(group.bbox)
+            if best is None or growth < best_growth:
+                best, best_growth = group_index, growth
+        if best is None:
+            groups.append(MergedRequest(bbox, [index]))
+            group_dates.append(field_dates)
+            covered.append(bbox.geometry)
+        else:
+            groups[best].add(index, bbox)
+            covered[best] = shapely.union(covered[best], bbox.geometry)
+    logger.info(f"{len(bboxes)} fields in {len(groups)} requests")
+    return groups
+
+
+def crop_window(merged_bbox: sh.BBox, field_bbox: sh.BBox, resolution: float):
+    """
+    The pixel window of field_bbox within the output of merged_bbox.
+    """
+    return Window(
+        round((field_bbox.min_x - merged_bbox.min_x) / resolution),
+        round((merged_bbox.max_y - field_bbox.max_y) / resolution),
+        round((field_bbox.max_x - field_bbox.min_x) / resolution),
+        round((field_bbox.max_y - field_bbox.min_y) / resolution)
+    )
+
+
+def write_crop(dataset, window: Window, target_path: pl.Path):
+    """
+    Write the window of an open dataset as its own GeoTIFF, through a
+    temporary file that is renamed to target_path when complete.
+    """
+    profile = dataset.profile.copy()
+    profile.update(
+        driver="GTiff", width=int(window.width), height=int(window.height),
+        transform=dataset.window_transform(window)
+    )
+    for key in ("blockxsize", "blockysize", "tiled"):
+        profile.pop(key, None)
+    tmp_path = target_path.with_name("." + target_path.name + ".part")
+    try:
+        with rio.open(tmp_path, "w", **profile) as crop:
+            crop.write(dataset.read(window=window))
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return rw.describe_file(target_path)
+
+
+def write_field_crops(content: bytes, merged_bbox: sh.BBox, resolution: float, targets, single_name: str):
+    """
+    Cut the fields out of the response of a merged request. targets is a
+    list of (field bbox, target folder, file name prefix); every band of
+    the response is written as <target folder>/<prefix><band>.tif, a
+    single tif response as <prefix><single_name>.
+    Returns a dict of {target folder: [WrittenFile]}.
+    """
+    members = rw.read_response_members(content, single_name)
+    written = {pl.Path(folder): [] for _, folder, _ in targets}
+    for name, data in members:
+        with MemoryFile(data) as memfile, memfile.open() as dataset:
+            for field_bbox, folder, prefix in targets:
+                folder = pl.Path(folder)
+                folder.mkdir(parents=True, exist_ok=True)
+                window = crop_window(merged_bbox, field_bbox, resolution)
+                written[folder].append(write_crop(dataset, window, folder.joinpath(prefix + name)))
+    return written
@@ -0,0 +1,144 @@
+"""
+Write SentinelHub responses straight to their final file names.
+
+request.save_data() first writes response.tar into a folder named after
+the request hash, which the scripts then move, extract, delete and rename.
+On a network share that means every byte crosses the wire at least twice.
+The functions here take the response from memory instead and write every
+tar member exactly once: into a temporary file next to its destination,
+which is then renamed to <prefix><member name> (e.g. scene_id_B01.tif).
+The rename is atomic, so a crash never leaves a half written tif behind
+under its final name.
+"""
+import dataclasses
+import hashlib
+import io
+import os
+import pathlib as pl
+import tarfile
+
+"""
+Read and write in chunks of this many bytes, so a member is never
+held in memory twice.
+"""
+CHUNK_SIZE = 1024 * 1024
+
+"""
+File extensions of the response formats, as the Process API names the
+members of its tar.
+"""
+EXTENSIONS = {"image/tiff": "tif", "application/json": "json", "image/png": "png", "image/jpeg": "jpg"}
+
+
+@dataclasses.dataclass
+class WrittenFile:
+    """
+    Path, size and sha256 checksum of a file written by this module.
+    """
+    path: pl.Path
+    size: int
+    sha256: str
+
+
+def describe_file(path: pl.Path):
+    """
+    Return a WrittenFile for a file that was written by other means
+    (e.g. by rasterio), reading it once for the checksum.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return WrittenFile(pl.Path(path), os.path.getsize(path), sha256.hexdigest())
+
+
+def write_atomic(source, target_path: pl.Path):
+    """
+    Copy the file object source to target_path. The data goes into a
+    hidden temporary file in the same folder first, which is renamed to
+    target_path once it is complete. Returns a WrittenFile.
+    """
+    target_path = pl.Path(target_path)
+    tmp_path = target_path.with_name("." + target_path.name + ".part")
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as tmp_file:
+            while chunk := source.read(CHUNK_SIZE):
+                tmp_file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return WrittenFile(target_path, size, sha256.hexdigest())
+
+
+def write_tar_members(fileobj, target_folder: pl.Path, prefix: str = ""):
+    """
+    Read a tar from the file object fileobj as a stream (mode "r|", so
+    fileobj does not have to be seekable, e.g. a raw HTTP response) and
+    write each member to target_folder/<prefix><member name>.
+    Only regular files are written, their paths are flattened to the
+    file name. Returns a list of WrittenFile.
+    """
+    target_folder = pl.Path(target_folder)
+    target_folder.mkdir(parents=True, exist_ok=True)
+    written = []
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = prefix + pl.PurePosixPath(member.name).name
+            written.append(write_atomic(tar.extractfile(member), target_folder.joinpath(name)))
+    return written
+
+
+def response_name(request):
+    """
+    The name the response of a request with a single output would have
+    in a tar, e.g. B04.tif. Sentinel Hub returns that file bare, without
+    its name.
+    """
+    response = request.payload["output"]["responses"][0]
+    return f"{response['identifier']}.{EXTENSIONS.get(response['format']['type'], 'tif')}"
+
+
+def write_response(content: bytes, target_folder: pl.Path, single_name: str, prefix: str = ""):
+    """
+    Write a Process API response held in memory. Requests with several
+    responses return a tar, which is written member by member. A request
+    with a single response returns the file itself, it is written as
+    <prefix><single_name> (see response_name). Returns a list of
+    WrittenFile.
+    """
+    if tarfile.is_tarfile(io.BytesIO(content)):
+        return write_tar_members(io.BytesIO(content), target_folder, prefix)
+    target_folder = pl.Path(target_folder)
+    target_folder.mkdir(parents=True, exist_ok=True)
+    return [write_atomic(io.BytesIO(content), target_folder.joinpath(prefix + single_name))]
+
+
+def read_response_members(content: bytes, single_name: str):
+    """
+    Return the files of a response held in memory as a list of
+    (name, bytes), for code that processes the tifs itself instead of
+    writing them out. A single tif response is named single_name.
+    """
+    if not tarfile.is_tarfile(io.BytesIO(content)):
+        return [(single_name, content)]
+    with tarfile.open(fileobj=io.BytesIO(content), mode="r|") as tar:
+        return [(pl.PurePosixPath(member.name).name, tar.extractfile(member).read())
+                for member in tar if member.isfile()]
+
+
+def download_response(request):
+    """
+    Run a SentinelHubRequest without saving anything and return the raw,
+    undecoded response bytes of its (single) download.
+    """
+    response = request.get_data(decode_data=False)[0]
+    return getattr(response, "content", response)
@@ -0,0 +1,144 @@
+"""
+Pick one scene per field and date before anything is downloaded.
+
+A field in the overlap of two Sentinel-2 tiles (or of two orbits) gets
+two catalog hits for the same day. The scripts used to take whichever
+scene came first and skip the other date folder. Which one that was
+depended on the order of the search results, and a scene that only
+touches the field at its edge could win over one that covers it fully.
+
+plan_field groups the catalog hits of a field by acquisition date and
+keeps the scene that covers most of the field polygon; equal coverage
+is decided by the lower eo:cloud_cover of the tile, then by the scene
+id, so the choice is the same in every run. The result is a list of
+PlannedDownload, one per date that is not done yet, which is all the
+downloader works from. Scenes that lose are only logged, no request is
+made for them.
+
+A request for a date would still mosaic every tile of that day over the
+bbox. tile_path gives the MGRS tile of the chosen scene as it appears in
+the dataPath of the tiles in an evalscript, for
+OutputLayout.evalscript(tile_path), which restricts the request to it.
+"""
+import dataclasses
+import logging
+import pathlib as pl
+import re
+
+import sentinelhub as sh
+import shapely
+
+import field_clusters as fc
+
+logger = logging.getLogger("SHD.scene_planner")
+
+"""
+Coverages closer than this are treated as equal, so a field lying
+inside both footprints is not decided by rounding errors of the
+intersection.
+"""
+COVERAGE_TOLERANCE = 0.001
+
+"""
+The MGRS tile in a Sentinel-2 product id, e.g. ..._R065_T32UNU_...
+"""
+TILE_ID_PATTERN = re.compile(r"_T(\d{2})([A-Z])([A-Z]{2})_")
+
+
+@dataclasses.dataclass
+class PlannedDownload:
+    """
+    One (field, date) to download from scene_id into folder. coverage is
+    the share of the field polygon inside the scene footprint,
+    cloud_cover the tile cloud cover from the catalog (None if unknown).
+    """
+    field_key: str
+    date_str: str
+    scene_id: str
+    bbox: sh.BBox
+    size: tuple
+    folder: pl.Path
+    coverage: float = 1.0
+    cloud_cover: float = None
+
+
+def field_coverage(geometry, footprint):
+    """
+    Share of the area of geometry that lies inside footprint (both
+    shapely, same crs). A geometry without area counts as covered if
+    it intersects the footprint.
+    """
+    area = geometry.area
+    if area == 0:
+        return float(shapely.intersects(geometry, footprint))
+    return shapely.intersection(geometry, footprint).area / area
+
+
+def scene_rank(scene: dict, coverage: float):
+    """
+    Sort key of a candidate scene, the best scene of a date sorts first.
+    """
+    cloud_cover = scene.get("properties", {}).get("eo:cloud_cover")
+    return (-round(coverage / COVERAGE_TOLERANCE),
+            float("inf") if cloud_cover is None else cloud_cover,
+            scene["id"])
+
+
+def plan_field(field_key: str, geometry, bbox: sh.BBox, size, folder: pl.Path, scenes, done=()):
+    """
+    The PlannedDownload of every date of scenes (catalog features with
+    id, properties.datetime, properties.eo:cloud_cover and geometry) for
+    one field, sorted by date. geometry is the field polygon in the crs
+    of bbox. Dates in done ((field_key, date) pairs, e.g. the manifest)
+    are left out.
+    """
+    by_date = {}
+    for scene in scenes:
+        by_date.setdefault(scene["properties"]["datetime"][:10], []).append(scene)
+
+    plan = []
+    for date_str, candidates in sorted(by_date.items()):
+        if (field_key, date_str) in done:
+            logger.info(f"{field_key} {date_str}: Already downloaded")
+            continue
+        ranked = sorted(
+            ((scene, field_coverage(geometry, fc.scene_footprint(scene, bbox.crs))) for scene in candidates),
+            key=lambda pair: scene_rank(*pair)
+        )
+        scene, coverage = ranked[0]
+        for other, other_coverage in ranked[1:]:
+            logger.info(f"{field_key} {date_str}: {other['id']} ({other_coverage:.0%} coverage) "
+                        f"discarded for {scene['id']} ({coverage:.0%})")
+        plan.append(PlannedDownload(
+            field_key=field_key,
+            date_str=date_str,
+            scene_id=scene["id"],
+            bbox=bbox,
+            size=size,
+            folder=pl.Path(folder).joinpath(date_str),
+            coverage=coverage,
+            cloud_cover=scene["properties"].get("eo:cloud_cover")
+        ))
+    return plan
+
+
+def tile_path(scene_id: str):
+    """
+    The part of the dataPath of the tiles of scene_id
+    (s3://sentinel-s2-l2a/tiles/32/U/NU/2024/5/1/0), or None if the id
+    names no MGRS tile.
+    """
+    match = TILE_ID_PATTERN.search(scene_id or "")
+    if match is None:
+        return None
+    return f"/tiles/{int(match[1])}/{match[2]}/{match[3]}/"
+
+
+def summary(plans):
+    """
+    One log line for the plans of all fields ([PlannedDownload]).
+    """
+    downloads = [download for plan in plans for download in plan]
+    partial = sum(download.coverage < 1 - COVERAGE_TOLERANCE for download in downloads)
+    return (f"Download plan: {len(downloads)} field dates for {len(plans)} fields, "
+            f"{partial} only partly covered by their scene")
@@ -1,21 +1,11 @@
-import geopandas as gpd
-import sentinelhub as sh
+import argparse
 import pathlib as pl
 import shutil
 import tarfile
-import numpy as np
 import datetime as dt
 import logging
 import sys
-
-### Helper functions
-"""
-A callable for the bbox edge rounding.
-"""
-def round_coordinates(x: float, y: float):
-    x = np.round(x, -1)
-    y = np.round(y, -1)
-    return x, y
+import functools
 
 ### Variables
 """
@@ -25,14 +15,84 @@ You should paste the filepaths after the r, which denotes
 a raw string (helps with the backslashes). Resolution
 should be 10 (m/px), which is the highest available.
 Shapefiles with a corresponding bbox of more than 25000m
-in width or height (25000m / (10m/px)= 2500px) will not
-work and must be split up for sentinelhub.
+in width or height (25000m / (10m/px)= 2500px) are too large
+for a single sentinelhub request. They are split up into tiles
+automatically, MAX_CONCURRENT_TILES of which are downloaded
+at the same time.
+MAX_CONCURRENT_REQUESTS is the number of requests that are sent
+to sentinelhub at the same time. With STREAM_RESPONSES the response
+tifs are written once from memory under their final names, instead of
+saving, moving, extracting and renaming the response.tar on disk.
+With MERGE_REQUESTS neighbouring small shapefiles are downloaded
+together in one request and cut apart locally.
+Finished downloads are recorded in MANIFEST_NAME in the output
+folder, a date is only skipped if it is recorded there. The prepared
+geometries, bboxes and sizes of the shapefiles are kept in
+FIELD_STORE_NAME, so unchanged shapefiles are not read again.
+With WRITE_CUBE every downloaded date is also appended to a Zarr cube
+(time x band x y x x) named CUBE_NAME in the folder of the shapefile,
+see field_cube.py. Without KEEP_TIFS the tifs are deleted once they
+are in the cube.
+With CLOUD_PRECHECK every date is first checked with a small 60m
+request of the cloud masks only, dates where less than
+PRECHECK_MIN_VALID of the field is clear are not downloaded, see
+cloud_precheck.py. The results are kept in PRECHECK_NAME, what the
+pre-check cost and saved is part of the run summary. It costs an extra
+request per date, so it is off unless asked for (--precheck).
+With STATISTICS_MODE nothing is downloaded: the Statistical API
+computes count, mean, min, max and std of BAND_NAMES for every field
+(or, with STATISTICS_PER_ZONE, every feature of its shapefile) and day,
+which are written to STATISTICS_NAME, see statistical_api.py.
+With BATCH_MODE the dates are not downloaded field by field, but with
+one Batch Processing job over all fields and dates of the season. The
+job delivers its tiles to BATCH_OUTPUT_URL (an S3 bucket, written
+with BATCH_IAM_ROLE_ARN or the AWS_* keys of the environment), from
+which every field is cut into its date folder, see batch_jobs.py.
+With CLOUD_MASKS OmniCloudMask is run on the CPU over all dates
+downloaded in this run, with the fields of a scene packed into a few
+model runs, and the masks are written next to the bands as
+scene_id_ocm.tif, see cloud_masks.py. The masks are computed from
+the tifs, so together with WRITE_CUBE they need KEEP_TIFS.
+With MULTI_TEMPORAL all dates of a shapefile are downloaded with one
+request (ORBIT mosaicking) and split into the date folders locally.
+Fields with many dates get as many requests as needed to stay under
+MAX_RESPONSE_MB and MAX_REQUEST_UNITS each, see multi_temporal.py.
+Takes precedence over MERGE_REQUESTS.
+BAND_NAMES are the bands to download, any of the bands in
+band_registry.py. Every band is written to its own file, with
+STACK_BANDS the selected bands are stacked into one file per group
+(bands, quality, angles) instead.
 """
 INPUT_FOLDER = r"M:\IT-Projekte\digiman local\digiman_data\test_input"
 OUTPUT_FOLDER = r"M:\IT-Projekte\digiman local\digiman_data\test_output"
 START_DATE = '2025-06-23'
 END_DATE = '2025-06-23'
 RESOLUTION = 10  # Meter pro Pixel
+MAX_CONCURRENT_REQUESTS = 4
+MAX_CONCURRENT_TILES = 4
+STREAM_RESPONSES = True
+MERGE_REQUESTS = True
+CATALOG_CACHE_NAME = "catalog_cache.sqlite"
+MANIFEST_NAME = "download_manifest.jsonl"
+FIELD_STORE_NAME = "fields.parquet"
+WRITE_CUBE = False
+KEEP_TIFS = True
+CUBE_NAME = "cube.zarr"
+CLOUD_PRECHECK = False
+PRECHECK_MIN_VALID = 0.5
+PRECHECK_NAME = "cloud_precheck.jsonl"
+STATISTICS_MODE = False
+STATISTICS_PER_ZONE = False
+STATISTICS_NAME = "statistics.parquet"
+BATCH_MODE = False
+BATCH_OUTPUT_URL = "s3://digiman-batch/jobs"
+BATCH_IAM_ROLE_ARN = ""
+CLOUD_MASKS = False
+MULTI_TEMPORAL = False
+MAX_RESPONSE_MB = 256
+MAX_REQUEST_UNITS = 200
+CATALOG_RECENT_DAYS = 30
+CLUSTER_DISTANCE = 5000  # Meter
 BAND_NAMES = [
     "B01",
     "B02",
@@ -47,306 +107,623 @@ BAND_NAMES = [
     "B11",
     "B12"
 ]
+STACK_BANDS = False
 
+### Command line
 """
-Create Path-Objects.
-Find all shapefiles in the level below the
-starting directory and create a list of them
+The settings above are the defaults, the most common ones can be
+changed on the command line, e.g.
+    python sentinelhub_download_script.py --input D:\\shapes --output D:\\out
+        --start 2025-04-01 --end 2025-09-30 --multi-temporal
+Only argparse and the standard library are imported before the
+arguments are parsed; sentinelhub, geopandas, rasterio etc. are
+imported by run(), so --help and importing this module (e.g. by a
+worker process) do not pay for them.
 """
-inputfolder_path = pl.Path(INPUT_FOLDER)
-outputfolder_path = pl.Path(OUTPUT_FOLDER)
-shapefile_list = inputfolder_path.glob("*/*.shp")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download Sentinel-2 L2A data for all shapefiles "
+                                                 "in the level below the input folder from Sentinel Hub.")
+    parser.add_argument("--input", default=INPUT_FOLDER, help="folder with one subfolder per betrieb")
+    parser.add_argument("--output", default=OUTPUT_FOLDER, help="output base folder")
+    parser.add_argument("--start", default=START_DATE, help="first date, YYYY-MM-DD")
+    parser.add_argument("--end", default=END_DATE, help="last date, YYYY-MM-DD")
+    parser.add_argument("--resolution", type=float, default=RESOLUTION, help="meters per pixel")
+    parser.add_argument("--bands", nargs="+", default=BAND_NAMES, help="bands from band_registry.py")
+    parser.add_argument("--stack-bands", action="store_true", default=STACK_BANDS,
+                        help="one file per band group instead of one per band")
+    parser.add_argument("--max-requests", type=int, default=MAX_CONCURRENT_REQUESTS,
+                        help="requests sent at the same time")
+    parser.add_argument("--precheck", action="store_true", default=CLOUD_PRECHECK,
+                        help="skip dates where the field is mostly clouded, see cloud_precheck.py")
+    parser.add_argument("--write-cube", action="store_true", default=WRITE_CUBE,
+                        help="also append every date to a Zarr cube per shapefile")
+    parser.add_argument("--cloud-masks", action="store_true", default=CLOUD_MASKS,
+                        help="run OmniCloudMask over the new downloads")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--multi-temporal", action="store_true", default=MULTI_TEMPORAL,
+                      help="all dates of a field in one request")
+    mode.add_argument("--statistics", action="store_true", default=STATISTICS_MODE,
+                      help="only band statistics from the Statistical API")
+    mode.add_argument("--batch", action="store_true", default=BATCH_MODE,
+                      help="one Batch Processing job for the whole season")
+    args = parser.parse_args(argv)
+    if args.cloud_masks and args.write_cube and not KEEP_TIFS:
+        parser.error("--cloud-masks reads the tifs, which --write-cube deletes without KEEP_TIFS")
+    return args
 
-"""
-Setup log file name as timestamp without ":" and "." and create a Path
-from that. Create logger object. Create formatte object. Create a Filehandler
-for the logfile and a consolehandler to output to console as well.
-"""
+def main(argv=None):
+    args = parse_args(argv)
 
-logfile_datetime = dt.datetime.now().replace(microsecond=0)
-logfile_name = logfile_datetime.isoformat().replace(":", "-") + ".log"
-logfile_path = outputfolder_path.joinpath(logfile_name) 
+    """
+    Setup log file name as timestamp without ":" and "." and create a Path
+    from that. Create logger object. Create formatte object. Create a Filehandler
+    for the logfile and a consolehandler to output to console as well.
+    """
 
-logger = logging.getLogger("SHD")
+    logfile_datetime = dt.datetime.now().replace(microsecond=0)
+    logfile_name = logfile_datetime.isoformat().replace(":", "-") + ".log"
+    logfile_path = pl.Path(args.output).joinpath(logfile_name)
 
-formatter = logging.Formatter()
+    logger = logging.getLogger("SHD")
 
-filehandler = logging.FileHandler(logfile_path)
-filehandler.setLevel(logging.INFO)
-filehandler.setFormatter(formatter)
+    formatter = logging.Formatter()
 
-consolehandler = logging.StreamHandler(sys.stdout)
-consolehandler.setLevel(logging.DEBUG)
-consolehandler.setFormatter(formatter)
+    filehandler = logging.FileHandler(logfile_path)
+    filehandler.setLevel(logging.INFO)
+    filehandler.setFormatter(formatter)
 
-logger.addHandler(filehandler)
-logger.addHandler(consolehandler)
+    consolehandler = logging.StreamHandler(sys.stdout)
+    consolehandler.setLevel(logging.DEBUG)
+    consolehandler.setFormatter(formatter)
 
-logger.setLevel(logging.DEBUG)
+    logger.addHandler(filehandler)
+    logger.addHandler(consolehandler)
 
+    logger.setLevel(logging.DEBUG)
 
-### SentinelHub-Setup
-"""
-Takes authentification details for sentinhelhub
-from the environmental
-variables SH_CLIENT_ID and SH_CLIENT_SECRET
-"""
-config = sh.SHConfig()
 
-"""
-Evalscript for sentinelhub request, specifying input
-and output and function to be applied. Is given an 
-array of strings specifying the bands we want (not arbitrary).
-Output an array of javascript objects (denoted by {}),
-specifying AT LEAST the number of bands.
-evaluatePixel takes as a parameter a single pixel from our scene
-(handled by the POST-Request) and MUST return an array of values,
-not objects.
-"""
-evalscript = """
-function setup() {
-    return {
-        input: [{
-            bands: [
-                "B01",
-                "B02",
-                "B03",
-                "B04",
-                "B05",
-                "B06",
-                "B07",
-                "B08",
-                "B8A",
-                "B09",
-                "B11",
-                "B12"
-            ],
-            units: "DN"
-        }],
-        output: [
-            { id: "B01", bands: 1, sampleType: "UINT16" },
-            { id: "B02", bands: 1, sampleType: "UINT16" },
-            { id: "B03", bands: 1, sampleType: "UINT16" },
-            { id: "B04", bands: 1, sampleType: "UINT16" },
-            { id: "B05", bands: 1, sampleType: "UINT16" },
-            { id: "B06", bands: 1, sampleType: "UINT16" },
-            { id: "B07", bands: 1, sampleType: "UINT16" },
-            { id: "B08", bands: 1, sampleType: "UINT16" },
-            { id: "B8A", bands: 1, sampleType: "UINT16" },
-            { id: "B09", bands: 1, sampleType: "UINT16" },
-            { id: "B11", bands: 1, sampleType: "UINT16" },
-            { id: "B12", bands: 1, sampleType: "UINT16" }
-            ]
-    };
-}
-function evaluatePixel(sample) {
-    return {
-        B01: [sample.B01],
-        B02: [sample.B02],
-        B03: [sample.B03],
-        B04: [sample.B04],
-        B05: [sample.B05],
-        B06: [sample.B06],
-        B07: [sample.B07],
-        B08: [sample.B08],
-        B8A: [sample.B8A],
-        B09: [sample.B09],
-        B11: [sample.B11],
-        B12: [sample.B12]
-        }
-}
-"""
+    """
+    Close the logging handlers in any case, to be able to delete the
+    logfile etc.
+    """
+    try:
+        run(args)
+    finally:
+        filehandler.close()
+        consolehandler.close()
+        logger.handlers.clear()
 
-"""
-responses is an array of strings to be used in the
-POST-Request, specifying the name and filetype of the
-responses. the name must match an id from the output
-section of the evalscript. The output_response function
-generates such a string for us. We don't have to use all
-outputs from the evalscript. Thus the evalscript can provide
-all bands, but we could create a separate response for each one.
-"""
-responses = [
-    sh.SentinelHubRequest.output_response("B01", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B02", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B03", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B04", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B05", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B06", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B07", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B08", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B8A", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B09", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B11", sh.MimeType.TIFF),
-    sh.SentinelHubRequest.output_response("B12", sh.MimeType.TIFF)
-    ]
-
-### Iterate over found shapefiles
-for shapefile_path in shapefile_list:
-    
-    ### Get coordinates etc.
+def run(args: argparse.Namespace):
     """
-    Read shapefile via geopandas and turn it into geodataframe.
-    The gdf contains all the information from the shapefile, including
-    field id etc. Extracts the geometry (coordinate vertices) from the 
-    gdf. union_all() can create a bounding box (coordinates for rectangle
-    containing shape) for multipolygons (in case of multiple areas
-    within a shape). We must turn it into a sh.BBox for the POST-Request.
-    Round coordinates to tenths to get pixel size of exactly 10m x 10m.
-    bbox_to_dimensions generates an appropriate pixel width and height for
-    our output according to our specified resolution (seemingly higher
-    resolution than 10m/px from copernicus browser is due to interpolation).
-    We cannot find out whether the coordinate system is LongLat or UTM,
-    so we assume that the gdf has a coordinate system set.
-    """
-    gdf = gpd.read_file(shapefile_path)
-    if (gdf.crs.to_epsg() == 4326):
-        crs_code = gdf.estimate_utm_crs().to_epsg()
-        gdf = gdf.to_crs(crs=crs_code)
-    else:
-        crs_code = gdf.crs.to_epsg()
-    geometry = gdf.geometry.union_all()
-    shgeometry = sh.Geometry(geometry, sh.CRS(crs_code))
-    bbox_unrounded = sh.BBox(bbox=geometry.bounds, crs=sh.CRS(crs_code))
-    bbox_buffered = bbox_unrounded.buffer((100.0, 100.0), relative=False)
-    bbox = bbox_buffered.apply(round_coordinates)
-    size = sh.bbox_to_dimensions(bbox, RESOLUTION)
-    
-    logger.info(f"{shapefile_path.name}: {repr(bbox)}")
-    
-    ### Create directories and get names
-    """
-    Get the relative path of the shapefile starting from the
-    input folder, including the file name with extension.
-    Make an output folder path out of the output base folder,
-    the parent folder of the shapefile and the shapefile name.
-    Create the necessary directories.
-    
-    If shapefiles are already in subdirectories named after them, 
-    this will create another subdirectory of the same name,
-    e.g. "lager/lager/2025-04-31/.."
-    """
-    shapefile_relpath= shapefile_path.relative_to(inputfolder_path)
-    shapefile_folder_path = outputfolder_path.joinpath(
-        shapefile_relpath.parent, shapefile_relpath.stem)
-    shapefile_folder_path.mkdir(parents = True, exist_ok = True)
-    """
-    Get the name of the greatest parent folder containing the shapefile,
-    which is hopefully named after the betrieb. This is later used for
-    renaming the output
-    """
-    shapefile_betrieb_name = shapefile_relpath.parts[0]
-    
-    ### Find matching scenes
-    """ 
-    Create iterator containing scenes in the
-    l2a collection from the 
-    sentinelhub stac matching the desired timeframe
-    and location, excluding unnecessary information.
-    Filter scenes with cloud cover greater than 80% (wip number).
-    We don't use "distinct='date'", as the generator only returns
-    date strings in this case, not scenes
+    The whole download with the settings of args (see parse_args), the
+    module constants above are only their defaults.
+    """
+    import sentinelhub as sh
+
+    import download_queue as dq
+    import response_writer as rw
+    import catalog_cache as cc
+    import field_clusters as fc
+    import bbox_tiling as bt
+    import request_merging as rm
+    import download_manifest as dm
+    import field_cube as fcube
+    import band_registry as br
+    import cloud_precheck as cp
+    import statistical_api as sa
+    import batch_jobs as bj
+    import cloud_masks as cm
+    import scene_planner as sp
+    import field_store as fs
+    import multi_temporal as mt
+
+    OUTPUT_LAYOUT = br.stacked_layout(args.bands) if args.stack_bands else br.single_band_layout(args.bands)
+
+    """
+    Create Path-Objects.
+    Find all shapefiles in the level below the
+    starting directory and create a list of them
+    """
+    inputfolder_path = pl.Path(args.input)
+    outputfolder_path = pl.Path(args.output)
+    shapefile_list = inputfolder_path.glob("*/*.shp")
+
+    logger = logging.getLogger("SHD")
+
+    ### SentinelHub-Setup
+    """
+    Takes authentification details for sentinhelhub
+    from the environmental
+    variables SH_CLIENT_ID and SH_CLIENT_SECRET
+    """
+    config = sh.SHConfig()
+
+    """
+    One catalog client for all searches. The results are cached in a
+    SQLite file in the output folder, so a rerun or a longer time window
+    only searches the dates that are not known yet. Results for dates in
+    the last CATALOG_RECENT_DAYS days are searched again after a while,
+    as sentinelhub may still add or reprocess scenes for them.
     """
     catalog = sh.SentinelHubCatalog(config=config)
-    matching_scenes = catalog.search(
-        sh.DataCollection.SENTINEL2_L2A,
-        bbox=bbox,
-        time=(START_DATE, END_DATE),
-        fields={"include": ["id", "properties.datetime"], "exclude": []},
-        filter="eo:cloud_cover < 80"
+    catalog_cache = cc.CatalogCache(
+        outputfolder_path.joinpath(CATALOG_CACHE_NAME),
+        recent_days=CATALOG_RECENT_DAYS
     )
-    
+
+    """
+    The download manifest records every (shapefile, date) whose tifs have
+    all been written, with scene id, bands, sizes and checksums. It decides
+    what is skipped, instead of checking whether the date folder exists:
+    a folder left behind by a crashed download is downloaded again, and
+    so is a date recorded with other bands or another OUTPUT_LAYOUT.
+    """
+    manifest = dm.DownloadManifest(outputfolder_path.joinpath(MANIFEST_NAME), OUTPUT_LAYOUT)
+
+    """
+    The evalscript for the sentinelhub request and the matching responses
+    are generated from OUTPUT_LAYOUT (see output_layouts.py), which says
+    which bands go into which file with which sample type. The default is
+    one file per band of BAND_NAMES, e.g. scene_id_B01.tif, with the sample
+    type the band registry gives it (UINT16 for the reflectances, UINT8 for
+    SCL, CLM etc.). With STACK_BANDS (--stack-bands) the bands are written
+    as one stack per group of the band registry instead: the reflectances
+    as UINT16 (scene_id_bands.tif) and, if selected, SCL, CLM, CLP or
+    dataMask as UINT8 (scene_id_quality.tif).
+    The evalscript is given an array of strings specifying the bands we
+    want, outputs one javascript object per file and evaluatePixel returns
+    an array of values per file. The name of every response must match an
+    id from the output section of the evalscript.
+    """
+    evalscript = OUTPUT_LAYOUT.evalscript()
+    responses = OUTPUT_LAYOUT.responses()
+
+    ### Download function
+    ### Create SentinelHub request
     """
-    Control output
+    The Request is fed the evalscript and the input_data string.
+    We provide the previously extracted date as the start and finish
+    of our time_intervall, so data from the whole day is considered.
+    With the scene_id the scene planner chose, the evalscript only uses
+    the tiles of that scene's MGRS tile (see scene_planner.tile_path), so
+    a field in the overlap of two tiles gets the planned one. Without it,
+    leastRecent is the mosaicking_order, incase the bbox overlaps multiple
+    tiles with data from different times.
     """
-    logger.info(f"{shapefile_path.name}: Matches für {START_DATE} bis {END_DATE}: {len(list(matching_scenes))}")
-    for scene in matching_scenes:
-        logger.info(f"{scene['id']}")
-    
-    ### Iterate over scenes
-    for scene in matching_scenes:
+    def create_request(date_str: str, bbox: sh.BBox, size: tuple,
+                       data_folder: pl.Path = None, scene_id: str = None):
+        tile_path = sp.tile_path(scene_id)
+        return sh.SentinelHubRequest(
+            evalscript=evalscript if tile_path is None else OUTPUT_LAYOUT.evalscript(tile_path),
+            input_data=[
+                sh.SentinelHubRequest.input_data(
+                    data_collection=sh.DataCollection.SENTINEL2_L2A,
+                    time_interval=(date_str, date_str),
+                    mosaicking_order="leastRecent"
+                )
+            ],
+            responses=responses,
+            bbox=bbox,
+            size=size,
+            config=config,
+            data_folder=data_folder
+        )
+
+    def download_scene(datefolder_path: pl.Path, scene_id: str, date_str: str,
+                       bbox: sh.BBox, size: tuple):
         """
-        Trim the last 10 characters from the
-        datetime string, which contain the time.
-        id could be used later.
+        Download all bands of one scene date for one shapefile into its
+        date folder. Runs inside the download queue, so several of these
+        are executed at the same time for different shapefiles.
+        Returns {datefolder_path: [WrittenFile]} for the manifest.
         """
-        date_str = scene["properties"]["datetime"][:10]
-        scene_id = scene["id"]
-        
         """
-        Create the datefolder path now to check if it already exists. We want
-        to also avoid downloading more than one scene per date, which is possible
-        in the case of regions in two or more overlapping tiles.
+        Create folder for that date as subdirectory for the betrieb
         """
-        datefolder_path = pl.Path(shapefile_folder_path).joinpath(date_str)
-        
-        if not datefolder_path.exists():
-            """
-            Create folder for that date as subdirectory for the betrieb
-            """
-            datefolder_path.mkdir(parents = True, exist_ok = True)
-            
-            ### Create SentinelHub request
+        datefolder_path.mkdir(parents = True, exist_ok = True)
+
+        if bt.needs_split(size):
             """
-            The Request is fed the evalscript and the input_data string.
-            We provide the previously extracted date as the start and finish
-            of our time_intervall, so data from the whole day is considered.
-            We choose leastRecent as our mosaicking_order, incase the bbox
-            overlaps multiple tiles with data from different times. We only
-            want data from one tile if possible.
+            More than 2500px in width or height is too large for a single
+            request. Download the bbox in tiles of the same 10m grid and
+            put them together into one tif per band.
             """
-            request = sh.SentinelHubRequest(
-                evalscript=evalscript,
-                input_data=[
-                    sh.SentinelHubRequest.input_data(
-                        data_collection=sh.DataCollection.SENTINEL2_L2A,
-                        time_interval=(date_str, date_str),
-                        mosaicking_order="leastRecent"
-                    )
-                ],
-                responses=responses,
-                bbox=bbox,
-                size=size,
-                config=config,
-                data_folder=datefolder_path
+            written = bt.download_tiled(
+                functools.partial(create_request, date_str, scene_id=scene_id),
+                bbox, args.resolution, datefolder_path,
+                prefix=scene_id + "_", max_workers=MAX_CONCURRENT_TILES
             )
-            request.save_data()
-            
-            """
-            Move the response.tar one level up, out of the folder named
-            after the hash (works via rename()). Delete the hash named folder.
-            Extract the tar. Delete the tar.
-            """
-            response_tar_path = next(datefolder_path.rglob("*.tar"))
-            tmp_response_tar_path = response_tar_path
-            new_tar_path = datefolder_path.joinpath(response_tar_path.name)
-            response_tar_path.rename(new_tar_path)
-            
-            shutil.rmtree(tmp_response_tar_path.parent)
-            with tarfile.open(new_tar_path, "r") as tar:
-                tar.extractall(datefolder_path, filter="data")
-            new_tar_path.unlink()
-            """
-            Rename the tifs according to the scene id and the band id
-            """
-            tif_paths = datefolder_path.glob("*.tif")
-            for tif_path in tif_paths:
-                new_filename = (scene_id + "_" + tif_path.name)
-                new_path = tif_path.parent.joinpath(new_filename)
-                tif_path.rename(new_path)
-                
+            return {datefolder_path: written}
+
+        request = create_request(date_str, bbox, size, datefolder_path, scene_id)
+
+        if STREAM_RESPONSES:
             """
-            Control output for a single scene
+            Keep the response.tar in memory and write every tif in it
+            only once, directly under its final name scene_id_band.tif.
             """
-            logger.info(f"{date_str}: Done")
-        
-        else:
-            logger.info(f"{date_str}: Already exists")
+            response_content = rw.download_response(request)
+            written = rw.write_response(response_content, datefolder_path, rw.response_name(request),
+                                        prefix=scene_id + "_")
+            return {datefolder_path: written}
 
-"""
-Close the the logging handlers to be able to delete the logfile etc.
-"""
-filehandler.close()
-consolehandler.close()
-logger.handlers.clear()
-        
\ No newline at end of file
+        request.save_data()
+
+        """
+        A layout with a single file is not returned as tar, but as one
+        response.tiff, which only needs its name.
+        """
+        if len(OUTPUT_LAYOUT.files) == 1:
+            response_path = next(datefolder_path.rglob("response.tiff"))
+            new_path = datefolder_path.joinpath(scene_id + "_" + rw.response_name(request))
+            response_path.rename(new_path)
+            shutil.rmtree(response_path.parent)
+            return {datefolder_path: [rw.describe_file(new_path)]}
+
+        """
+        Move the response.tar one level up, out of the folder named
+        after the hash (works via rename()). Delete the hash named folder.
+        Extract the tar. Delete the tar.
+        """
+        response_tar_path = next(datefolder_path.rglob("*.tar"))
+        tmp_response_tar_path = response_tar_path
+        new_tar_path = datefolder_path.joinpath(response_tar_path.name)
+        response_tar_path.rename(new_tar_path)
+
+        shutil.rmtree(tmp_response_tar_path.parent)
+        with tarfile.open(new_tar_path, "r") as tar:
+            tar.extractall(datefolder_path, filter="data")
+        new_tar_path.unlink()
+        """
+        Rename the tifs according to the scene id and the band id
+        """
+        tif_paths = datefolder_path.glob("*.tif")
+        written = []
+        for tif_path in tif_paths:
+            new_filename = (scene_id + "_" + tif_path.name)
+            new_path = tif_path.parent.joinpath(new_filename)
+            tif_path.rename(new_path)
+            written.append(rw.describe_file(new_path))
+        return {datefolder_path: written}
+
+    def download_merged(date_str: str, merged_bbox: sh.BBox, targets: list, scene_id: str = None):
+        """
+        Download one date for several neighbouring shapefiles with a single
+        request over merged_bbox and cut each shapefile's bbox out of it.
+        targets is a list of (bbox, datefolder_path, file name prefix).
+        scene_id is the scene planned for all of them.
+        Returns {datefolder_path: [WrittenFile]} for the manifest.
+        """
+        merged_size = sh.bbox_to_dimensions(merged_bbox, args.resolution)
+        request = create_request(date_str, merged_bbox, merged_size, scene_id=scene_id)
+        response_content = rw.download_response(request)
+        return rm.write_field_crops(response_content, merged_bbox, args.resolution, targets,
+                                    rw.response_name(request))
+
+    def record_result(result: dict):
+        """
+        Records each date folder in result ({datefolder_path: [WrittenFile]})
+        in the manifest, and in the cube with WRITE_CUBE.
+        """
+        for datefolder_path, written in result.items():
+            field_key, date_str, scene_id = download_targets[datefolder_path]
+            mask_targets.append(cm.MaskTarget(datefolder_path, scene_id, [file.path for file in written]))
+            if args.write_cube:
+                cube = fcube.FieldCube(datefolder_path.parent.joinpath(CUBE_NAME))
+                cube.append_files(date_str, scene_id, [file.path for file in written], OUTPUT_LAYOUT)
+                if not KEEP_TIFS:
+                    """
+                    Only the tifs that went into the cube are deleted.
+                    The date folder goes too once nothing else is left
+                    in it.
+                    """
+                    for file in written:
+                        file.path.unlink(missing_ok=True)
+                    if not any(datefolder_path.iterdir()):
+                        datefolder_path.rmdir()
+            manifest.record(field_key, date_str, scene_id, written)
+
+    def record_downloads(job: dq.DownloadJob, result: dict):
+        """
+        Called by the download queue for every finished job.
+        """
+        record_result(result)
+        logger.info(f"{job.label}: Done")
+
+    """
+    Collects a DownloadJob for every (shapefile, scene date) pair that still
+    has to be downloaded. The jobs are only run after all shapefiles have
+    been searched, see the download queue below.
+    """
+    download_jobs = []
+
+    def log_run_summary(summary: str):
+        """
+        Logs what the run downloaded, and what the cloud pre-check cost
+        and saved if it ran.
+        """
+        logger.info(f"Run summary: {summary}")
+        if precheck_report is not None:
+            logger.info(precheck_report.summary())
+
+    """
+    Maps the date folder of every queued download to its
+    (manifest field key, date, scene id).
+    """
+    download_targets = {}
+
+    """
+    The date folders downloaded in this run, for the cloud masks.
+    """
+    mask_targets = []
+
+    """
+    Collects the bbox, size and output folder of every shapefile. The
+    catalog is only searched after all shapefiles have been read.
+    """
+    fields = []
+    field_store = fs.FieldStore(outputfolder_path.joinpath(FIELD_STORE_NAME), inputfolder_path, args.resolution)
+
+    ### Get coordinates etc.
+    """
+    Only the shapefiles that changed since the last run are read, all at
+    once, see field_store.py and field_registry.py: their features are
+    moved into their UTM zone (shapefiles in EPSG:4326) and united, the
+    bbox around them is buffered by 100 m and rounded to whole pixels of
+    RESOLUTION, which gives the pixel width and height of the output.
+    Everything else comes from FIELD_STORE_NAME in the output folder.
+    """
+    field_records = field_store.get_many(sorted(shapefile_list))
+
+    ### Iterate over found shapefiles
+    for field_record in field_records:
+        shapefile_path = field_record.path
+        crs_code = field_record.epsg
+        geometry = field_record.geometry
+        shgeometry = sh.Geometry(geometry, sh.CRS(crs_code))
+        bbox = field_record.bbox
+        size = field_record.size
+
+        logger.info(f"{shapefile_path.name}: {repr(bbox)}")
+
+        ### Create directories and get names
+        """
+        Get the relative path of the shapefile starting from the
+        input folder, including the file name with extension.
+        Make an output folder path out of the output base folder,
+        the parent folder of the shapefile and the shapefile name.
+        The directories are only created when something is downloaded.
+
+        If shapefiles are already in subdirectories named after them, 
+        this will create another subdirectory of the same name,
+        e.g. "lager/lager/2025-04-31/.."
+        """
+        shapefile_relpath= shapefile_path.relative_to(inputfolder_path)
+        shapefile_folder_path = outputfolder_path.joinpath(
+            shapefile_relpath.parent, shapefile_relpath.stem)
+        """
+        Get the name of the greatest parent folder containing the shapefile,
+        which is hopefully named after the betrieb. This is later used for
+        renaming the output
+        """
+        shapefile_betrieb_name = field_record.betrieb
+
+        fields.append({
+            "shapefile_path": shapefile_path,
+            "folder_path": shapefile_folder_path,
+            "manifest_key": shapefile_relpath.with_suffix("").as_posix(),
+            "bbox": bbox,
+            "geometry": geometry,
+            "zones": [sh.Geometry(zone, sh.CRS(crs_code)) for zone in field_record.zones] if STATISTICS_PER_ZONE
+                     else [shgeometry],
+            "size": size,
+            "downloads": {}
+        })
+
+    field_store.save()
+
+    ### Statistical API mode
+    """
+    Only the statistics are needed, so there is nothing to search or
+    download: one Statistical API request per zone, all sent at once.
+    """
+    if args.statistics:
+        zones = [sa.Zone(field["manifest_key"], zone_index, zone)
+                 for field in fields for zone_index, zone in enumerate(field["zones"])]
+        statistics_table = sa.run_statistics(
+            zones, args.bands, (args.start, args.end), config,
+            max_threads=args.max_requests, resolution=args.resolution, maxcc=0.8
+        )
+        sa.write_table(statistics_table, outputfolder_path.joinpath(STATISTICS_NAME))
+        return
+
+    ### Find matching scenes
+    """ 
+    Create a list of scenes in the
+    l2a collection from the 
+    sentinelhub stac matching the desired timeframe
+    and location, excluding unnecessary information.
+    Filter scenes with cloud cover greater than 80% (wip number).
+    We don't use "distinct='date'", as the generator only returns
+    date strings in this case, not scenes.
+    The search goes through the catalog cache, which only asks
+    sentinelhub for the days not searched in an earlier run.
+
+    Neighbouring fields mostly lie in the same tiles, so the bboxes of
+    fields closer than CLUSTER_DISTANCE meters are grouped into clusters
+    and each cluster is searched only once. The footprint ("geometry")
+    of each scene is used to hand it back to the fields it covers, its
+    cloud cover to choose between scenes of the same date. The cache
+    keeps the results per field, so a new field in a cluster only
+    searches its own days.
+    """
+    def search_scenes(field_bboxes):
+        return catalog_cache.search_fields(
+            catalog,
+            sh.DataCollection.SENTINEL2_L2A,
+            field_bboxes,
+            time=(args.start, args.end),
+            fields={"include": ["id", "properties.datetime", "properties.eo:cloud_cover", "geometry"],
+                    "exclude": []},
+            filter="eo:cloud_cover < 80"
+        )
+
+    clusters = fc.cluster_fields([field["bbox"] for field in fields], max_distance=CLUSTER_DISTANCE)
+    scenes_per_field = fc.search_fields_by_cluster(clusters, search_scenes)
+
+    ### Plan the downloads
+    """
+    Fields in the overlap of two tiles get more than one scene for the same
+    date. The planner keeps one scene per date, the one covering most of
+    the field polygon (then the least clouded tile), and leaves out dates
+    the manifest says were completely downloaded in an earlier run. The
+    date folders themselves are not looked at. Everything after this only
+    works from the plan.
+    """
+    plans = []
+    for field_index, field in enumerate(fields):
+        matching_scenes = scenes_per_field[field_index]
+        logger.info(f"{field['shapefile_path'].name}: Matches für {args.start} bis {args.end}: {len(matching_scenes)}")
+        plan = sp.plan_field(
+            field["manifest_key"], field["geometry"], field["bbox"], field["size"], field["folder_path"],
+            matching_scenes, done=manifest
+        )
+        for download in plan:
+            field["downloads"][download.date_str] = (download.scene_id, download.folder)
+            download_targets[download.folder] = (download.field_key, download.date_str, download.scene_id)
+        plans.append(plan)
+    logger.info(sp.summary(plans))
+
+    ### Cloud pre-check
+    """
+    Check all dates still to download at once and take the ones where
+    the field itself is mostly clouded out again, before any job is
+    created for them.
+    """
+    precheck_report = None
+    if args.precheck:
+        cloud_precheck = cp.CloudPrecheck(
+            outputfolder_path.joinpath(PRECHECK_NAME), config,
+            min_valid_fraction=PRECHECK_MIN_VALID, max_threads=args.max_requests
+        )
+        candidates = [
+            cp.Candidate(field["manifest_key"], date_str, scene_id, field["bbox"], field["geometry"], field["size"])
+            for field in fields
+            for date_str, (scene_id, datefolder_path) in field["downloads"].items()
+        ]
+        keep, precheck_report = cloud_precheck.check(candidates, OUTPUT_LAYOUT)
+        kept = {(candidate.field_key, candidate.date_str) for candidate in keep}
+        for field in fields:
+            for date_str in list(field["downloads"]):
+                if (field["manifest_key"], date_str) not in kept:
+                    scene_id, datefolder_path = field["downloads"].pop(date_str)
+                    del download_targets[datefolder_path]
+
+    ### Batch Processing mode
+    """
+    All dates still to download are known and checked. Group them by date
+    over all fields and let one batch job for all of them produce them
+    instead of the download queue.
+    """
+    if args.batch:
+        batch_targets = {}
+        for field in fields:
+            for date_str, (scene_id, datefolder_path) in field["downloads"].items():
+                batch_targets.setdefault(date_str, []).append(
+                    bj.BatchTarget(field["bbox"], field["geometry"], datefolder_path, scene_id + "_"))
+        batch_written = bj.run_batch_job(
+            batch_targets, OUTPUT_LAYOUT, config, bj.S3ObjectStore(), BATCH_OUTPUT_URL,
+            resolution=args.resolution, credentials=bj.s3_credentials(BATCH_IAM_ROLE_ARN)
+        )
+        record_result(batch_written)
+        log_run_summary(f"{len(batch_written)} date folders written by the batch job")
+        if args.cloud_masks:
+            cm.mask_downloads(mask_targets, OUTPUT_LAYOUT)
+        return
+
+    ### Create download jobs
+    """
+    With MERGE_REQUESTS, neighbouring fields that need the same dates and
+    whose bboxes fit into one request together are downloaded with a
+    single request per date and cut apart afterwards, see
+    request_merging.py. Otherwise every field
+    is its own "merged request". Each merged request gets one job per date
+    that any of its fields still needs.
+    With MULTI_TEMPORAL every field gets one job per chunk of its dates
+    instead, except for fields that are too large for a single request,
+    which are downloaded date by date in tiles as before.
+    """
+    if args.multi_temporal:
+        for field in fields:
+            if not field["downloads"] or bt.needs_split(field["size"]):
+                continue
+            targets = [mt.DateTarget(date_str, scene_id, datefolder_path)
+                       for date_str, (scene_id, datefolder_path) in field["downloads"].items()]
+            chunks = mt.chunk_targets(targets, field["bbox"], field["size"], OUTPUT_LAYOUT,
+                                      max_bytes=MAX_RESPONSE_MB * 1024 * 1024, max_units=MAX_REQUEST_UNITS)
+            for chunk in chunks:
+                download_jobs.append(dq.DownloadJob(
+                    field_key=repr(field["bbox"]),
+                    label=f"{field['shapefile_path'].name} {chunk.dates[0]} bis {chunk.dates[-1]} ({len(chunk.dates)})",
+                    run=functools.partial(mt.download_chunk, chunk, OUTPUT_LAYOUT, config)
+                ))
+            field["downloads"] = {}
+
+    if MERGE_REQUESTS:
+        """
+        Fields are only merged if they need the same dates from the same
+        planned scenes. The merged request is pinned to that scene, so
+        every crop comes from the scene its file is named after.
+        """
+        merged_requests = rm.merge_fields(
+            [field["bbox"] for field in fields], args.resolution,
+            dates=[frozenset((date_str, scene_id) for date_str, (scene_id, _) in field["downloads"].items())
+                   for field in fields]
+        )
+    else:
+        merged_requests = [rm.MergedRequest(field["bbox"], [field_index])
+                           for field_index, field in enumerate(fields)]
+
+    for merged_request in merged_requests:
+        member_fields = [fields[field_index] for field_index in merged_request.members]
+        dates = sorted({date_str for field in member_fields for date_str in field["downloads"]})
+        for date_str in dates:
+            date_fields = [field for field in member_fields if date_str in field["downloads"]]
+            if len(merged_request.members) == 1:
+                field = date_fields[0]
+                scene_id, datefolder_path = field["downloads"][date_str]
+                run = functools.partial(
+                    download_scene, datefolder_path, scene_id, date_str, field["bbox"], field["size"])
+            else:
+                scene_id = date_fields[0]["downloads"][date_str][0]
+                targets = [(field["bbox"], field["downloads"][date_str][1], scene_id + "_")
+                           for field in date_fields]
+                run = functools.partial(download_merged, date_str, merged_request.bbox, targets, scene_id)
+            download_jobs.append(dq.DownloadJob(
+                field_key=repr(merged_request.bbox),
+                label=", ".join(field["shapefile_path"].name for field in date_fields) + f" {date_str}",
+                run=run
+            ))
+
+    ### Run the download queue
+    """
+    All (shapefile, scene date) pairs are now known. Download them with
+    at most MAX_CONCURRENT_REQUESTS requests at the same time. Dates of
+    one shapefile are still downloaded one after another, rate limited
+    (429) or failed (5xx) requests are retried with a backoff.
+    """
+    logger.info(f"Queued downloads: {len(download_jobs)}")
+    queue_stats = dq.run_download_queue(
+        download_jobs,
+        max_workers=args.max_requests,
+        on_done=record_downloads
+    )
+    log_run_summary(f"{queue_stats.done} downloads, {queue_stats.failed} failed, "
+                    f"{queue_stats.retries} retries in {queue_stats.seconds:.1f}s")
+
+    ### Cloud masks
+    if args.cloud_masks:
+        cm.mask_downloads(mask_targets, OUTPUT_LAYOUT)
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,10 @@ import shutil
 import tarfile
 import numpy as np
 
+import band_registry as br
+import response_writer as rw
+import scene_planner as sp
+
 ### Helper functions
 """
 A callable for the bbox edge rounding.
@@ -21,6 +25,9 @@ timeframe, bands of interest, output folder, etc.
 You should paste the filepaths after the r, which denotes
 a raw string (helps with the backslashes). Resolution
 should be 10 (m/px), which is the highest available.
+With STREAM_RESPONSES the response tifs are written once from
+memory under their final names, instead of saving, moving,
+extracting and renaming the response.tar on disk.
 """
 INPUT_FOLDER = r"C:\Users\juliu\Daten\IT-Projekte\Digiman\data\test_input"
 OUTPUT_FOLDER = r"C:\Users\juliu\Daten\IT-Projekte\Digiman\data\test_output"
@@ -28,6 +35,7 @@ START_DATE = '2025-06-23'
 END_DATE = '2025-06-23'
 RESOLUTION = 10  # Meter pro Pixel
 BAND_NAMES = ["B02", "B03", "B04"]
+STREAM_RESPONSES = True
 
 """
 Create Path-Objects.
@@ -93,6 +101,14 @@ responses = [
     sh.SentinelHubRequest.output_response("B04", sh.MimeType.TIFF),
     ]
 
+"""
+The same three files as an output layout (see band_registry.py). Its
+evalscript can be restricted to the tile of a single scene, which the
+requests below use: a shape in the overlap of two tiles gets the bands
+of the scene its files are named after, not a mosaic of both.
+"""
+OUTPUT_LAYOUT = br.single_band_layout(["B02", "B03", "B04"])
+
 ### Iterate over found shapefiles
 for shapefile_path in shapefile_list:
     
@@ -175,7 +191,7 @@ for shapefile_path in shapefile_list:
     where a shape is within two different, overlapping tiles,
     leading to two scenes for a single day.
     """
-    downloaded_scene_dates = []
+    downloaded_scene_dates = set()
     ### Iterate over scenes
     for scene in matching_scenes:
         """
@@ -198,11 +214,13 @@ for shapefile_path in shapefile_list:
             The Request is fed the evalscript and the input_data string.
             We provide the previously extracted date as the start and finish
             of our time_intervall, so data from the whole day is considered.
-            We choose mostRecent as our mosaicking_order, incase the bbox
-            overlaps multiple tiles with data from different times.
+            If the scene id names its tile, only that tile is used,
+            otherwise we choose mostRecent as our mosaicking_order, incase
+            the bbox overlaps multiple tiles with data from different times.
             """
+            tile_path = sp.tile_path(scene_id)
             request = sh.SentinelHubRequest(
-                evalscript=evalscript,
+                evalscript=evalscript if tile_path is None else OUTPUT_LAYOUT.evalscript(tile_path),
                 input_data=[
                     sh.SentinelHubRequest.input_data(
                         data_collection=sh.DataCollection.SENTINEL2_L2A,
@@ -216,6 +234,17 @@ for shapefile_path in shapefile_list:
                 config=config,
                 data_folder=datefolder_path
             )
+            if STREAM_RESPONSES:
+                """
+                Keep the response.tar in memory and write every tif in it
+                only once, directly under its final name scene_id_band.tif.
+                """
+                response_content = rw.download_response(request)
+                rw.write_response(response_content, datefolder_path, rw.response_name(request),
+                                  prefix=scene_id + "_")
+                downloaded_scene_dates.add(date_str)
+                continue
+            
             request.save_data()
             
             """
@@ -245,5 +274,5 @@ for shapefile_path in shapefile_list:
         Add this date to the already downloaded dates to avoid
         downloading from more than one scene for a single day
         """
-        downloaded_scene_dates.append(date_str)
+        downloaded_scene_dates.add(date_str)
             
@@ -5,7 +5,11 @@ from tkinter import Tk, filedialog, Button, Label
 from tkcalendar import DateEntry
 from tqdm import tqdm
 import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import download_queue as dq
+
+# Anzahl gleichzeitiger Requests an Sentinel Hub
+MAX_CONCURRENT_REQUESTS = 8
 
 # GUI-Funktionen für Ordner- und Datumsauswahl
 def select_folder(title="Ordner auswählen"):
@@ -48,18 +52,23 @@ def create_output_dir(input_root, output_root, shapefile_path):
     out_dir = os.path.join(output_root, base_path + "-data")
     return out_dir
 
-# Download-Funktion für Sentinel Hub
+# Ein einzelnes Band herunterladen, läuft in der Download-Queue
+def download_band(request, band, shapefile_path):
+    print(f"⬇️ Lade Band {band} für {os.path.basename(shapefile_path)} herunter...")
+    request.get_data(save_data=True)  # speichert TIFF in out_dir
+
+# Download-Jobs für Sentinel Hub erstellen, ein Job pro Band
 def download_sentinelhub_bands(shapefile_path, start_date, end_date, input_root, output_root, config):
     try:
             
         gdf = gpd.read_file(shapefile_path).to_crs("EPSG:4326")
     except Exception as e:
         print(f"⚠️ Fehler beim Laden von {shapefile_path}: {e}")
-        return
+        return []
 
     if len(gdf) != 1:
         print(f"⚠️ Überspringe {shapefile_path}: enthält {len(gdf)} Features (erwartet 1).")
-        return
+        return []
 
     geom = gdf.geometry[0]
     bbox = BBox(bbox=geom.bounds, crs=CRS.WGS84)
@@ -78,7 +87,8 @@ def download_sentinelhub_bands(shapefile_path, start_date, end_date, input_root,
     # Bänder, die heruntergeladen werden sollen
     bands = ["B02", "B03", "B04", "B08"]  # Blau, Grün, Rot, NIR
 
-    # Für jeden Band ein Request erstellen und ausführen
+    # Für jedes Band einen Request erstellen, ausgeführt werden sie später gemeinsam in der Download-Queue
+    jobs = []
     for band in bands:
         date_str = f"{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}"
         tif_name = f"{betrieb}-{feld_id}-{date_str}-{band.lower()}.tif"
@@ -115,13 +125,14 @@ def download_sentinelhub_bands(shapefile_path, start_date, end_date, input_root,
             data_folder=out_dir
         )
 
-        print(f"⬇️ Lade Band {band} für {os.path.basename(shapefile_path)} herunter...")
-        try:
-            data = request.get_data(save_data=True)  # speichert TIFF in out_dir
-        except Exception as e:
-            print(f"⚠️ Fehler beim Download von Band {band}: {e}")
+        # Die Bänder hängen nicht voneinander ab, deshalb bekommt jedes Band einen eigenen field_key
+        jobs.append(dq.DownloadJob(
+            field_key=out_path,
+            label=f"{os.path.basename(shapefile_path)} {band}",
+            run=functools.partial(download_band, request, band, shapefile_path)
+        ))
 
-    print(f"✅ Download für {os.path.basename(shapefile_path)} abgeschlossen.")
+    return jobs
 
 def find_shapefiles(folder):
     shapefiles = []
@@ -168,10 +179,19 @@ def main():
     shapefiles = find_shapefiles(input_root)
     print(f"🔍 Gefundene Shapefiles: {len(shapefiles)}")
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(download_sentinelhub_bands, shp, start_date, end_date, input_root, output_root, config) for shp in shapefiles]
-        for future in tqdm(as_completed(futures), total=len(futures), desc="🔄 Bearbeitung"):
-            pass
+    # Erst die Bänder aller Shapefiles sammeln, dann gemeinsam in einer Queue herunterladen
+    jobs = []
+    for shp in shapefiles:
+        jobs.extend(download_sentinelhub_bands(shp, start_date, end_date, input_root, output_root, config))
+
+    with tqdm(total=len(jobs), desc="🔄 Bearbeitung") as progress:
+        stats = dq.run_download_queue(
+            jobs,
+            max_workers=MAX_CONCURRENT_REQUESTS,
+            on_done=lambda job, result: progress.update(),
+            on_error=lambda job, e: (print(f"⚠️ Fehler beim Download von {job.label}: {e}"), progress.update())
+        )
+    print(f"✅ Download abgeschlossen: {stats.done} Bänder, {stats.failed} Fehler.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,297 @@
+"""
+Asynchronous STAC search and COG download for many fields at once.
+
+gpt_version.py handles one shapefile after the other and starts a new
+ThreadPoolExecutor for every scene, in which every band is opened with
+rioxarray.open_rasterio, i.e. with its own GDAL connections. Here all
+STAC searches and all COG range requests of all fields and scenes run
+as coroutines on one event loop, over a single pooled httpx.AsyncClient.
+One semaphore limits the requests in flight for the whole run, so the
+limit holds no matter how many fields, scenes or bands there are.
+
+A FieldTask describes one field: its geometry (EPSG:4326) and where the
+tif of a band of a scene goes. run_engine searches for every field, then
+turns the results around into item -> band -> [fields]: every item is
+signed once and every band COG is opened once, no matter how many fields
+lie in it. The tiles covering all of these fields are read in one batch
+(see cog_reader.py), and each field's window is cut out of them and
+written masked to its geometry, like rioxarray's clip(drop=True) did.
+"""
+import asyncio
+import dataclasses
+import functools
+import itertools
+import logging
+import os
+import pathlib as pl
+import time
+from typing import Callable
+
+import httpx
+import numpy as np
+import pyproj
+import rasterio as rio
+import rasterio.features
+import shapely
+import shapely.geometry
+
+import cog_reader as cr
+import pc_signing
+import range_cache as rc
+
+logger = logging.getLogger("SHD.stac_engine")
+
+PC_STAC_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+MAX_IN_FLIGHT = 32
+
+
+@dataclasses.dataclass
+class FieldTask:
+    """
+    One field to download. out_path(item datetime, band code) returns the
+    path of the tif for that band of a scene. If write_band is given, it
+    is called with (item id, item datetime, band code, masked array,
+    transform, crs) instead of writing a tif, e.g. to write into a
+    field_cube.FieldCube, and is_done(item datetime, band code) replaces
+    the check whether the tif exists.
+    """
+    name: str
+    geometry: shapely.Geometry
+    out_path: Callable
+    write_band: Callable = None
+    is_done: Callable = None
+
+
+@dataclasses.dataclass
+class EngineStats:
+    """
+    Counters of run_engine. failed counts the fields whose search failed
+    and every (field, item) with at least one failed band.
+    """
+    searches: int = 0
+    items: int = 0
+    opened: int = 0
+    files: int = 0
+    skipped: int = 0
+    failed: int = 0
+    requests: int = 0
+    bytes_read: int = 0
+    seconds: float = 0.0
+
+    @property
+    def megabytes_per_second(self) -> float:
+        return self.bytes_read / 1e6 / self.seconds if self.seconds else 0.0
+
+
+@functools.lru_cache(maxsize=None)
+def transformer_to(epsg: int):
+    return pyproj.Transformer.from_crs(4326, epsg, always_xy=True)
+
+
+async def search_items(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, stac_url: str,
+                       body: dict, stats: EngineStats):
+    """
+    POST a STAC item search and follow its "next" links. Returns the
+    items as a list of dicts.
+    """
+    items = []
+    request = {"method": "POST", "href": stac_url.rstrip("/") + "/search", "body": body}
+    while request is not None:
+        async with semaphore:
+            if request.get("method", "GET") == "POST":
+                response = await client.post(request["href"], json=request["body"])
+            else:
+                response = await client.get(request["href"])
+        response.raise_for_status()
+        stats.searches += 1
+        page = response.json()
+        items.extend(page["features"])
+        request = next((link for link in page.get("links", []) if link["rel"] == "next"), None)
+        if request is not None and request.get("merge"):
+            request["body"] = {**body, **request.get("body", {})}
+    return items
+
+
+def mask_outside(data: np.ndarray, transform, geometry, nodata):
+    """
+    Set the pixels of data outside geometry to nodata.
+    """
+    inside = rasterio.features.geometry_mask([geometry], data.shape, transform, invert=True)
+    return np.where(inside, data, np.array(nodata, dtype=data.dtype))
+
+
+def write_tif(data: np.ndarray, transform, epsg: int, out_path: pl.Path, nodata):
+    """
+    Write data as a GeoTIFF through a hidden temporary file that is
+    renamed to out_path.
+    """
+    out_path = pl.Path(out_path)
+    tmp_path = out_path.with_name("." + out_path.name + ".part")
+    try:
+        with rio.open(tmp_path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0],
+                      count=1, dtype=data.dtype, crs=f"EPSG:{epsg}", transform=transform,
+                      nodata=nodata) as dataset:
+            dataset.write(data, 1)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+async def download_asset(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, href: str,
+                         targets, stats: EngineStats, cache: rc.RangeCache = None,
+                         signer: pc_signing.TokenCache = None):
+    """
+    Open the COG at href once and write the window of every (FieldTask,
+    item, band code, out_path) in targets, masked to the geometry of the
+    task. The tiles of all windows are fetched together, through cache if
+    given. With a signer every range request is signed with its current
+    token.
+    """
+    source = cr.HttpRangeSource(client, href, semaphore, signer.sign_href_async if signer else None)
+    try:
+        reader = await cr.CogReader.open(rc.CachedRangeSource(source, cache) if cache else source)
+        stats.opened += 1
+        nodata = 0 if reader.info.nodata is None else reader.info.nodata
+        fields = []
+        for task, item, band_code, out_path in targets:
+            local_geometry = shapely.transform(task.geometry, transformer_to(reader.epsg).transform,
+                                               interleaved=False)
+            window = reader.window_from_bounds(local_geometry.bounds)
+            if window.width == 0 or window.height == 0:
+                stats.skipped += 1
+                continue
+            fields.append((task, item, band_code, out_path, local_geometry, window))
+
+        datas = await reader.read_windows([field[-1] for field in fields])
+        for (task, item, band_code, out_path, local_geometry, window), data in zip(fields, datas):
+            transform = rio.windows.transform(window, reader.transform)
+            data = mask_outside(data, transform, local_geometry, nodata)
+            if task.write_band is not None:
+                await asyncio.to_thread(task.write_band, item["id"], item["properties"]["datetime"],
+                                        band_code, data, transform, f"EPSG:{reader.epsg}")
+            else:
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                await asyncio.to_thread(write_tif, data, transform, reader.epsg, out_path, nodata)
+            stats.files += 1
+    finally:
+        stats.requests += source.requests
+        stats.bytes_read += source.bytes_read
+
+
+def band_assets(item: dict):
+    """
+    The band assets (keys starting with "B", like B02 or B8A) of an item.
+    """
+    return {key: asset for key, asset in item["assets"].items()
+            if key.startswith("B") and "href" in asset}
+
+
+async def run_engine(tasks, start_date: str, end_date: str, stac_url: str = PC_STAC_URL,
+                     collections=("sentinel-2-l2a",), max_in_flight: int = MAX_IN_FLIGHT,
+                     sign: Callable = None, cache: rc.RangeCache = None,
+                     signer: pc_signing.TokenCache = None):
+    """
+    Search and download all tasks with at most max_in_flight HTTP
+    requests at a time. sign(item) is applied to every found item before
+    its assets are read (e.g. planetary_computer.sign); it runs in a
+    worker thread. A signer (pc_signing.TokenCache) is used instead of
+    sign: it signs all items in one go and every range request again with
+    the current token. Band files that already exist (or that is_done
+    reports for tasks writing with write_band) are skipped. With a
+    RangeCache, COG byte ranges read in earlier runs are not fetched again.
+    Returns EngineStats.
+    """
+    stats = EngineStats()
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60.0, follow_redirects=True) as client:
+        searches = [
+            search_items(client, semaphore, stac_url, {
+                "collections": list(collections),
+                "datetime": f"{start_date}/{end_date}",
+                "intersects": shapely.geometry.mapping(task.geometry),
+                "limit": 100,
+            }, stats)
+            for task in tasks
+        ]
+        results = await asyncio.gather(*searches, return_exceptions=True)
+
+        items = {}
+        item_fields = {}
+        for task, found in zip(tasks, results):
+            if isinstance(found, BaseException):
+                logger.error(f"{task.name}: search failed ({found!r})")
+                stats.failed += 1
+                continue
+            logger.info(f"{task.name}: {len(found)} scenes")
+            for item in found:
+                items.setdefault(item["id"], item)
+                item_fields.setdefault(item["id"], []).append(task)
+        stats.items = len(items)
+
+        if signer is not None:
+            signed = await asyncio.to_thread(signer.sign_items, list(items.values()))
+            items = dict(zip(items, signed))
+        elif sign is not None:
+            signed = await asyncio.gather(*(asyncio.to_thread(sign, item) for item in items.values()))
+            items = dict(zip(items, signed))
+
+        """
+        item -> band -> [fields]: one read per band file, with all fields
+        of the item that still need that band
+        """
+        reads = []
+        planned = set()
+        for item_id, item in items.items():
+            datetime = item["properties"]["datetime"]
+            for band_code, asset in band_assets(item).items():
+                targets = []
+                for task in item_fields[item_id]:
+                    out_path = pl.Path(task.out_path(datetime, band_code.lower()))
+                    done = task.is_done(datetime, band_code.lower()) if task.is_done else out_path.exists()
+                    if out_path in planned or done:
+                        stats.skipped += 1
+                        continue
+                    planned.add(out_path)
+                    targets.append((task, item, band_code.lower(), out_path))
+                if targets:
+                    reads.append((asset["href"], targets))
+
+        """
+        At most max_in_flight COGs are open at a time, the next one starts
+        when one is written. Starting all of them at once would hold the
+        tiles of every COG that is waiting for the semaphore or the disk.
+        """
+        logger.info(f"{len(planned)} band files from {len(reads)} COGs to download")
+        remaining = iter(reads)
+        running = {}
+        failed = set()
+        while True:
+            for href, targets in itertools.islice(remaining, max_in_flight - len(running)):
+                download = download_asset(client, semaphore, href, targets, stats, cache, signer)
+                running[asyncio.ensure_future(download)] = (href, targets)
+            if not running:
+                break
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in finished:
+                href, targets = running.pop(future)
+                if future.exception() is not None:
+                    logger.error(f"{href.split('?')[0]}: failed ({future.exception()!r})")
+                    failed.update((task.name, item["id"]) for task, item, _, _ in targets)
+        stats.failed += len(failed)
+
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"Engine: {stats.files} files from {stats.opened} COGs, {stats.skipped} skipped, {stats.failed} failed, "
+                f"{stats.requests} range requests, {stats.bytes_read / 1e6:.1f} MB "
+                f"in {stats.seconds:.1f}s ({stats.megabytes_per_second:.1f} MB/s)")
+    return stats
+
+
+def download_all(tasks, start_date: str, end_date: str, **kwargs):
+    """
+    Run run_engine from synchronous code.
+    """
+    return asyncio.run(run_engine(tasks, start_date, end_date, **kwargs))
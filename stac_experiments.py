@@ -0,0 +1,137 @@
+### STAC/COG-Engine-Experimente
+
+import os
+import pathlib as pl
+import tempfile
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio as rio
+import rioxarray
+import shapely
+from rasterio.transform import from_origin
+
+import stac_engine
+import stub_api
+
+"""
+Durchsatz der async Engine gegen den lokalen Stub messen: der Stub
+liefert die STAC-Suche und dient als statischer Dateiserver für COGs
+(mit Range-Requests). SCENES Szenen mit je BANDS Bändern als gekachelte,
+deflate-komprimierte GeoTIFFs, FIELDS kleine Felder darin. Jeder Request
+bekommt LATENCY Sekunden Verzögerung, wie übers Netz.
+Zum Vergleich der alte Weg aus gpt_version.py: pro Szene ein
+ThreadPoolExecutor(5) mit rioxarray.open_rasterio je Band.
+"""
+SCENES = 6
+BANDS = ["B02", "B03", "B04", "B08"]
+FIELDS = 20
+SIZE = 4096
+LATENCY = 0.02
+
+"""
+GDAL sucht beim Öffnen nach Nebendateien (.aux.xml, .ovr, ...). Gegen
+den Stub im selben Prozess blockiert das, also abschalten.
+"""
+os.environ["GDAL_DISABLE_READDIR_ON_OPEN"] = "EMPTY_DIR"
+
+ORIGIN = (600000, 5400000)
+transform = from_origin(*ORIGIN, 10, 10)
+to_4326 = stac_engine.pyproj.Transformer.from_crs(32632, 4326, always_xy=True)
+
+
+def make_cogs(folder: pl.Path):
+    rng = np.random.default_rng(0)
+    for scene in range(SCENES):
+        for band in BANDS:
+            path = folder.joinpath(f"scene{scene}", f"{band}.tif")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            data = rng.integers(0, 10000, (SIZE, SIZE), dtype=np.uint16)
+            with rio.open(path, "w", driver="GTiff", width=SIZE, height=SIZE, count=1,
+                          dtype="uint16", crs="EPSG:32632", transform=transform, nodata=0,
+                          tiled=True, blockxsize=512, blockysize=512,
+                          compress="deflate", predictor=2) as dataset:
+                dataset.write(data, 1)
+
+
+def make_items(url: str):
+    return [{
+        "type": "Feature", "id": f"scene{scene}",
+        "properties": {"datetime": f"2025-06-{scene + 1:02d}T10:30:00Z"},
+        "assets": {band: {"href": f"{url}/files/scene{scene}/{band}.tif"} for band in BANDS},
+    } for scene in range(SCENES)]
+
+
+def make_fields():
+    """
+    Felder von 300 x 300 m, über die Fläche der Szenen verteilt
+    """
+    rng = np.random.default_rng(1)
+    fields = []
+    for x, y in rng.uniform(1000, SIZE * 10 - 1000, (FIELDS, 2)):
+        box = shapely.box(ORIGIN[0] + x, ORIGIN[1] - y, ORIGIN[0] + x + 300, ORIGIN[1] - y + 300)
+        fields.append(shapely.transform(box, to_4326.transform, interleaved=False))
+    return fields
+
+
+def make_tasks(fields, out_folder: pl.Path):
+    return [
+        stac_engine.FieldTask(
+            name=f"feld{index}", geometry=geometry,
+            out_path=lambda datetime, band, index=index: out_folder.joinpath(
+                f"feld{index}", datetime[:10], f"{band}.tif"))
+        for index, geometry in enumerate(fields)
+    ]
+
+
+def old_way(items, fields, out_folder: pl.Path):
+    """
+    Wie gpt_version.py: Feld für Feld, Szene für Szene, Bänder in
+    einem neuen ThreadPoolExecutor(5) über rioxarray
+    """
+    for index, geometry in enumerate(fields):
+        for item in items:
+            folder = out_folder.joinpath(f"feld{index}", item["properties"]["datetime"][:10])
+            folder.mkdir(parents=True, exist_ok=True)
+
+            def download(band):
+                da = rioxarray.open_rasterio(item["assets"][band]["href"], masked=True).squeeze()
+                clipped = da.rio.clip([geometry], "EPSG:4326", drop=True)
+                clipped.rio.to_raster(folder.joinpath(f"{band}.tif"))
+
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                list(executor.map(download, BANDS))
+
+
+def main():
+    logging.getLogger("SHD").addHandler(logging.StreamHandler(sys.stdout))
+    logging.getLogger("SHD").setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pl.Path(tmp_dir)
+        make_cogs(tmp_path.joinpath("cogs"))
+        fields = make_fields()
+
+        with stub_api.StubServer(latency=LATENCY, static_root=tmp_path.joinpath("cogs")) as server:
+            server.stac_items = make_items(server.url)
+            stac_url = server.url + "/api/stac/v1"
+
+            start = time.perf_counter()
+            old_way(server.stac_items, fields, tmp_path.joinpath("old"))
+            print(f"alter Weg: {time.perf_counter() - start:.1f} s")
+
+            for max_in_flight in (1, 8, 32):
+                tasks = make_tasks(fields, tmp_path.joinpath(f"engine{max_in_flight}"))
+                stats = stac_engine.download_all(tasks, "2025-06-01", "2025-06-30",
+                                                 stac_url=stac_url, max_in_flight=max_in_flight)
+                print(f"max_in_flight={max_in_flight}: {stats.seconds:.1f} s, {stats.files} Dateien "
+                      f"aus {stats.opened} COGs, "
+                      f"{stats.requests} Range-Requests, {stats.megabytes_per_second:.1f} MB/s, "
+                      f"{stats.failed} Fehler")
+
+
+if __name__ == "__main__":
+    main()
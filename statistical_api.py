@@ -0,0 +1,131 @@
+"""
+Per-field band statistics from the Sentinel Hub Statistical API.
+
+Many jobs only need the mean (or min, max, std) of every band per field
+or zone and date, which raster_experiments.py / zonal_stats.py compute
+after downloading the full tifs. The Statistical API computes them on
+the server: one request per geometry and time range returns the
+statistics of every band for every day with data, no raster is sent.
+
+statistics_evalscript turns a band list into an evalscript with one
+FLOAT32 output "bands" and the dataMask output the API needs.
+run_statistics sends the requests of all zones at once through a
+SentinelHubStatisticalDownloadClient (max_threads at a time, days that
+failed on the server are retried one by one) and turns the
+responses into one table in the layout of zonal_stats.zonal_stats: one
+row per field, zone and date with the columns <band>_<statistic>.
+write_table writes it as parquet (through a temporary file, like the
+tifs in response_writer.py).
+"""
+import dataclasses
+import logging
+import os
+import pathlib as pl
+
+import numpy as np
+import pandas as pd
+import sentinelhub as sh
+
+import output_layouts as ol
+import zonal_stats as zs
+
+logger = logging.getLogger("SHD.statistical_api")
+
+AGGREGATION_INTERVAL = "P1D"
+
+
+def statistics_layout(bands):
+    return ol.OutputLayout([
+        ol.OutputFile("bands", list(bands), "FLOAT32"),
+        ol.OutputFile("dataMask", ["dataMask"], "UINT8"),
+    ])
+
+
+def statistics_evalscript(bands):
+    return statistics_layout(bands).evalscript()
+
+
+@dataclasses.dataclass
+class Zone:
+    """
+    One geometry to get statistics for: a whole field (zone 0) or one
+    feature of its shapefile.
+    """
+    field_key: str
+    zone: int
+    geometry: sh.Geometry
+
+
+def create_statistics_request(zone: Zone, bands, time_interval, config: sh.SHConfig,
+                              resolution: float = 10, aggregation_interval: str = AGGREGATION_INTERVAL,
+                              data_collection=sh.DataCollection.SENTINEL2_L2A, maxcc: float = None):
+    return sh.SentinelHubStatistical(
+        aggregation=sh.SentinelHubStatistical.aggregation(
+            evalscript=statistics_evalscript(bands),
+            time_interval=time_interval,
+            aggregation_interval=aggregation_interval,
+            resolution=(resolution, resolution)
+        ),
+        input_data=[sh.SentinelHubStatistical.input_data(data_collection, maxcc=maxcc)],
+        geometry=zone.geometry,
+        config=config
+    )
+
+
+def response_rows(zone: Zone, response: dict, bands):
+    """
+    One row per interval of a Statistical API response, dates without
+    a valid pixel are left out.
+    """
+    rows = []
+    for interval in response.get("data", []):
+        if "error" in interval:
+            logger.warning(f"{zone.field_key} zone {zone.zone} {interval['interval']['from'][:10]}: "
+                           f"{interval['error']}")
+            continue
+        output_bands = interval["outputs"]["bands"]["bands"]
+        row = {"field": zone.field_key, "zone": zone.zone, "date": interval["interval"]["from"][:10]}
+        for index, band in enumerate(bands):
+            stats = output_bands[f"B{index}"]["stats"]
+            count = stats["sampleCount"] - stats["noDataCount"]
+            row[f"{band}_count"] = count
+            for name, key in (("mean", "mean"), ("min", "min"), ("max", "max"), ("std", "stDev")):
+                value = stats.get(key)
+                row[f"{band}_{name}"] = np.nan if count == 0 or value in (None, "NaN") else float(value)
+        rows.append(row)
+    return rows
+
+
+def run_statistics(zones, bands, time_interval, config: sh.SHConfig, max_threads: int = 4, **kwargs):
+    """
+    Statistics of bands for all zones over time_interval. kwargs go to
+    create_statistics_request. Zones whose request failed are logged
+    and missing from the table.
+    """
+    requests = [create_statistics_request(zone, bands, time_interval, config, **kwargs) for zone in zones]
+    client = sh.SentinelHubStatisticalDownloadClient(config=config, raise_download_errors=False)
+    responses = client.download([request.download_list[0] for request in requests],
+                                max_threads=max_threads)
+    rows = []
+    failed = 0
+    for zone, response in zip(zones, responses):
+        if response is None:
+            failed += 1
+            continue
+        rows.extend(response_rows(zone, response, bands))
+    columns = ["field", "zone", "date"] + [f"{band}_{name}" for band in bands for name in zs.STATISTICS]
+    table = pd.DataFrame(rows, columns=columns)
+    logger.info(f"Statistical API: {len(table)} rows for {len(zones) - failed} of {len(zones)} zones, "
+                f"{failed} failed")
+    return table
+
+
+def write_table(table: pd.DataFrame, path: pl.Path):
+    path = pl.Path(path)
+    tmp_path = path.with_name("." + path.name + ".part")
+    try:
+        table.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
@@ -0,0 +1,494 @@
+"""
+Local stand-in for the Sentinel Hub (and STAC/COG) endpoints the
+download scripts use.
+
+Nothing here talks to the real service. The stub is meant for measuring
+throughput and trying out the download code without spending processing
+units: start a StubServer, point an SHConfig at it with stub_config, use the
+data collection from stub_collection and run the normal request code.
+
+Served endpoints:
+    POST /oauth/token       returns a dummy access token
+    POST /api/v1/process    returns a tar with one GeoTIFF per response
+                            identifier (or a single tif), filled with zeros,
+                            with the band count and sample type of the
+                            matching output in the evalscript
+    POST /api/v1/statistics returns server.statistics_response if set,
+                            otherwise made up statistics for every band of
+                            every output of the evalscript and every
+                            aggregation interval of the time range
+    POST /api/v2/batch/process
+                            creates a batch job; .../<id>/start runs it:
+                            after server.batch_delay s one tif per output
+                            and tile of a batch_tile_size grid (UTM) is
+                            written below server.object_store, tile n
+                            filled with n + 1 or server.batch_fill[output]
+    GET  /api/v2/batch/process/<id>
+                            returns the batch job and its status
+    POST /api/stac/v1/search returns server.stac_items, page by page
+    GET  /files/<path>      serves the files below server.static_root,
+                            with single byte ranges ("Range: bytes=a-b"),
+                            HEAD for their size and ETag (as GDAL's
+                            /vsicurl/ and range_cache.py ask);
+                            with require_signature only with an unexpired
+                            "se=<unix time>" in the query string
+    GET  /api/sas/v1/token/<account>/<container>
+                            returns a SAS token valid for server.token_ttl s
+"""
+import datetime as dt
+import http.server
+import io
+import json
+import os
+import pathlib as pl
+import re
+import tarfile
+import urllib.parse
+import threading
+import time
+
+import sentinelhub as sh
+
+
+def make_tif_bytes(width: int, height: int, bands: int = 1, dtype: str = "uint16",
+                   bbox=None, crs_epsg=None, fill=0):
+    """
+    Write an in-memory GeoTIFF of the given size filled with fill.
+    If a bbox (minx, miny, maxx, maxy) and EPSG code are given, the
+    tif is georeferenced accordingly.
+    """
+    import numpy as np
+    import rasterio as rio
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_bounds
+
+    profile = {
+        "driver": "GTiff", "width": width, "height": height,
+        "count": bands, "dtype": dtype,
+    }
+    if bbox is not None:
+        profile["transform"] = from_bounds(*bbox, width, height)
+        profile["crs"] = rio.crs.CRS.from_epsg(crs_epsg)
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dataset:
+            dataset.write(np.full((bands, height, width), fill, dtype=dtype))
+        return memfile.read()
+
+
+def make_tar_bytes(members: dict):
+    """
+    Pack a dict of {member name: bytes} into an uncompressed tar,
+    the same format the Process API uses for multi-response requests.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+"""
+{ id: "B01", bands: 1, sampleType: "UINT16" } in the output section of
+an evalscript
+"""
+OUTPUT_PATTERN = re.compile(
+    r'id\s*:\s*"(?P<id>[^"]+)"\s*,\s*bands\s*:\s*(?P<bands>\d+)'
+    r'(?:\s*,\s*sampleType\s*:\s*"(?P<sample_type>\w+)")?')
+
+
+"""
+var DATES = ["2024-05-01", ...]; in a multi-temporal (ORBIT) evalscript
+"""
+DATES_PATTERN = re.compile(r"var DATES = (\[[^\]]*\]);")
+
+
+def evalscript_outputs(evalscript: str):
+    """
+    {output id: (bands, numpy dtype)} of the outputs an evalscript
+    declares. Outputs without sampleType are AUTO, i.e. uint8.
+    """
+    return {
+        match["id"]: (int(match["bands"]), (match["sample_type"] or "UINT8").lower())
+        for match in OUTPUT_PATTERN.finditer(evalscript)
+    }
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler for StubServer. Routes are looked up in
+    server.routes, a dict of {(method, path prefix): callable}.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, payload, headers=None):
+        self.send_body(status, json.dumps(payload).encode(), "application/json", headers)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length)
+
+    def dispatch(self, method: str):
+        for (route_method, prefix), route in self.server.routes.items():
+            if route_method == method and self.path.startswith(prefix):
+                self.server.count(prefix)
+                return route(self)
+        self.send_json(404, {"error": f"no stub route for {method} {self.path}"})
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_HEAD(self):
+        self.dispatch("HEAD")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+
+def token_route(handler: StubHandler):
+    handler.read_body()
+    handler.send_json(200, {
+        "access_token": "stub-token",
+        "token_type": "Bearer",
+        "expires_in": 3600,
+        "expires_at": time.time() + 3600,
+    })
+
+
+def process_route(handler: StubHandler):
+    """
+    Answer a Process API request. Output size, bbox and response
+    identifiers are taken from the request payload. Every n-th request
+    is answered with a 503 if the server was started with fail_every=n.
+    """
+    server = handler.server
+    payload = json.loads(handler.read_body())
+    if server.latency:
+        time.sleep(server.latency)
+    if server.fail_every and server.requests_seen("/api/v1/process") % server.fail_every == 0:
+        handler.send_json(503, {"error": "service unavailable"})
+        return
+
+    output = payload.get("output", {})
+    width, height = output.get("width", 1), output.get("height", 1)
+    bounds = payload["input"]["bounds"]
+    bbox = bounds.get("bbox")
+    crs = bounds.get("properties", {}).get("crs", "")
+    epsg = int(crs.rsplit("/", 1)[-1]) if crs else None
+    identifiers = [response["identifier"] for response in output.get("responses", [])]
+    evalscript = payload.get("evalscript", "")
+    outputs = evalscript_outputs(evalscript)
+    """
+    Multi-temporal requests get every output once per date of their
+    DATES list, and the dates as userdata.
+    """
+    dates_match = DATES_PATTERN.search(evalscript)
+    dates = json.loads(dates_match[1]) if dates_match else None
+    tifs = {}
+    for identifier in identifiers or ["default"]:
+        if identifier == "userdata":
+            tifs[identifier] = json.dumps({"dates": dates or []}).encode()
+            continue
+        bands, dtype = outputs.get(identifier, (1, "uint16"))
+        tifs[identifier] = make_tif_bytes(width, height, bands * len(dates) if dates else bands, dtype,
+                                          bbox=bbox, crs_epsg=epsg)
+
+    if len(identifiers) > 1:
+        body = make_tar_bytes({f"{identifier}.json" if identifier == "userdata" else f"{identifier}.tif": tif
+                               for identifier, tif in tifs.items()})
+        handler.send_body(200, body, "application/tar")
+    else:
+        handler.send_body(200, next(iter(tifs.values())), "image/tiff")
+
+
+def statistics_route(handler: StubHandler):
+    """
+    Answer a Statistical API request. Without a canned
+    server.statistics_response, band i of every output gets a mean of
+    1000 + 100 * i on every day, with intervals of aggregationInterval
+    (whole days, "P<n>D") between timeRange from and to.
+    """
+    server = handler.server
+    payload = json.loads(handler.read_body())
+    if server.latency:
+        time.sleep(server.latency)
+    if server.fail_every and server.requests_seen("/api/v1/statistics") % server.fail_every == 0:
+        handler.send_json(503, {"error": "service unavailable"})
+        return
+    if server.statistics_response is not None:
+        handler.send_json(200, server.statistics_response)
+        return
+
+    aggregation = payload["aggregation"]
+    start = dt.datetime.fromisoformat(aggregation["timeRange"]["from"].replace("Z", "+00:00"))
+    end = dt.datetime.fromisoformat(aggregation["timeRange"]["to"].replace("Z", "+00:00"))
+    step = dt.timedelta(days=int(re.fullmatch(r"P(\d+)D", aggregation["aggregationInterval"]["of"])[1]))
+    outputs = {identifier: bands for identifier, (bands, _) in
+               evalscript_outputs(aggregation["evalscript"]).items() if identifier != "dataMask"}
+    data = []
+    while start + step <= end + dt.timedelta(seconds=1):
+        data.append({
+            "interval": {"from": start.isoformat().replace("+00:00", "Z"),
+                         "to": (start + step).isoformat().replace("+00:00", "Z")},
+            "outputs": {identifier: {"bands": {f"B{band}": {"stats": {
+                "min": 0.0, "max": 2000.0 + 100 * band, "mean": 1000.0 + 100 * band, "stDev": 50.0,
+                "sampleCount": 100, "noDataCount": 0,
+            }} for band in range(bands)}} for identifier, bands in outputs.items()},
+        })
+        start += step
+    handler.send_json(200, {"data": data, "status": "OK"})
+
+
+def run_batch_job(server, job: dict):
+    """
+    "Process" a batch job: cover the bounds of its geometry with tiles of
+    server.batch_tile_size m in the UTM zone of its center and write
+    every output of every tile into server.object_store, tile n filled
+    with n + 1, or with server.batch_fill[output id] if given.
+    s3://bucket/key goes to object_store/bucket/key.
+    """
+    import pyproj
+    import shapely
+    import shapely.geometry
+
+    time.sleep(server.batch_delay)
+    payload = job["request"]
+    process_request = payload["processRequest"]
+    geometry = shapely.geometry.shape(process_request["input"]["bounds"]["geometry"])
+    zone = int((geometry.centroid.x + 180) // 6) + 1
+    epsg = (32600 if geometry.centroid.y >= 0 else 32700) + zone
+    transformer = pyproj.Transformer.from_crs(4326, epsg, always_xy=True)
+    geometry = shapely.transform(geometry, transformer.transform, interleaved=False)
+    resolution = payload["input"]["resolution"]
+    size = server.batch_tile_size
+    outputs = evalscript_outputs(process_request["evalscript"])
+    url = payload["output"]["delivery"]["s3"]["url"]
+
+    minx, miny, maxx, maxy = geometry.bounds
+    tiles = [(x, y) for x in range(int(minx // size), int(maxx // size) + 1)
+             for y in range(int(miny // size), int(maxy // size) + 1)
+             if shapely.box(x * size, y * size, (x + 1) * size, (y + 1) * size).intersects(geometry)]
+    for index, (x, y) in enumerate(tiles):
+        bbox = (x * size, y * size, (x + 1) * size, (y + 1) * size)
+        for identifier, (bands, dtype) in outputs.items():
+            tile_url = (url.replace("<requestId>", job["id"]).replace("<tileName>", f"{zone}_{x}_{y}")
+                        .replace("<outputId>", identifier))
+            path = server.object_store.joinpath(*tile_url.removeprefix("s3://").split("/"))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(make_tif_bytes(round(size / resolution), round(size / resolution), bands,
+                                            dtype, bbox, epsg, fill=server.batch_fill.get(identifier, index + 1)))
+    job.update(status="DONE", completionPercentage=100)
+
+
+def batch_route(handler: StubHandler):
+    """
+    Create (POST .../process), start (POST .../process/<id>/start) and
+    look at (GET .../process/<id>) batch jobs.
+    """
+    server = handler.server
+    body = handler.read_body()
+    parts = handler.path.split("?")[0].rstrip("/").split("/")[5:]
+    if not parts:
+        job = {"id": f"stub-batch-{len(server.batch_jobs) + 1}", "request": json.loads(body),
+               "domainAccountId": "stub", "status": "CREATED", "completionPercentage": 0}
+        server.batch_jobs[job["id"]] = job
+        handler.send_json(201, job)
+        return
+    job = server.batch_jobs.get(parts[0])
+    if job is None:
+        handler.send_json(404, {"error": f"no batch job {parts[0]}"})
+        return
+    if parts[1:] == ["start"]:
+        job["status"] = "PROCESSING"
+        threading.Thread(target=run_batch_job, args=(server, job), daemon=True).start()
+        handler.send_body(204, b"", "application/json")
+        return
+    handler.send_json(200, job)
+
+
+def stac_search_route(handler: StubHandler):
+    """
+    Answer a STAC item search with the items in server.stac_items (no
+    filtering), limit items per page. The "next" link carries the
+    offset of the next page as token in the POST body.
+    """
+    server = handler.server
+    payload = json.loads(handler.read_body() or b"{}")
+    if server.latency:
+        time.sleep(server.latency)
+    limit = int(payload.get("limit", 100))
+    offset = int(payload.get("token") or 0)
+    features = server.stac_items[offset:offset + limit]
+    links = []
+    if offset + limit < len(server.stac_items):
+        links.append({
+            "rel": "next", "href": server.url + "/api/stac/v1/search", "method": "POST",
+            "body": {**payload, "token": str(offset + limit)}, "merge": False,
+        })
+    handler.send_json(200, {"type": "FeatureCollection", "features": features, "links": links})
+
+
+def static_route(handler: StubHandler):
+    """
+    Serve a file below server.static_root. A "Range: bytes=start-end"
+    header is answered with 206 and only those bytes, like a blob store
+    serving COGs.
+    """
+    server = handler.server
+    path = pl.Path(server.static_root).joinpath(handler.path.split("?")[0][len("/files/"):])
+    if server.latency:
+        time.sleep(server.latency)
+    if server.require_signature:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query)
+        if float(query.get("se", ["0"])[0]) < time.time():
+            handler.send_json(403, {"error": "AuthenticationFailed: signature missing or expired"})
+            return
+    if not path.is_file():
+        handler.send_json(404, {"error": f"no such file {handler.path}"})
+        return
+    stat = path.stat()
+    size = stat.st_size
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+    if handler.command == "HEAD":
+        handler.send_response(200)
+        handler.send_header("Content-Type", "image/tiff")
+        handler.send_header("Content-Length", str(size))
+        handler.send_header("Accept-Ranges", "bytes")
+        handler.send_header("ETag", etag)
+        handler.end_headers()
+        return
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", handler.headers.get("Range", ""))
+    with open(path, "rb") as file:
+        if match is None:
+            handler.send_body(200, file.read(), "image/tiff", {"Accept-Ranges": "bytes", "ETag": etag})
+            return
+        start = int(match.group(1) or 0)
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        file.seek(start)
+        body = file.read(max(end - start + 1, 0))
+    handler.send_body(206, body, "image/tiff", {
+        "Accept-Ranges": "bytes", "Content-Range": f"bytes {start}-{end}/{size}", "ETag": etag})
+
+
+def sas_token_route(handler: StubHandler):
+    """
+    Answer a token request like the Planetary Computer SAS endpoint,
+    with a token that expires after server.token_ttl seconds.
+    """
+    server = handler.server
+    expiry = time.time() + server.token_ttl
+    handler.send_json(200, {
+        "msft:expiry": dt.datetime.fromtimestamp(expiry, dt.timezone.utc).isoformat().replace("+00:00", "Z"),
+        "token": f"se={expiry:.3f}&sig=stub{server.requests_seen('/api/sas/v1/token/')}",
+    })
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    Threaded local HTTP server with the stub routes registered. Use it as
+    a context manager; the server runs in a background thread on a free
+    port and url holds its base address. static_root is the folder
+    served under /files/, stac_items the STAC items (dicts) returned by
+    the search endpoint. With require_signature the files are only served
+    with a token from the SAS endpoint, which expires after token_ttl s.
+    statistics_response is the canned answer of the statistics endpoint.
+    Batch jobs deliver their tiles into the folder object_store;
+    batch_fill ({output id: value}) fixes the values of their outputs.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency: float = 0.0, fail_every: int = 0,
+                 static_root: pl.Path = None, stac_items: list = None,
+                 require_signature: bool = False, token_ttl: float = 3600.0,
+                 statistics_response: dict = None, object_store: pl.Path = None,
+                 batch_delay: float = 0.5, batch_tile_size: float = 10000, batch_fill: dict = None):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.static_root = static_root
+        self.stac_items = stac_items or []
+        self.require_signature = require_signature
+        self.token_ttl = token_ttl
+        self.statistics_response = statistics_response
+        self.object_store = pl.Path(object_store) if object_store else None
+        self.batch_delay = batch_delay
+        self.batch_tile_size = batch_tile_size
+        self.batch_fill = batch_fill or {}
+        self.batch_jobs = {}
+        self.counts = {}
+        self.count_lock = threading.Lock()
+        self.routes = {
+            ("POST", "/oauth/token"): token_route,
+            ("POST", "/api/v1/process"): process_route,
+            ("POST", "/api/v1/statistics"): statistics_route,
+            ("POST", "/api/v2/batch/process"): batch_route,
+            ("GET", "/api/v2/batch/process"): batch_route,
+            ("POST", "/api/stac/v1/search"): stac_search_route,
+            ("GET", "/files/"): static_route,
+            ("HEAD", "/files/"): static_route,
+            ("GET", "/api/sas/v1/token/"): sas_token_route,
+        }
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, prefix: str):
+        with self.count_lock:
+            self.counts[prefix] = self.counts.get(prefix, 0) + 1
+
+    def requests_seen(self, prefix: str):
+        with self.count_lock:
+            return self.counts.get(prefix, 0)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def stub_config(server: StubServer):
+    """
+    Create an SHConfig pointing at a running StubServer. oauthlib refuses
+    plain http token urls unless OAUTHLIB_INSECURE_TRANSPORT is set.
+    """
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    config = sh.SHConfig()
+    config.sh_client_id = "stub-client"
+    config.sh_client_secret = "stub-secret"
+    config.sh_base_url = server.url
+    config.sh_token_url = server.url + "/oauth/token"
+    config.max_download_attempts = 1
+    return config
+
+
+def stub_collection(server: StubServer, collection=sh.DataCollection.SENTINEL2_L2A):
+    """
+    The predefined data collections are bound to the url of their
+    service, which takes precedence over config.sh_base_url. This returns
+    a copy of the collection bound to the stub instead.
+    """
+    name = f"{collection.name}_STUB_{server.server_address[1]}"
+    return collection.define_from(name, service_url=server.url)
@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+import rasterio as rio
+import sentinelhub as sh
+import shapely
+
+import band_registry as br
+import batch_jobs as bj
+import stub_api
+
+OUTPUT_URL = "s3://bucket/jobs"
+
+
+def make_target(tmp_path, x, date_str, size=500):
+    bbox = sh.BBox((x, 5360000, x + size, 5360000 + size), crs=sh.CRS(32632))
+    return bj.BatchTarget(bbox, bbox.geometry, tmp_path / "out" / f"feld_{x}" / date_str, f"S2_{date_str}_")
+
+
+def run(tmp_path, targets_per_date, layout, **kwargs):
+    with stub_api.StubServer(object_store=tmp_path / "store", batch_delay=0.1, batch_tile_size=2000,
+                             **kwargs) as server:
+        config = stub_api.stub_config(server)
+        written = bj.run_batch_job(targets_per_date, layout, config, bj.LocalObjectStore(tmp_path / "store"),
+                                   OUTPUT_URL, poll_interval=0.05, credentials={"iam_role_arn": "stub"})
+        return written, server
+
+
+def test_one_job_for_all_dates(tmp_path):
+    layout = br.stacked_layout(["B04", "B08", "SCL"])
+    targets_per_date = {
+        "2024-05-03": [make_target(tmp_path, 690000, "2024-05-03")],
+        "2024-05-01": [make_target(tmp_path, 690000, "2024-05-01"), make_target(tmp_path, 693000, "2024-05-01")],
+    }
+    written, server = run(tmp_path, targets_per_date, layout)
+
+    assert list(server.batch_jobs) == ["stub-batch-1"]
+    job = server.batch_jobs["stub-batch-1"]
+    assert job["status"] == "DONE"
+    payload = job["request"]
+    assert payload["input"] == {"type": "tiling-grid", "id": bj.TILING_GRID, "resolution": 10}
+    assert payload["output"]["delivery"]["s3"]["url"] == f"{OUTPUT_URL}/{bj.TILE_PATH}"
+    assert payload["output"]["delivery"]["s3"]["iamRoleARN"] == "stub"
+    assert payload["output"]["type"] == "raster" and payload["output"]["cogOutput"] is True
+    time_range = payload["processRequest"]["input"]["data"][0]["dataFilter"]["timeRange"]
+    assert time_range["from"].startswith("2024-05-01") and time_range["to"].startswith("2024-05-03")
+    evalscript = payload["processRequest"]["evalscript"]
+    assert json.dumps(["2024-05-01", "2024-05-03"]) in evalscript
+    assert stub_api.evalscript_outputs(evalscript) == {
+        "bands": (4, "uint16"), "quality": (2, "uint8"), "coverage": (2, "uint8")}
+
+    assert len(written) == 3
+    for target in [target for targets in targets_per_date.values() for target in targets]:
+        files = written[target.folder]
+        assert [file.path.name for file in files] == [f"{target.prefix}bands.tif", f"{target.prefix}quality.tif"]
+        with rio.open(files[0].path) as dataset:
+            assert dataset.count == 2 and dataset.crs.to_epsg() == 32632
+            assert (dataset.width, dataset.height) == (50, 50)
+            assert np.all(dataset.read() > 0)
+    assert not any(path.name.endswith(".part") for path in tmp_path.joinpath("out").rglob("*"))
+
+
+def test_fields_in_another_utm_zone_are_warped(tmp_path):
+    layout = br.single_band_layout(["B04"])
+    near = make_target(tmp_path, 690000, "2024-05-01")
+    bbox = sh.BBox((300000, 5360000, 300500, 5360500), crs=sh.CRS(32633))
+    other_zone = bj.BatchTarget(bbox, shapely.box(*bbox), tmp_path / "out" / "feld_33" / "2024-05-01", "S2_")
+    written, _ = run(tmp_path, {"2024-05-01": [near, other_zone]}, layout)
+    assert set(written) == {near.folder, other_zone.folder}
+    with rio.open(written[other_zone.folder][0].path) as dataset:
+        assert dataset.crs.to_epsg() == 32633 and (dataset.width, dataset.height) == (50, 50)
+        assert (dataset.read() > 0).mean() > 0.9
+
+
+def test_all_zero_categorical_bands_are_kept(tmp_path):
+    """
+    CLM 0 is "clear": a cut of only zeros is data as long as dataMask
+    covers the field.
+    """
+    target = make_target(tmp_path, 690000, "2024-05-01")
+    written, _ = run(tmp_path, {"2024-05-01": [target]}, br.single_band_layout(["CLM"]), batch_fill={"CLM": 0})
+    with rio.open(written[target.folder][0].path) as dataset:
+        assert dataset.nodata is None and not dataset.read().any()
+
+
+def test_dates_without_coverage_are_left_out(tmp_path):
+    target = make_target(tmp_path, 690000, "2024-05-01")
+    written, _ = run(tmp_path, {"2024-05-01": [target]}, br.single_band_layout(["B04"]), batch_fill={"coverage": 0})
+    assert written == {}
+    assert not target.folder.exists()
+
+
+def test_nothing_to_do():
+    assert bj.run_batch_job({}, br.single_band_layout(["B04"]), None, None, OUTPUT_URL) == {}
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+import rasterio as rio
+import sentinelhub as sh
+
+import band_registry as br
+import bbox_tiling as bt
+import stub_api
+
+
+def make_bbox(width, height, resolution=10):
+    return sh.BBox((690000, 5360000, 690000 + width * resolution, 5360000 + height * resolution),
+                   crs=sh.CRS(32632))
+
+
+def test_tiles_share_the_pixel_grid_of_the_bbox():
+    bbox = make_bbox(5010, 2400)
+    tiles = bt.split_bbox(bbox, 10)
+    assert [(tile.col_off, tile.row_off, tile.width, tile.height) for tile in tiles] == [
+        (0, 0, 1670, 2400), (1670, 0, 1670, 2400), (3340, 0, 1670, 2400)]
+    for tile in tiles:
+        assert tile.bbox.min_x == bbox.min_x + tile.col_off * 10
+        assert tile.bbox.max_y == bbox.max_y - tile.row_off * 10
+        assert tile.bbox.max_x - tile.bbox.min_x == tile.width * 10
+        assert tile.bbox.max_y - tile.bbox.min_y == tile.height * 10
+
+
+def test_last_tiles_take_the_remainder():
+    tiles = bt.split_bbox(make_bbox(7, 5), 10, max_pixels=3)
+    assert sum(tile.width * tile.height for tile in tiles) == 35
+    assert [(tile.width, tile.height) for tile in tiles[-3:]] == [(3, 2), (3, 2), (1, 2)]
+    assert not bt.needs_split((2500, 2500)) and bt.needs_split((2501, 10))
+
+
+def make_request_for(server, layout):
+    config = stub_api.stub_config(server)
+    collection = stub_api.stub_collection(server)
+
+    def make_request(tile_bbox, tile_size):
+        return sh.SentinelHubRequest(
+            evalscript=layout.evalscript(),
+            input_data=[sh.SentinelHubRequest.input_data(data_collection=collection,
+                                                         time_interval=("2024-05-01", "2024-05-01"))],
+            responses=layout.responses(),
+            bbox=tile_bbox,
+            size=tile_size,
+            config=config
+        )
+    return make_request
+
+
+def test_tiles_are_mosaicked_into_one_file_per_output(tmp_path, monkeypatch):
+    layout = br.single_band_layout(["B04", "SCL"])
+    bbox = make_bbox(70, 50)
+    lock = threading.Lock()
+    in_flight = []
+    held = [0]
+    download_response = bt.rw.download_response
+    add = bt.Mosaic.add
+
+    def counting_download(request):
+        content = download_response(request)
+        with lock:
+            held[0] += 1
+            in_flight.append(held[0])
+        return content
+
+    def counting_add(self, tile, content, single_name):
+        time.sleep(0.02)
+        add(self, tile, content, single_name)
+        with lock:
+            held[0] -= 1
+
+    monkeypatch.setattr(bt.rw, "download_response", counting_download)
+    monkeypatch.setattr(bt.Mosaic, "add", counting_add)
+    with stub_api.StubServer() as server:
+        written = bt.download_tiled(make_request_for(server, layout), bbox, 10, tmp_path, prefix="S2_",
+                                    max_workers=2, max_pixels=20)
+        assert server.requests_seen("/api/v1/process") == 12
+
+    assert max(in_flight) <= 2
+    assert sorted(file.path.name for file in written) == ["S2_B04.tif", "S2_SCL.tif"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["S2_B04.tif", "S2_SCL.tif"]
+    with rio.open(tmp_path / "S2_SCL.tif") as dataset:
+        assert (dataset.width, dataset.height, dataset.dtypes[0]) == (70, 50, "uint8")
+        assert dataset.transform.c == bbox.min_x and dataset.transform.f == bbox.max_y
+
+
+def test_failed_tile_leaves_no_part_files(tmp_path):
+    layout = br.single_band_layout(["B04"])
+    with stub_api.StubServer() as server:
+        make_request = make_request_for(server, layout)
+
+        def failing_request(tile_bbox, tile_size):
+            if tile_bbox.min_x > 690000:
+                raise RuntimeError("tile failed")
+            return make_request(tile_bbox, tile_size)
+
+        with pytest.raises(RuntimeError):
+            bt.download_tiled(failing_request, make_bbox(40, 20), 10, tmp_path, prefix="S2_",
+                              max_workers=1, max_pixels=20)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,78 @@
+import datetime as dt
+
+import sentinelhub as sh
+import shapely
+import shapely.geometry
+
+import catalog_cache as cc
+import field_clusters as fc
+
+FIELDS = {"include": ["id", "properties.datetime", "geometry"], "exclude": []}
+
+
+class FakeCatalog:
+    """
+    Returns one scene per day, with a footprint of the tile it was
+    created with (WGS84), and records every search.
+    """
+
+    def __init__(self, footprint):
+        self.footprint = shapely.geometry.mapping(footprint)
+        self.searches = []
+
+    def search(self, collection, bbox, time, filter=None, fields=None):
+        self.searches.append((bbox, time))
+        first, last = (dt.date.fromisoformat(value) for value in time)
+        day = first
+        while day <= last:
+            yield {"id": f"S2_{day}", "properties": {"datetime": f"{day}T10:00:00Z"},
+                   "geometry": self.footprint}
+            day += dt.timedelta(days=1)
+
+
+def utm_bbox(x, y, size=500):
+    return sh.BBox((x, y, x + size, y + size), crs=sh.CRS(32632))
+
+
+def test_adding_a_field_keeps_the_cache_of_the_others(tmp_path):
+    cache = cc.CatalogCache(tmp_path / "cache.sqlite", recent_days=0)
+    catalog = FakeCatalog(shapely.box(10, 47, 12, 49))
+    fields = [utm_bbox(690000, 5360000), utm_bbox(691000, 5360000)]
+    clusters = fc.cluster_fields(fields)
+    search = lambda bboxes: cache.search_fields(catalog, "S2L2A", bboxes, ("2024-05-01", "2024-05-03"),
+                                                fields=FIELDS)
+    scenes = fc.search_fields_by_cluster(clusters, search)
+    assert len(catalog.searches) == 1
+    assert [len(scenes[index]) for index in range(2)] == [3, 3]
+
+    fields.append(utm_bbox(692000, 5360000))
+    clusters = fc.cluster_fields(fields)
+    assert len(clusters) == 1
+    scenes = fc.search_fields_by_cluster(clusters, search)
+    assert len(catalog.searches) == 2
+    assert catalog.searches[-1][0] == fields[2]
+    assert [len(scenes[index]) for index in range(3)] == [3, 3, 3]
+
+    fc.search_fields_by_cluster(fc.cluster_fields(fields[1:]), search)
+    assert len(catalog.searches) == 2
+
+
+def test_only_missing_days_are_searched(tmp_path):
+    cache = cc.CatalogCache(tmp_path / "cache.sqlite", recent_days=0)
+    catalog = FakeCatalog(shapely.box(10, 47, 12, 49))
+    bbox = utm_bbox(690000, 5360000)
+    cache.search(catalog, "S2L2A", bbox, ("2024-05-02", "2024-05-03"), fields=FIELDS)
+    features = cache.search(catalog, "S2L2A", bbox, ("2024-05-01", "2024-05-05"), fields=FIELDS)
+    assert [time for _, time in catalog.searches] == [("2024-05-02", "2024-05-03"), ("2024-05-01", "2024-05-01"),
+                                                      ("2024-05-04", "2024-05-05")]
+    assert [feature["id"] for feature in features] == [f"S2_2024-05-0{day}" for day in range(1, 6)]
+
+
+def test_features_outside_a_field_are_not_stored_for_it(tmp_path):
+    cache = cc.CatalogCache(tmp_path / "cache.sqlite", recent_days=0)
+    far_away = sh.BBox((300000, 5360000, 300500, 5360500), crs=sh.CRS(32632))
+    catalog = FakeCatalog(sh.Geometry(utm_bbox(690000, 5360000, 2000).geometry, sh.CRS(32632))
+                          .transform(sh.CRS.WGS84).geometry)
+    near, far = cache.search_fields(catalog, "S2L2A", [utm_bbox(690500, 5360500), far_away],
+                                    ("2024-05-01", "2024-05-01"), fields=FIELDS)
+    assert len(near) == 1 and far == []
@@ -0,0 +1,29 @@
+import sys
+import types
+
+import numpy as np
+from rasterio.transform import from_origin
+
+import cloud_masks as cm
+
+
+def test_small_atlas_is_padded_to_the_minimum_patch_size(monkeypatch):
+    calls = []
+
+    def predict_from_array(array, patch_size, patch_overlap, **kwargs):
+        calls.append((array.shape, patch_size, patch_overlap))
+        return np.ones((1, *array.shape[1:]), dtype=np.float32)
+
+    monkeypatch.setitem(sys.modules, "omnicloudmask", types.SimpleNamespace(predict_from_array=predict_from_array))
+    data = np.full((3, 12, 20), 500, dtype=np.uint16)
+    data[:, 0, 0] = 0
+    area = cm.Area([], data, from_origin(690000, 5360120, 10, 10))
+    shape, areas = cm.pack_areas([area], padding=4)[0]
+    assert shape == (16, 24)
+
+    [mask] = cm.predict_atlas(shape, areas)
+    [(atlas_shape, patch_size, patch_overlap)] = calls
+    assert atlas_shape == (3, cm.MIN_PATCH_SIZE, cm.MIN_PATCH_SIZE)
+    assert patch_size == cm.MIN_PATCH_SIZE and patch_overlap < patch_size
+    assert mask.shape == (12, 20)
+    assert mask[0, 0] == cm.NODATA and (mask[1:] == 1).all()
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import sentinelhub as sh
+import shapely
+from rasterio.transform import from_origin
+
+import band_registry as br
+import cloud_precheck as cp
+import stub_api
+
+
+def make_candidate(field_key, date_str="2024-05-01"):
+    bbox = sh.BBox((690000, 5360000, 690600, 5360600), crs=sh.CRS(32632))
+    return cp.Candidate(field_key, date_str, "S2A_" + date_str, bbox, bbox.geometry, (60, 60))
+
+
+def test_valid_fraction_inside_the_field():
+    scl = np.full((10, 10), 4, np.uint8)
+    clm = np.zeros((10, 10), np.uint8)
+    data_mask = np.ones((10, 10), np.uint8)
+    scl[:, :3] = 9
+    clm[0, :] = 1
+    data_mask[:, 9] = 0
+    field = shapely.box(690000, 5359400, 690600, 5360000)
+    fraction = cp.valid_fraction(np.stack([scl, clm, data_mask]), from_origin(690000, 5360000, 60, 60), field)
+    assert fraction == pytest.approx(6 * 9 / 100)
+    outside = shapely.box(700000, 5359400, 700600, 5360000)
+    assert cp.valid_fraction(np.stack([scl, clm, data_mask]), from_origin(690000, 5360000, 60, 60), outside) == 0.0
+
+
+def test_processing_units():
+    assert cp.processing_units((512, 512), 3) == 1.0
+    assert cp.processing_units((10, 10), 3) == 0.01
+    assert cp.processing_units((1024, 512), 6, float32=True) == 8.0
+    layout = br.stacked_layout(["B02", "B03", "B04", "SCL"])
+    assert cp.layout_processing_units((512, 512), layout) == pytest.approx(4 / 3)
+    assert cp.layout_bytes((10, 10), layout) == 100 * (3 * 2 + 1)
+
+
+def run_check(server, path, candidates, layout, **kwargs):
+    precheck = cp.CloudPrecheck(path, stub_api.stub_config(server), max_threads=2,
+                                data_collection=stub_api.stub_collection(server), **kwargs)
+    return precheck.check(candidates, layout)
+
+
+def test_clouded_dates_are_dropped_and_remembered(tmp_path):
+    """
+    The stub answers with zeros: no data anywhere, so nothing is valid.
+    """
+    layout = br.single_band_layout(["B04", "B08"])
+    candidates = [make_candidate("feld_a"), make_candidate("feld_b")]
+    with stub_api.StubServer() as server:
+        keep, report = run_check(server, tmp_path / "precheck.jsonl", candidates, layout)
+        assert server.requests_seen("/api/v1/process") == 2
+        assert keep == []
+        assert (report.checked, report.cached, report.dropped, report.failed) == (2, 0, 2, 0)
+        assert report.precheck_units == pytest.approx(2 * 0.01)
+        assert report.saved_units == pytest.approx(2 * 3600 / 512 ** 2 * 2 / 3)
+        assert report.saved_bytes == 2 * 60 * 60 * 4
+        assert "2 of 2 dates dropped" in report.summary()
+
+        candidates.append(make_candidate("feld_a", "2024-05-02"))
+        keep, report = run_check(server, tmp_path / "precheck.jsonl", candidates, layout, min_valid_fraction=0.0)
+        assert server.requests_seen("/api/v1/process") == 3
+        assert len(keep) == 3 and (report.checked, report.cached, report.dropped) == (1, 2, 0)
+
+
+def test_failed_precheck_keeps_the_date(tmp_path):
+    with stub_api.StubServer(fail_every=1) as server:
+        keep, report = run_check(server, tmp_path / "precheck.jsonl", [make_candidate("feld_a")],
+                                 br.single_band_layout(["B04"]))
+    assert [candidate.field_key for candidate in keep] == ["feld_a"]
+    assert report.failed == 1 and report.dropped == 0
+    assert not (tmp_path / "precheck.jsonl").exists()
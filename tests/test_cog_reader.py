@@ -0,0 +1,56 @@
+import asyncio
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import cog_reader as cr
+
+
+class FileRangeSource:
+    def __init__(self, path):
+        self.data = path.read_bytes()
+        self.requests = []
+
+    async def read(self, start, end):
+        self.requests.append((start, end))
+        return self.data[start:end]
+
+
+def write_cog(path, data, nodata, **options):
+    with rio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                  dtype=data.dtype, crs="EPSG:32632", transform=from_origin(600000, 5400000, 10, 10),
+                  nodata=nodata, tiled=True, blockxsize=256, blockysize=256, **options) as dataset:
+        dataset.write(data, 1)
+
+
+def read(path, window):
+    async def run():
+        reader = await cr.CogReader.open(source)
+        return reader, await reader.read_window(window)
+    source = FileRangeSource(path)
+    reader, data = asyncio.run(run())
+    return reader, data, source
+
+
+def test_tiles_match_rasterio(tmp_path):
+    data = (np.arange(512 * 512, dtype=np.uint16).reshape(512, 512) % 5000) + 1
+    write_cog(tmp_path / "band.tif", data, 0, compress="deflate", predictor=2)
+    reader, window_data, _ = read(tmp_path / "band.tif", Window(100, 200, 300, 250))
+    assert reader.epsg == 32632
+    assert np.array_equal(window_data, data[200:450, 100:400])
+
+
+def test_sparse_tiles_are_nodata(tmp_path):
+    data = np.full((512, 512), 7, dtype=np.uint16)
+    data[:256, :256] = 3
+    with rio.open(tmp_path / "sparse.tif", "w", driver="GTiff", width=512, height=512, count=1, dtype="uint16",
+                  crs="EPSG:32632", transform=from_origin(600000, 5400000, 10, 10), nodata=7,
+                  tiled=True, blockxsize=256, blockysize=256, compress="deflate", sparse_ok=True) as dataset:
+        dataset.write(data[:256, :256], 1, window=Window(0, 0, 256, 256))
+
+    reader, window_data, source = read(tmp_path / "sparse.tif", Window(0, 0, 512, 512))
+    assert reader.info.tile_byte_counts.count(0) == 3
+    assert np.array_equal(window_data, data)
+    assert len(source.requests) == 2
@@ -0,0 +1,61 @@
+import json
+
+import band_registry as br
+import download_manifest as dm
+import response_writer as rw
+
+
+def test_incomplete_lines_are_skipped(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    manifest = dm.DownloadManifest(path)
+    manifest.record("betrieb/feld", "2024-05-01", "S2A", [rw.WrittenFile(tmp_path / "S2A_B04.tif", 10, "00")])
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps({"date": "2024-05-02"}) + "\n")
+        file.write("[1, 2]\n")
+        file.write('{"field": "betrieb/feld", "date": "2024-05-03", "sca')
+
+    manifest = dm.DownloadManifest(path)
+    assert list(manifest.entries) == [("betrieb/feld", "2024-05-01")]
+    assert manifest.get("betrieb/feld", "2024-05-01")["bands"] == ["B04"]
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 1
+
+
+def written_files(tmp_path, scene_id, layout):
+    return [rw.WrittenFile(tmp_path / f"{scene_id}_{file.id}.tif", 10, "00") for file in layout.files]
+
+
+def test_dates_only_count_as_done_for_the_recorded_layout(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    key = ("betrieb/feld", "2024-05-01")
+    first = br.single_band_layout(["B04", "SCL"])
+    dm.DownloadManifest(path, first).record(*key, "S2A", written_files(tmp_path, "S2A", first))
+
+    assert key in dm.DownloadManifest(path, first)
+    assert key in dm.DownloadManifest(path, br.single_band_layout(["B04"]))
+    assert key not in dm.DownloadManifest(path, br.single_band_layout(["B04", "B08"]))
+    assert key not in dm.DownloadManifest(path, br.stacked_layout(["B04", "SCL"]))
+
+    rerun = br.single_band_layout(["B08"])
+    manifest = dm.DownloadManifest(path, rerun)
+    manifest.record(*key, "S2A", written_files(tmp_path, "S2A", rerun))
+    manifest = dm.DownloadManifest(path, br.single_band_layout(["B04", "B08", "SCL"]))
+    assert key in manifest
+    assert manifest.get(*key)["bands"] == ["B04", "SCL", "B08"]
+
+
+def test_stacks_must_hold_the_same_bands(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    key = ("betrieb/feld", "2024-05-01")
+    layout = br.stacked_layout(["B04", "B08", "SCL"])
+    dm.DownloadManifest(path, layout).record(*key, "S2A", written_files(tmp_path, "S2A", layout))
+    assert key in dm.DownloadManifest(path, layout)
+    assert key not in dm.DownloadManifest(path, br.stacked_layout(["B04", "B08", "B11", "SCL"]))
+
+
+def test_entries_without_a_layout_only_cover_single_band_files(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    key = ("betrieb/feld", "2024-05-01")
+    dm.DownloadManifest(path).record(*key, "S2A", [rw.WrittenFile(tmp_path / "S2A_B04.tif", 10, "00"),
+                                                   rw.WrittenFile(tmp_path / "S2A_bands.tif", 10, "00")])
+    assert key in dm.DownloadManifest(path, br.single_band_layout(["B04"]))
+    assert key not in dm.DownloadManifest(path, br.stacked_layout(["B04", "B08"]))
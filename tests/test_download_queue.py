@@ -0,0 +1,159 @@
+import functools
+
+import pytest
+import sentinelhub as sh
+
+import download_queue as dq
+import stub_api
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.response = FakeResponse(status_code, headers)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    The delays the queue waited, without waiting.
+    """
+    delays = []
+    monkeypatch.setattr(dq.time, "sleep", delays.append)
+    return delays
+
+
+def failing(errors, result="ok"):
+    """
+    A job function raising the given exceptions one after another, then
+    returning result.
+    """
+    errors = list(errors)
+
+    def run():
+        if errors:
+            raise errors.pop(0)
+        return result
+    return run
+
+
+def test_fields_are_served_round_robin_in_job_order():
+    order = []
+    jobs = [dq.DownloadJob(field_key, f"{field_key}{index}",
+                           functools.partial(order.append, f"{field_key}{index}"))
+            for field_key, count in (("a", 3), ("b", 1), ("c", 2)) for index in range(count)]
+    stats = dq.run_download_queue(jobs, max_workers=1)
+    assert order == ["a0", "b0", "c0", "a1", "c1", "a2"]
+    assert stats.done == 6 and stats.failed == 0
+
+
+def test_one_job_per_field_at_a_time():
+    running = set()
+    overlaps = []
+
+    def run(field_key):
+        overlaps.append(field_key in running)
+        running.add(field_key)
+        dq.time.sleep(0.01)
+        running.discard(field_key)
+
+    jobs = [dq.DownloadJob(str(index % 2), str(index), functools.partial(run, str(index % 2)))
+            for index in range(8)]
+    dq.run_download_queue(jobs, max_workers=4)
+    assert not any(overlaps)
+
+
+def test_retry_after_is_read_in_milliseconds(sleeps):
+    job = dq.DownloadJob("a", "a", failing([HTTPError(429, {"Retry-After": "2500"})]))
+    assert dq.run_with_backoff(job) == ("ok", 1)
+    assert sleeps == [2.5]
+
+
+def test_exponential_backoff_without_retry_after(sleeps):
+    job = dq.DownloadJob("a", "a", failing([HTTPError(503), HTTPError(429), HTTPError(502)]))
+    assert dq.run_with_backoff(job, backoff_base=1.0) == ("ok", 3)
+    for retry, delay in enumerate(sleeps):
+        assert 0.5 * 2 ** retry <= delay <= 2 ** retry
+
+
+def test_status_code_behind_sentinelhub_exception(sleeps):
+    cause = HTTPError(429, {"Retry-After": "100"})
+    error = sh.exceptions.DownloadFailedException("rate limited", request_exception=cause)
+    job = dq.DownloadJob("a", "a", failing([error]))
+    assert dq.run_with_backoff(job) == ("ok", 1)
+    assert sleeps == [0.1]
+
+
+def test_other_errors_are_not_retried(sleeps):
+    job = dq.DownloadJob("a", "a", failing([HTTPError(400)]))
+    with pytest.raises(HTTPError):
+        dq.run_with_backoff(job)
+    assert sleeps == []
+
+
+def test_gives_up_after_max_retries(sleeps):
+    job = dq.DownloadJob("a", "a", failing([HTTPError(503)] * 3))
+    with pytest.raises(HTTPError):
+        dq.run_with_backoff(job, max_retries=2)
+    assert len(sleeps) == 2
+
+
+def test_failed_job_does_not_stop_its_field(sleeps):
+    errors = []
+    jobs = [dq.DownloadJob("a", "a0", failing([HTTPError(400)])),
+            dq.DownloadJob("a", "a1", failing([]))]
+    done = []
+    stats = dq.run_download_queue(jobs, on_done=lambda job, result: done.append(job.label),
+                                  on_error=lambda job, e: errors.append(job.label))
+    assert errors == ["a0"] and done == ["a1"]
+    assert stats.failed == 1 and stats.done == 1
+
+
+def test_retries_503_from_the_stub():
+    with stub_api.StubServer(fail_every=2) as server:
+        config = stub_api.stub_config(server)
+        collection = stub_api.stub_collection(server)
+        evalscript = """
+function setup() {
+    return { input: [{ bands: ["B02"], units: "DN" }], output: [{ id: "B02", bands: 1, sampleType: "UINT16" }] };
+}
+function evaluatePixel(sample) { return { B02: [sample.B02] }; }
+"""
+
+        def download(date_str):
+            request = sh.SentinelHubRequest(
+                evalscript=evalscript,
+                input_data=[sh.SentinelHubRequest.input_data(data_collection=collection,
+                                                             time_interval=(date_str, date_str))],
+                responses=[sh.SentinelHubRequest.output_response("B02", sh.MimeType.TIFF)],
+                bbox=sh.BBox((690000, 5360000, 690100, 5360100), crs=sh.CRS(32632)),
+                size=(10, 10),
+                config=config
+            )
+            return request.get_data(decode_data=False)[0]
+
+        jobs = [dq.DownloadJob("a", date_str, functools.partial(download, date_str))
+                for date_str in ("2025-06-01", "2025-06-02", "2025-06-03")]
+        stats = dq.run_download_queue(jobs, max_workers=2, backoff_base=0.01)
+    assert stats.done == 3 and stats.failed == 0
+    assert stats.retries >= 1
+
+
+def test_failing_callbacks_do_not_stop_the_queue():
+    def on_done(job, result):
+        if job.label == "a0":
+            raise OSError("disk full")
+
+    def on_error(job, e):
+        raise RuntimeError("broken handler")
+
+    jobs = [dq.DownloadJob("a", "a0", failing([])), dq.DownloadJob("a", "a1", failing([HTTPError(400)])),
+            dq.DownloadJob("a", "a2", failing([])), dq.DownloadJob("b", "b0", failing([]))]
+    stats = dq.run_download_queue(jobs, max_workers=2, on_done=on_done, on_error=on_error)
+    assert stats.done == 2 and stats.failed == 2
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+
+import band_registry as br
+import field_cube as fc
+import output_layouts as ol
+import stub_api
+
+TRANSFORM = from_origin(690000, 5360100, 10, 10)
+
+
+def write_tif(path, data):
+    with rio.open(path, "w", driver="GTiff", width=data.shape[2], height=data.shape[1], count=data.shape[0],
+                  dtype=data.dtype, crs="EPSG:32632", transform=TRANSFORM) as dataset:
+        dataset.write(data)
+    return path
+
+
+def stack(values, dtype):
+    return np.stack([np.full((10, 10), value, dtype) for value in values])
+
+
+def test_dates_and_bands_grow_the_cube(tmp_path):
+    layout = br.stacked_layout(["B04", "B08", "SCL"])
+    cube = fc.FieldCube(tmp_path / "cube.zarr")
+    cube.append_files("2024-05-03", "S2_3", [write_tif(tmp_path / "S2_3_bands.tif", stack([300, 800], np.uint16)),
+                                              write_tif(tmp_path / "S2_3_quality.tif", stack([4], np.uint8))], layout)
+    cube.append_files("2024-05-01", "S2_1", [write_tif(tmp_path / "S2_1_B11.tif", stack([1100], np.uint16))])
+
+    assert cube.dates == ["2024-05-03", "2024-05-01"] and cube.bands == ["B04", "B08", "SCL", "B11"]
+    assert cube.has("2024-05-03", "SCL") and not cube.has("2024-05-01", "SCL") and not cube.has("2024-05-02")
+    assert cube.group["data"].dtype == np.uint16
+
+    data = fc.FieldCube(tmp_path / "cube.zarr").to_xarray()
+    assert [str(date)[:10] for date in data["time"].values] == ["2024-05-01", "2024-05-03"]
+    assert data["scene_id"].values.tolist() == ["S2_1", "S2_3"]
+    assert data.sel(band="B08").values[1].min() == 800 and data.sel(band="SCL").values[1].max() == 4
+    assert data.sel(band="B11").values[0].min() == 1100 and data.sel(band="B04").values[0].max() == 0
+    assert data["x"].values[0] == 690005 and data["y"].values[0] == 5360095
+
+
+def test_float_outputs_are_not_truncated(tmp_path):
+    layout = ol.OutputLayout([ol.OutputFile("ndvi", ["NDVI"], "FLOAT32"), ol.OutputFile("quality", ["SCL"], "UINT8")])
+    cube = fc.FieldCube(tmp_path / "cube.zarr")
+    cube.append_files("2024-05-01", "S2", [write_tif(tmp_path / "S2_quality.tif", stack([4], np.uint8)),
+                                           write_tif(tmp_path / "S2_ndvi.tif", stack([0.25], np.float32))], layout)
+    assert cube.group["data"].dtype == np.float32
+    assert cube.to_xarray().sel(band="NDVI").values.max() == 0.25
+
+    uint16_cube = fc.FieldCube(tmp_path / "uint16.zarr")
+    uint16_cube.append_files("2024-05-01", "S2", [tmp_path / "S2_quality.tif"], layout)
+    with pytest.raises(ValueError, match="float32"):
+        uint16_cube.append_files("2024-05-02", "S2", [tmp_path / "S2_ndvi.tif"], layout)
+
+
+def test_response_members_are_written(tmp_path):
+    layout = br.single_band_layout(["B04", "SCL"])
+    content = stub_api.make_tar_bytes({
+        "B04.tif": stub_api.make_tif_bytes(10, 10, bbox=(690000, 5360000, 690100, 5360100), crs_epsg=32632, fill=400),
+        "SCL.tif": stub_api.make_tif_bytes(10, 10, dtype="uint8", bbox=(690000, 5360000, 690100, 5360100),
+                                           crs_epsg=32632, fill=4),
+    })
+    cube = fc.FieldCube(tmp_path / "cube.zarr")
+    cube.append_response(content, "2024-05-01", "S2", "unused.tif", layout)
+    single = stub_api.make_tif_bytes(10, 10, bbox=(690000, 5360000, 690100, 5360100), crs_epsg=32632, fill=800)
+    cube.append_response(single, "2024-05-02", "S2", "B08.tif", layout)
+    assert cube.bands == ["B04", "SCL", "B08"] and cube.group["data"].dtype == np.uint16
+    assert cube.to_xarray().sel(band="B08").values[1].min() == 800
+
+
+def test_other_grids_are_rejected(tmp_path):
+    cube = fc.FieldCube(tmp_path / "cube.zarr")
+    cube.write_band("2024-05-01", "S2", "B04", np.zeros((10, 10), np.uint16), TRANSFORM, "EPSG:32632")
+    with pytest.raises(ValueError, match="grid"):
+        cube.write_band("2024-05-02", "S2", "B04", np.zeros((10, 12), np.uint16), TRANSFORM, "EPSG:32632")
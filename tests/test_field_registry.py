@@ -0,0 +1,36 @@
+import geopandas as gpd
+import pyproj
+import pytest
+import shapely
+
+import field_registry as fr
+
+FIELD = shapely.box(9.9, 48.3, 9.91, 48.31)
+
+"""
+A transverse mercator without an EPSG code, as some GIS exports write it.
+"""
+CUSTOM_CRS = pyproj.CRS("+proj=tmerc +lat_0=0 +lon_0=10.5 +k=1 +x_0=100000 +y_0=0 +ellps=GRS80 +units=m +no_defs")
+
+
+def write_field(tmp_path, name, crs):
+    path = tmp_path / "betrieb" / f"{name}.shp"
+    path.parent.mkdir(exist_ok=True)
+    gpd.GeoDataFrame(geometry=[FIELD], crs=4326).to_crs(crs).to_file(path)
+    return path
+
+
+@pytest.mark.parametrize("crs", [4326, 4258, "OGC:CRS84", CUSTOM_CRS])
+def test_unprojected_and_custom_crs_are_moved_to_utm(tmp_path, crs):
+    [field] = fr.read_fields([write_field(tmp_path, "feld", crs)], tmp_path).itertuples()
+    assert field.epsg == 32632
+    expected = gpd.GeoSeries([FIELD], crs=4326).to_crs(32632)[0]
+    assert shapely.hausdorff_distance(field.geometry, expected) < 0.5
+    assert (field.width, field.height) == (96, 132)
+
+
+def test_projected_crs_with_a_code_is_kept(tmp_path):
+    [field] = fr.read_fields([write_field(tmp_path, "feld", 25832)], tmp_path).itertuples()
+    assert field.epsg == 25832
+    assert field.key == "betrieb/feld" and field.betrieb == "betrieb"
+    assert (field.max_x - field.min_x) / 10 == field.width
@@ -0,0 +1,91 @@
+import os
+
+import geopandas as gpd
+import shapely
+
+import field_registry as fr
+import field_store as fs
+
+FIELD = shapely.box(9.9, 48.3, 9.91, 48.31)
+
+
+def write_field(tmp_path, name, geometry=FIELD):
+    path = tmp_path / "input" / "betrieb" / f"{name}.shp"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    gpd.GeoDataFrame(geometry=[geometry], crs=4326).to_file(path)
+    return path
+
+
+def open_store(tmp_path, resolution=10):
+    return fs.FieldStore(tmp_path / "fields.parquet", tmp_path / "input", resolution)
+
+
+def no_reads(monkeypatch):
+    def read_fields(*args, **kwargs):
+        raise AssertionError("shapefile read again")
+
+    monkeypatch.setattr(fr, "read_fields", read_fields)
+
+
+def test_unchanged_shapefiles_are_not_read_again(tmp_path, monkeypatch):
+    paths = [write_field(tmp_path, "feld_a"), write_field(tmp_path, "feld_b", shapely.box(9.95, 48.3, 9.96, 48.31))]
+    store = open_store(tmp_path)
+    first = store.get_many(paths)
+    store.save()
+    assert store.counts == {"cached": 0, "hashed": 0, "read": 2}
+    assert gpd.read_parquet(tmp_path / "fields.parquet").crs.to_epsg() == 4326
+
+    no_reads(monkeypatch)
+    store = open_store(tmp_path)
+    second = store.get_many(paths)
+    assert store.counts == {"cached": 2, "hashed": 0, "read": 0} and not store.changed
+    assert [record.key for record in second] == ["betrieb/feld_a", "betrieb/feld_b"]
+    for old, new in zip(first, second):
+        assert (new.epsg, new.betrieb, new.size, new.path) == (old.epsg, old.betrieb, old.size, old.path)
+        assert tuple(new.bbox) == tuple(old.bbox) and new.geometry.equals_exact(old.geometry, 1e-6)
+
+
+def test_touched_shapefiles_only_update_their_stamp(tmp_path, monkeypatch):
+    path = write_field(tmp_path, "feld")
+    store = open_store(tmp_path)
+    store.get_many([path])
+    store.save()
+    for part in fs.shapefile_parts(path):
+        os.utime(part, ns=(part.stat().st_atime_ns, part.stat().st_mtime_ns + 10 ** 9))
+
+    no_reads(monkeypatch)
+    store = open_store(tmp_path)
+    store.get_many([path])
+    store.save()
+    assert store.counts["hashed"] == 1
+    store = open_store(tmp_path)
+    store.get_many([path])
+    assert store.counts["cached"] == 1
+
+
+def test_changed_shapefiles_are_read_again(tmp_path):
+    path = write_field(tmp_path, "feld")
+    store = open_store(tmp_path)
+    [old] = store.get_many([path])
+    store.save()
+    write_field(tmp_path, "feld", shapely.box(9.9, 48.3, 9.92, 48.31))
+
+    store = open_store(tmp_path)
+    [new] = store.get_many([path])
+    assert store.counts["read"] == 1
+    assert new.size[0] > 1.5 * old.size[0] and not new.geometry.equals(old.geometry)
+
+
+def test_other_resolution_uses_the_stored_geometry(tmp_path, monkeypatch):
+    path = write_field(tmp_path, "feld")
+    store = open_store(tmp_path)
+    [old] = store.get_many([path])
+    store.save()
+
+    no_reads(monkeypatch)
+    store = open_store(tmp_path, resolution=20)
+    [new] = store.get_many([path])
+    assert store.counts["cached"] == 1 and store.changed
+    bounds, sizes = fr.field_bounds([old.geometry], 20, fr.BUFFER)
+    assert tuple(new.bbox) == tuple(bounds[0]) and new.size == tuple(sizes[0])
+    assert new.size[0] < old.size[0] and (new.bbox.max_x - new.bbox.min_x) / 20 == new.size[0]
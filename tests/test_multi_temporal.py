@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+import pytest
+import rasterio as rio
+import sentinelhub as sh
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+import band_registry as br
+import multi_temporal as mt
+import stub_api
+
+BBOX = sh.BBox((690000, 5360000, 690100, 5360100), crs=sh.CRS(32632))
+LAYOUT = br.stacked_layout(["B04", "B08", "SCL"])
+
+
+def make_stack(values, dtype):
+    """
+    A 10 x 10 tif with one band per value, each filled with its value.
+    """
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff", width=10, height=10, count=len(values), dtype=dtype,
+                          crs="EPSG:32632", transform=from_origin(690000, 5360100, 10, 10)) as dataset:
+            dataset.write(np.stack([np.full((10, 10), value, dtype) for value in values]))
+        return memfile.read()
+
+
+def make_chunk(tmp_path, dates):
+    return mt.TimeSeriesChunk(BBOX, (10, 10), [mt.DateTarget(date_str, f"S2_{date_str}", tmp_path / date_str)
+                                               for date_str in dates])
+
+
+def test_userdata_dates_become_date_files(tmp_path):
+    """
+    The service had data on 05-01, 05-02 and 05-04; 05-02 was not
+    planned and 05-03 had no acquisition.
+    """
+    dates = ["2024-05-01", "2024-05-02", "2024-05-04"]
+    content = stub_api.make_tar_bytes({
+        "bands.tif": make_stack([100 * day + band for day in (1, 2, 4) for band in (4, 8)], np.uint16),
+        "quality.tif": make_stack([day for day in (1, 2, 4)], np.uint8),
+        "userdata.json": json.dumps({"dates": dates}).encode(),
+    })
+    chunk = make_chunk(tmp_path, ["2024-05-01", "2024-05-03", "2024-05-04"])
+    written = mt.split_response(content, chunk, LAYOUT)
+
+    assert set(written) == {tmp_path / "2024-05-01", tmp_path / "2024-05-04"}
+    assert [file.path.name for file in written[tmp_path / "2024-05-04"]] == [
+        "S2_2024-05-04_bands.tif", "S2_2024-05-04_quality.tif"]
+    with rio.open(tmp_path / "2024-05-04" / "S2_2024-05-04_bands.tif") as dataset:
+        assert dataset.count == 2 and dataset.dtypes[0] == "uint16"
+        assert [int(band.max()) for band in dataset.read()] == [404, 408]
+    with rio.open(tmp_path / "2024-05-01" / "S2_2024-05-01_quality.tif") as dataset:
+        assert dataset.count == 1 and dataset.read(1).max() == 1
+    assert not (tmp_path / "2024-05-02").exists() and not (tmp_path / "2024-05-03").exists()
+    assert not any(path.name.endswith(".part") for path in tmp_path.rglob("*"))
+
+
+def test_band_count_must_match_the_dates(tmp_path):
+    content = stub_api.make_tar_bytes({
+        "bands.tif": make_stack([1, 2, 3], np.uint16),
+        "quality.tif": make_stack([1, 2], np.uint8),
+        "userdata.json": json.dumps({"dates": ["2024-05-01", "2024-05-02"]}).encode(),
+    })
+    with pytest.raises(ValueError, match="bands.tif has 3 bands"):
+        mt.split_response(content, make_chunk(tmp_path, ["2024-05-01", "2024-05-02"]), LAYOUT)
+
+
+def test_chunk_is_downloaded_with_one_request(tmp_path):
+    chunk = make_chunk(tmp_path, ["2024-05-01", "2024-05-02", "2024-05-03"])
+    with stub_api.StubServer() as server:
+        written = mt.download_chunk(chunk, LAYOUT, stub_api.stub_config(server),
+                                    data_collection=stub_api.stub_collection(server))
+        assert server.requests_seen("/api/v1/process") == 1
+    assert set(written) == {target.folder for target in chunk.targets}
+    with rio.open(tmp_path / "2024-05-02" / "S2_2024-05-02_bands.tif") as dataset:
+        assert dataset.count == 2 and (dataset.width, dataset.height) == (10, 10)
+
+
+def test_chunks_follow_the_limits():
+    """
+    A 10 x 10 field of LAYOUT is 500 bytes (2 x uint16 + uint8 per pixel)
+    per date, a 512 x 512 one 1 processing unit (3 input bands).
+    """
+    targets = [mt.DateTarget(f"2024-05-0{day}", f"S2_{day}", None) for day in (5, 1, 3, 2, 4)]
+    chunks = mt.chunk_targets(targets, BBOX, (10, 10), LAYOUT, max_bytes=1000)
+    assert [chunk.dates for chunk in chunks] == [["2024-05-01", "2024-05-02"], ["2024-05-03", "2024-05-04"],
+                                                 ["2024-05-05"]]
+    assert chunks[1].time_interval == ("2024-05-03", "2024-05-04")
+    single = mt.chunk_targets(targets, BBOX, (10, 10), LAYOUT, max_bytes=10)
+    assert [chunk.dates for chunk in single] == [[f"2024-05-0{day}"] for day in range(1, 6)]
+    assert mt.chunk_targets([], BBOX, (10, 10), LAYOUT) == []
+    assert mt.dates_per_request((512, 512), LAYOUT, max_units=3.5) == 3
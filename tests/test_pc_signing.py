@@ -0,0 +1,74 @@
+import asyncio
+import concurrent.futures
+import datetime as dt
+import time
+
+import httpx
+import pytest
+
+import cog_reader as cr
+import pc_signing
+import stub_api
+
+TOKEN_PREFIX = "/api/sas/v1/token/"
+
+
+@pytest.fixture
+def server(tmp_path):
+    (tmp_path / "files").mkdir()
+    (tmp_path / "files" / "band.tif").write_bytes(bytes(range(256)) * 16)
+    with stub_api.StubServer(static_root=tmp_path / "files", require_signature=True) as server:
+        yield server
+
+
+def token_cache(server, **kwargs):
+    return pc_signing.TokenCache(sas_url=server.url + "/api/sas/v1/token", signed_hosts=("127.0.0.1",),
+                                 **kwargs)
+
+
+def test_concurrent_reads_fetch_one_token(server):
+    signer = token_cache(server)
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            source = cr.HttpRangeSource(client, f"{server.url}/files/band.tif", asyncio.Semaphore(8),
+                                        signer.sign_href_async)
+            return await asyncio.gather(*(source.read(start, start + 256) for start in range(0, 4096, 256)))
+
+    chunks = asyncio.run(run())
+    assert b"".join(chunks) == bytes(range(256)) * 16
+    assert server.requests_seen(TOKEN_PREFIX) == 1
+
+
+def test_threads_missing_the_same_token_fetch_it_once(server):
+    signer = token_cache(server)
+    href = f"{server.url}/files/band.tif"
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        signed = set(executor.map(signer.sign_href, [href] * 16))
+    assert len(signed) == 1
+    assert server.requests_seen(TOKEN_PREFIX) == 1
+
+
+def test_token_is_refreshed_ahead_of_expiry(server):
+    server.token_ttl = 5
+    signer = token_cache(server, refresh_margin=dt.timedelta(seconds=10))
+    href = f"{server.url}/files/band.tif"
+    first = asyncio.run(signer.sign_href_async(href))
+    assert asyncio.run(signer.sign_href_async(href)) == first
+    deadline = time.monotonic() + 5
+    while server.requests_seen(TOKEN_PREFIX) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.1)
+    assert server.requests_seen(TOKEN_PREFIX) == 2
+    assert signer.sign_href(href) != first
+
+
+def test_expired_token_is_not_used(server):
+    server.token_ttl = 0.5
+    signer = token_cache(server, refresh_margin=dt.timedelta(0))
+    href = f"{server.url}/files/band.tif"
+    first = signer.sign_href(href)
+    time.sleep(0.6)
+    second = signer.sign_href(href)
+    assert second != first
+    assert httpx.get(second, headers={"Range": "bytes=0-9"}).status_code == 206
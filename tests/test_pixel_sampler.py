@@ -0,0 +1,51 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio as rio
+import shapely
+from rasterio.transform import from_origin
+
+import band_registry as br
+import pixel_sampler as ps
+
+
+def write_tif(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with rio.open(path, "w", driver="GTiff", width=data.shape[2], height=data.shape[1], count=data.shape[0],
+                  dtype=data.dtype, crs="EPSG:32632", transform=from_origin(690000, 5360100, 10, 10)) as dataset:
+        dataset.write(data)
+
+
+def stack(values, dtype):
+    return np.stack([np.full((10, 10), value, dtype) for value in values])
+
+
+def points():
+    return gpd.GeoDataFrame(geometry=[shapely.Point(690005, 5360095), shapely.Point(690095, 5360005),
+                                      shapely.Point(700000, 5360000)], crs=32632)
+
+
+def test_two_stacks_of_one_date_keep_their_columns(tmp_path):
+    for date in ("2024-05-01", "2024-05-02"):
+        write_tif(tmp_path / date / "S2_bands.tif", stack([100, 200], np.uint16))
+        write_tif(tmp_path / date / "S2_quality.tif", stack([4, 9], np.uint8))
+    folders = [tmp_path / "2024-05-01", tmp_path / "2024-05-02"]
+
+    table = ps.sample_stack(points(), folders)
+    assert list(table.columns) == ["point", "date", "bands_B1", "bands_B2", "quality_B1", "quality_B2"]
+    assert len(table) == 6
+    first = table[table["date"] == "2024-05-01"]
+    assert first["bands_B2"].tolist()[:2] == [200, 200] and first["quality_B1"].tolist()[:2] == [4, 4]
+    assert np.isnan(first["quality_B2"].iloc[2])
+
+    layout = br.stacked_layout(["B02", "B03", "SCL", "dataMask"])
+    table = ps.sample_stack(points(), folders, layout=layout)
+    assert list(table.columns) == ["point", "date", "B02", "B03", "SCL", "dataMask"]
+    assert table["B03"].iloc[0] == 200 and table["dataMask"].iloc[0] == 9
+
+
+def test_same_column_from_two_files_raises(tmp_path):
+    write_tif(tmp_path / "2024-05-01" / "S2A_B04.tif", stack([100], np.uint16))
+    write_tif(tmp_path / "2024-05-01" / "S2B_B04.tif", stack([200], np.uint16))
+    with pytest.raises(ValueError, match="B04"):
+        ps.sample_stack(points(), [tmp_path / "2024-05-01"])
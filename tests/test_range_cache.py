@@ -0,0 +1,62 @@
+import asyncio
+import concurrent.futures
+import os
+
+import httpx
+
+import cog_reader as cr
+import range_cache as rc
+import stub_api
+
+
+def read_through(cache, url, start, end):
+    async def run():
+        async with httpx.AsyncClient() as client:
+            source = cr.HttpRangeSource(client, url)
+            return await rc.CachedRangeSource(source, cache).read(start, end), source.requests
+    return asyncio.run(run())
+
+
+def test_blocks_are_served_from_the_cache(tmp_path):
+    (tmp_path / "files").mkdir()
+    (tmp_path / "files" / "band.tif").write_bytes(bytes(range(256)) * 64)
+    cache = rc.RangeCache(tmp_path / "cache.sqlite", block_size=1024)
+    with stub_api.StubServer(static_root=tmp_path / "files") as server:
+        url = f"{server.url}/files/band.tif"
+        data, requests = read_through(cache, url, 1000, 5000)
+        assert data == (bytes(range(256)) * 64)[1000:5000]
+        assert requests == 2  # HEAD + one range
+
+        data, requests = read_through(cache, url, 1500, 3000)
+        assert data == (bytes(range(256)) * 64)[1500:3000]
+        assert requests == 1  # HEAD only
+        assert cache.stats.hits == 2
+
+
+def test_replaced_file_is_not_served_stale(tmp_path):
+    (tmp_path / "files").mkdir()
+    path = tmp_path / "files" / "band.tif"
+    path.write_bytes(b"a" * 4096)
+    cache = rc.RangeCache(tmp_path / "cache.sqlite", block_size=1024)
+    with stub_api.StubServer(static_root=tmp_path / "files") as server:
+        url = f"{server.url}/files/band.tif"
+        assert read_through(cache, url, 0, 2048)[0] == b"a" * 2048
+
+        path.write_bytes(b"b" * 4096)
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        data, requests = read_through(cache, url, 0, 2048)
+        assert data == b"b" * 2048
+        assert requests == 2
+
+
+def test_total_bytes_stays_exact_with_many_writers(tmp_path):
+    cache = rc.RangeCache(tmp_path / "cache.sqlite", max_bytes=60 * 1024, block_size=1024)
+
+    def put(worker):
+        for block in range(20):
+            cache.put_blocks(f"https://host/{worker}.tif", {block: bytes(1024)})
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(put, range(8)))
+    assert cache.total_bytes == cache.stored_bytes() <= 60 * 1024
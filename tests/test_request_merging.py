@@ -0,0 +1,33 @@
+import sentinelhub as sh
+
+import request_merging as rm
+
+
+def utm_bbox(min_x, min_y, max_x, max_y):
+    return sh.BBox((min_x, min_y, max_x, max_y), crs=sh.CRS(32632))
+
+
+def test_overlapping_fields_are_counted_once():
+    """
+    Two identical 1 km bboxes cover 1 km², not 2 km², of a 2 x 1 km merged
+    bbox with a third field at its end: 2/3 (union) against 3/2 (sum).
+    """
+    bboxes = [utm_bbox(0, 0, 1000, 1000), utm_bbox(0, 0, 1000, 1000), utm_bbox(2000, 0, 3000, 1000)]
+    merged = rm.merge_fields(bboxes, min_fill=0.7)
+    assert sorted(map(sorted, (group.members for group in merged))) == [[0, 1], [2]]
+
+
+def test_only_fields_with_the_same_dates_are_merged():
+    bboxes = [utm_bbox(0, 0, 1000, 1000), utm_bbox(1000, 0, 2000, 1000), utm_bbox(0, 1000, 1000, 2000)]
+    dates = [frozenset({"2024-05-01", "2024-05-02"}), frozenset({"2024-05-01"}),
+             frozenset({"2024-05-01", "2024-05-02"})]
+    merged = rm.merge_fields(bboxes, dates=dates)
+    assert sorted(map(sorted, (group.members for group in merged))) == [[0, 2], [1]]
+
+
+def test_fields_with_different_planned_scenes_are_not_merged():
+    bboxes = [utm_bbox(0, 0, 1000, 1000), utm_bbox(1000, 0, 2000, 1000), utm_bbox(0, 1000, 1000, 2000)]
+    dates = [frozenset({("2024-05-01", "S2A_T32UNU")}), frozenset({("2024-05-01", "S2A_T32UPU")}),
+             frozenset({("2024-05-01", "S2A_T32UNU")})]
+    merged = rm.merge_fields(bboxes, dates=dates)
+    assert sorted(map(sorted, (group.members for group in merged))) == [[0, 2], [1]]
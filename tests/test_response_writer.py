@@ -0,0 +1,34 @@
+import sentinelhub as sh
+
+import band_registry as br
+import response_writer as rw
+import stub_api
+
+
+def make_request(layout):
+    return sh.SentinelHubRequest(
+        evalscript=layout.evalscript(),
+        input_data=[sh.SentinelHubRequest.input_data(data_collection=sh.DataCollection.SENTINEL2_L2A,
+                                                     time_interval=("2025-06-01", "2025-06-01"))],
+        responses=layout.responses(),
+        bbox=sh.BBox((690000, 5360000, 690100, 5360100), crs=sh.CRS(32632)),
+        size=(10, 10)
+    )
+
+
+def test_single_response_is_named_after_its_output(tmp_path):
+    for layout in (br.single_band_layout(["B04"]), br.stacked_layout(["B02", "B03"])):
+        request = make_request(layout)
+        content = stub_api.make_tif_bytes(10, 10, len(layout.files[0].bands))
+        written = rw.write_response(content, tmp_path, rw.response_name(request), prefix="S2_")
+        assert [file.path.name for file in written] == [f"S2_{layout.files[0].id}.tif"]
+        assert layout.band_names(written[0].path) == layout.files[0].bands
+
+
+def test_tar_members_keep_their_names(tmp_path):
+    layout = br.single_band_layout(["B04", "SCL"])
+    content = stub_api.make_tar_bytes({"B04.tif": stub_api.make_tif_bytes(10, 10),
+                                       "SCL.tif": stub_api.make_tif_bytes(10, 10, dtype="uint8")})
+    written = rw.write_response(content, tmp_path, rw.response_name(make_request(layout)), prefix="S2_")
+    assert sorted(file.path.name for file in written) == ["S2_B04.tif", "S2_SCL.tif"]
+    assert [name for name, _ in rw.read_response_members(content, "unused.tif")] == ["B04.tif", "SCL.tif"]
@@ -0,0 +1,34 @@
+import sentinelhub as sh
+import shapely
+import shapely.geometry
+
+import band_registry as br
+import scene_planner as sp
+import stub_api
+
+
+def scene(scene_id, footprint, cloud_cover):
+    return {"id": scene_id, "geometry": shapely.geometry.mapping(footprint),
+            "properties": {"datetime": "2024-05-01T10:30:00Z", "eo:cloud_cover": cloud_cover}}
+
+
+def test_scene_covering_the_field_wins_and_pins_its_tile(tmp_path):
+    bbox = sh.BBox((690000, 5360000, 690500, 5360500), crs=sh.CRS(32632))
+    footprint = sh.Geometry(bbox.geometry.buffer(5000), bbox.crs).transform(sh.CRS.WGS84).geometry
+    edge = sh.Geometry(shapely.box(689000, 5360000, 690100, 5360500), bbox.crs).transform(sh.CRS.WGS84).geometry
+    scenes = [scene("S2A_MSIL2A_20240501T102021_N0510_R065_T32UNU_20240501T131005", edge, 1.0),
+              scene("S2A_MSIL2A_20240501T102021_N0510_R065_T32UPU_20240501T131005", footprint, 30.0)]
+    [download] = sp.plan_field("feld", bbox.geometry, bbox, (50, 50), tmp_path, scenes)
+    assert download.scene_id.endswith("T32UPU_20240501T131005") and download.coverage == 1.0
+
+    tile_path = sp.tile_path(download.scene_id)
+    assert tile_path == "/tiles/32/U/PU/"
+    layout = br.stacked_layout(["B04", "B08", "SCL"])
+    evalscript = layout.evalscript(tile_path)
+    assert '"/tiles/32/U/PU/"' in evalscript and 'mosaicking: "TILE"' in evalscript
+    assert stub_api.evalscript_outputs(evalscript) == stub_api.evalscript_outputs(layout.evalscript())
+
+
+def test_ids_without_a_tile_are_not_pinned():
+    assert sp.tile_path("S2A_1") is None and sp.tile_path(None) is None
+    assert sp.tile_path("S2B_MSIL2A_20240501T102021_N0510_R065_T09UXA_20240501T131005") == "/tiles/9/U/XA/"
@@ -0,0 +1,100 @@
+import geopandas as gpd
+import pytest
+import sentinelhub as sh
+import shapely
+from shapely.geometry import mapping
+
+import field_cube as fc
+import sentinelhub_download_script as sds
+import stub_api
+
+FIELDS = [shapely.box(11, 48, 11.005, 48.004), shapely.box(11.006, 48, 11.011, 48.004)]
+DATES = ["2024-05-01", "2024-05-02", "2024-05-03"]
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    """
+    A stub server the script downloads from, with one scene per date of
+    DATES covering both FIELDS. Yields (server, input folder, output
+    folder).
+    """
+    input_folder = tmp_path / "in"
+    output_folder = tmp_path / "out"
+    (input_folder / "betrieb").mkdir(parents=True)
+    output_folder.mkdir()
+    for index, field in enumerate(FIELDS):
+        gpd.GeoDataFrame(geometry=[field], crs=4326).to_file(input_folder / "betrieb" / f"feld{index}.shp")
+    monkeypatch.setenv("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+
+    with stub_api.StubServer() as server:
+        config = stub_api.stub_config(server)
+        collection = stub_api.stub_collection(server)
+        input_data = sh.SentinelHubRequest.input_data
+
+        def stub_input_data(*args, **kwargs):
+            return input_data(*args, **{**kwargs, "data_collection": collection})
+
+        def search(self, data_collection, bbox, time, **kwargs):
+            return [{"id": f"S2A_{date_str}", "geometry": mapping(shapely.box(10, 47, 12, 49)),
+                     "properties": {"datetime": f"{date_str}T10:00:00Z", "eo:cloud_cover": 10}}
+                    for date_str in DATES]
+
+        monkeypatch.setattr(sh, "SHConfig", lambda *args, **kwargs: config)
+        monkeypatch.setattr(sh.SentinelHubRequest, "input_data", staticmethod(stub_input_data))
+        monkeypatch.setattr(sh.SentinelHubCatalog, "search", search)
+        yield server, input_folder, output_folder
+
+
+def script_args(input_folder, output_folder, *argv):
+    return sds.parse_args(["--input", str(input_folder), "--output", str(output_folder),
+                           "--start", DATES[0], "--end", DATES[-1], "--bands", "B04", "SCL", *argv])
+
+
+def test_defaults_come_from_the_constants():
+    args = sds.parse_args([])
+    assert (args.input, args.output, args.start, args.end) == (
+        sds.INPUT_FOLDER, sds.OUTPUT_FOLDER, sds.START_DATE, sds.END_DATE)
+    assert args.bands == sds.BAND_NAMES and args.resolution == sds.RESOLUTION
+    assert not (args.multi_temporal or args.statistics or args.batch)
+
+    args = sds.parse_args(["--bands", "B04", "B08", "--resolution", "20", "--stack-bands", "--batch"])
+    assert args.bands == ["B04", "B08"] and args.resolution == 20.0 and args.stack_bands and args.batch
+
+
+def test_invalid_combinations_are_rejected(monkeypatch):
+    with pytest.raises(SystemExit):
+        sds.parse_args(["--multi-temporal", "--batch"])
+    sds.parse_args(["--cloud-masks", "--write-cube"])
+    monkeypatch.setattr(sds, "KEEP_TIFS", False)
+    with pytest.raises(SystemExit):
+        sds.parse_args(["--cloud-masks", "--write-cube"])
+
+
+def test_downloaded_dates_are_not_requested_again(stub):
+    server, input_folder, output_folder = stub
+    sds.run(script_args(input_folder, output_folder))
+    requests = server.requests_seen("/api/v1/process")
+    assert requests == len(DATES)
+    for field in ("feld0", "feld1"):
+        for date_str in DATES:
+            assert sorted(path.name for path in (output_folder / "betrieb" / field / date_str).iterdir()) == [
+                f"S2A_{date_str}_B04.tif", f"S2A_{date_str}_SCL.tif"]
+
+    sds.run(script_args(input_folder, output_folder))
+    assert server.requests_seen("/api/v1/process") == requests
+
+
+def test_cube_only_run_keeps_foreign_files(stub, monkeypatch):
+    server, input_folder, output_folder = stub
+    monkeypatch.setattr(sds, "KEEP_TIFS", False)
+    notes = output_folder / "betrieb" / "feld0" / DATES[0] / "notes.txt"
+    notes.parent.mkdir(parents=True)
+    notes.write_text("keep me")
+    sds.run(script_args(input_folder, output_folder, "--write-cube"))
+
+    assert notes.read_text() == "keep me"
+    assert list(notes.parent.iterdir()) == [notes]
+    assert not (output_folder / "betrieb" / "feld1" / DATES[0]).exists()
+    cube = fc.FieldCube(output_folder / "betrieb" / "feld1" / sds.CUBE_NAME)
+    assert sorted(cube.dates) == DATES and cube.bands == ["B04", "SCL"]
@@ -0,0 +1,127 @@
+import asyncio
+
+import httpx
+import numpy as np
+import pyproj
+import pytest
+import rasterio as rio
+import shapely
+from rasterio.transform import from_origin
+
+import stac_engine
+import stub_api
+
+ORIGIN = (600000, 5400000)
+SIZE = 1024
+BANDS = ["B02", "B08"]
+
+
+@pytest.fixture(autouse=True)
+def no_sidecar_lookups(monkeypatch):
+    monkeypatch.setenv("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+
+
+def make_cog(path, value):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = (np.arange(SIZE * SIZE, dtype=np.uint16).reshape(SIZE, SIZE) % 1000) + value
+    with rio.open(path, "w", driver="GTiff", width=SIZE, height=SIZE, count=1, dtype="uint16",
+                  crs="EPSG:32632", transform=from_origin(*ORIGIN, 10, 10), nodata=0,
+                  tiled=True, blockxsize=256, blockysize=256, compress="deflate") as dataset:
+        dataset.write(data, 1)
+    return data
+
+
+def field_geometry(x, y, size=300):
+    to_4326 = pyproj.Transformer.from_crs(32632, 4326, always_xy=True)
+    box = shapely.box(ORIGIN[0] + x, ORIGIN[1] - y - size, ORIGIN[0] + x + size, ORIGIN[1] - y)
+    return shapely.transform(box, to_4326.transform, interleaved=False)
+
+
+@pytest.fixture
+def stac(tmp_path):
+    """
+    A stub serving two scenes of two band COGs each, and their items.
+    """
+    cogs = tmp_path / "cogs"
+    data = {(scene, band): make_cog(cogs / f"scene{scene}" / f"{band}.tif", 1000 * (scene + 1) + index)
+            for scene in range(2) for index, band in enumerate(BANDS)}
+    with stub_api.StubServer(static_root=cogs) as server:
+        server.stac_items = [{
+            "type": "Feature", "id": f"scene{scene}",
+            "properties": {"datetime": f"2025-06-0{scene + 1}T10:30:00Z"},
+            "assets": {band: {"href": f"{server.url}/files/scene{scene}/{band}.tif"} for band in BANDS},
+        } for scene in range(2)]
+        yield server, data
+
+
+def make_task(out_folder, name, geometry):
+    return stac_engine.FieldTask(
+        name=name, geometry=geometry,
+        out_path=lambda datetime, band: out_folder / name / datetime[:10] / f"{band}.tif")
+
+
+def test_fields_are_cut_from_the_cogs(stac, tmp_path):
+    server, data = stac
+    tasks = [make_task(tmp_path / "out", "feld0", field_geometry(1000, 2000)),
+             make_task(tmp_path / "out", "feld1", field_geometry(6000, 7000))]
+    stats = stac_engine.download_all(tasks, "2025-06-01", "2025-06-30", stac_url=server.url + "/api/stac/v1",
+                                     max_in_flight=4)
+    assert stats.failed == 0
+    assert stats.files == 8
+    assert stats.opened == 4
+
+    with rio.open(tmp_path / "out" / "feld0" / "2025-06-02" / "b08.tif") as dataset:
+        written = dataset.read(1)
+        col, row = (round(value) for value in (~from_origin(*ORIGIN, 10, 10)) @ (dataset.transform.c,
+                                                                                    dataset.transform.f))
+        expected = data[(1, "B08")][row:row + dataset.height, col:col + dataset.width]
+    inside = written != 0
+    assert inside.mean() > 0.8
+    assert np.array_equal(written[inside], expected[inside])
+
+
+def test_existing_files_are_skipped(stac, tmp_path):
+    server, _ = stac
+    tasks = [make_task(tmp_path / "out", "feld0", field_geometry(1000, 2000))]
+    stac_engine.download_all(tasks, "2025-06-01", "2025-06-30", stac_url=server.url + "/api/stac/v1")
+    stats = stac_engine.download_all(tasks, "2025-06-01", "2025-06-30", stac_url=server.url + "/api/stac/v1")
+    assert stats.files == 0 and stats.skipped == 4 and stats.requests == 0
+
+
+def test_search_follows_next_links(stac):
+    server, _ = stac
+    server.stac_items = server.stac_items * 3
+
+    async def search():
+        async with httpx.AsyncClient() as client:
+            return await stac_engine.search_items(client, asyncio.Semaphore(1), server.url + "/api/stac/v1",
+                                                  {"limit": 4}, stats)
+
+    stats = stac_engine.EngineStats()
+    items = asyncio.run(search())
+    assert len(items) == 6 and stats.searches == 2
+
+
+def test_failed_item_counts_once_per_field(stac, tmp_path, monkeypatch):
+    server, _ = stac
+    for band in BANDS:
+        (tmp_path / "cogs" / "scene1" / f"{band}.tif").unlink()
+    running = []
+    concurrent = []
+    download_asset = stac_engine.download_asset
+
+    async def counting_download(*args, **kwargs):
+        running.append(1)
+        concurrent.append(len(running))
+        try:
+            return await download_asset(*args, **kwargs)
+        finally:
+            running.pop()
+
+    monkeypatch.setattr(stac_engine, "download_asset", counting_download)
+    tasks = [make_task(tmp_path / "out", "feld0", field_geometry(1000, 2000)),
+             make_task(tmp_path / "out", "feld1", field_geometry(6000, 7000))]
+    stats = stac_engine.download_all(tasks, "2025-06-01", "2025-06-30", stac_url=server.url + "/api/stac/v1",
+                                     max_in_flight=2)
+    assert stats.files == 4 and stats.failed == 2
+    assert len(concurrent) == 4 and max(concurrent) == 2
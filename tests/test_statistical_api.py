@@ -0,0 +1,67 @@
+import math
+
+import pandas as pd
+import sentinelhub as sh
+import shapely
+
+import statistical_api as sa
+import stub_api
+
+
+def make_zone(field_key, zone=0):
+    return sa.Zone(field_key, zone, sh.Geometry(shapely.box(690000, 5360000, 690500, 5360500), sh.CRS(32632)))
+
+
+def interval(day, band_stats):
+    return {
+        "interval": {"from": f"2024-05-0{day}T00:00:00Z", "to": f"2024-05-0{day + 1}T00:00:00Z"},
+        "outputs": {"bands": {"bands": {f"B{index}": {"stats": stats} for index, stats in enumerate(band_stats)}}},
+    }
+
+
+def stats(mean, sample_count=100, no_data_count=0):
+    return {"min": 0.0, "max": 2 * mean, "mean": mean, "stDev": 5.0,
+            "sampleCount": sample_count, "noDataCount": no_data_count}
+
+
+def test_response_rows_skip_errors_and_empty_statistics():
+    response = {"data": [
+        interval(1, [stats(1200.0, 100, 40), stats(2400.0)]),
+        {"interval": {"from": "2024-05-02T00:00:00Z", "to": "2024-05-03T00:00:00Z"},
+         "error": {"type": "EXECUTION_ERROR"}},
+        interval(3, [stats("NaN", 100, 100), stats(2000.0)]),
+    ]}
+    rows = sa.response_rows(make_zone("feld"), response, ["B04", "B08"])
+    assert [row["date"] for row in rows] == ["2024-05-01", "2024-05-03"]
+    assert rows[0]["B04_count"] == 60 and rows[0]["B04_mean"] == 1200.0 and rows[0]["B08_max"] == 4800.0
+    assert rows[0]["B04_std"] == 5.0
+    assert rows[1]["B04_count"] == 0 and math.isnan(rows[1]["B04_mean"]) and math.isnan(rows[1]["B04_min"])
+    assert rows[1]["B08_mean"] == 2000.0
+
+
+def test_statistics_of_all_zones_in_one_table(tmp_path):
+    with stub_api.StubServer() as server:
+        config = stub_api.stub_config(server)
+        zones = [make_zone("feld_a"), make_zone("feld_b", 1)]
+        table = sa.run_statistics(zones, ["B04", "B08"], ("2024-05-01", "2024-05-03"), config,
+                                  data_collection=stub_api.stub_collection(server))
+        assert server.requests_seen("/api/v1/statistics") == 2
+
+    assert list(table.columns[:3]) == ["field", "zone", "date"]
+    assert len(table) == 6
+    assert sorted(set(zip(table["field"], table["zone"]))) == [("feld_a", 0), ("feld_b", 1)]
+    assert (table["B04_mean"] == 1000.0).all() and (table["B08_mean"] == 1100.0).all()
+    assert (table["B04_count"] == 100).all()
+
+    sa.write_table(table, tmp_path / "statistics.parquet")
+    assert pd.read_parquet(tmp_path / "statistics.parquet").equals(table)
+    assert list(tmp_path.iterdir()) == [tmp_path / "statistics.parquet"]
+
+
+def test_failed_zones_are_left_out():
+    with stub_api.StubServer(fail_every=2) as server:
+        config = stub_api.stub_config(server)
+        table = sa.run_statistics([make_zone("feld_a"), make_zone("feld_b")], ["B04"],
+                                  ("2024-05-01", "2024-05-02"), config, max_threads=1,
+                                  data_collection=stub_api.stub_collection(server))
+    assert table["field"].tolist() == ["feld_a", "feld_a"]
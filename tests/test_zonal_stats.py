@@ -0,0 +1,30 @@
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+import shapely
+from rasterio.transform import from_origin
+
+import band_registry as br
+import zonal_stats as zs
+
+
+def write_tif(path, data):
+    with rio.open(path, "w", driver="GTiff", width=data.shape[2], height=data.shape[1], count=data.shape[0],
+                  dtype=data.dtype, crs="EPSG:32632", transform=from_origin(690000, 5360100, 10, 10)) as dataset:
+        dataset.write(data)
+
+
+def test_stacked_files_get_their_own_columns(tmp_path):
+    write_tif(tmp_path / "S2_bands.tif", np.stack([np.full((10, 10), 100 * band, np.uint16) for band in (1, 2)]))
+    write_tif(tmp_path / "S2_quality.tif", np.stack([np.full((10, 10), band, np.uint8) for band in (4, 9)]))
+    zones = gpd.GeoDataFrame(geometry=[shapely.box(690000, 5360000, 690050, 5360100)], crs=32632)
+    paths = [tmp_path / "S2_bands.tif", tmp_path / "S2_quality.tif"]
+
+    table = zs.zonal_stats_files(zones, paths)
+    assert not table.columns.duplicated().any()
+    assert table.loc[0, "bands_B2_mean"] == 200 and table.loc[0, "quality_B1_mean"] == 4
+    assert table.loc[0, "bands_B1_count"] == 50
+
+    layout = br.stacked_layout(["B02", "B03", "SCL", "dataMask"])
+    table = zs.zonal_stats_files(zones, paths, layout=layout)
+    assert table.loc[0, "B03_mean"] == 200 and table.loc[0, "dataMask_max"] == 9
@@ -0,0 +1,201 @@
+"""
+Zonal statistics for field or pixel polygons over many bands and dates.
+
+rasterstats.zonal_stats takes 51 s for Freising Süd on a single band (see
+raster_experiments.py), because it handles the polygons one by one. Here
+the polygons are rasterized once into a label raster aligned with the
+downloaded grid (pixel value = index of the polygon + 1, 0 = outside).
+The labeled pixels are sorted by polygon once, after that mean, min,
+max, std and count of every band are segment reductions
+(np.add/minimum/maximum.reduceat) over all polygons at the same time.
+
+The label raster only depends on the geometries and the grid, so it is
+cached per (geometries, grid) in memory and optionally in a cache folder.
+All later dates and bands on the same grid only pay for the reductions.
+Where polygons overlap, a pixel counts for the last one only.
+"""
+import dataclasses
+import hashlib
+import pathlib as pl
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import rasterio.features
+import shapely
+
+import pixel_sampler as ps
+
+STATISTICS = ["count", "mean", "min", "max", "std"]
+
+
+@dataclasses.dataclass
+class LabelRaster:
+    """
+    A rasterized set of n_zones polygons. order holds the flat indices
+    of all labeled pixels sorted by zone, zones the zone (0 based) of
+    each segment and starts where each segment begins in order.
+    """
+    n_zones: int
+    shape: tuple
+    order: np.ndarray
+    zones: np.ndarray
+    starts: np.ndarray
+
+
+_label_cache = {}
+
+
+def grid_key(geometries, shape, transform):
+    """
+    Hash of the geometries (as WKB) and the grid, used as cache key.
+    """
+    digest = hashlib.sha1()
+    for wkb in shapely.to_wkb(np.asarray(geometries)):
+        digest.update(wkb)
+    digest.update(repr((tuple(shape), tuple(transform)[:6])).encode())
+    return digest.hexdigest()
+
+
+def rasterize_labels(geometries, shape, transform, all_touched: bool = False):
+    """
+    Rasterize the geometries into a LabelRaster for the grid given by
+    shape (height, width) and transform.
+    """
+    labels = rasterio.features.rasterize(
+        ((geometry, index + 1) for index, geometry in enumerate(geometries)),
+        out_shape=shape, transform=transform, fill=0, dtype="int32",
+        all_touched=all_touched
+    ).ravel()
+    labeled = np.flatnonzero(labels)
+    order = labeled[np.argsort(labels[labeled], kind="stable")]
+    zones, starts = np.unique(labels[order] - 1, return_index=True)
+    return LabelRaster(len(geometries), tuple(shape), order, zones, starts)
+
+
+def label_raster(geometries, shape, transform, cache_dir: pl.Path = None):
+    """
+    Return the LabelRaster for geometries on the given grid, from the
+    memory cache, from cache_dir or freshly rasterized.
+    """
+    geometries = list(geometries)
+    key = grid_key(geometries, shape, transform)
+    if key in _label_cache:
+        return _label_cache[key]
+
+    cache_path = pl.Path(cache_dir).joinpath(key + ".npz") if cache_dir else None
+    if cache_path is not None and cache_path.exists():
+        with np.load(cache_path) as cached:
+            labels = LabelRaster(int(cached["n_zones"]), tuple(cached["shape"]),
+                                 cached["order"], cached["zones"], cached["starts"])
+    else:
+        labels = rasterize_labels(geometries, shape, transform)
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(cache_path, n_zones=labels.n_zones, shape=labels.shape,
+                     order=labels.order, zones=labels.zones, starts=labels.starts)
+    _label_cache[key] = labels
+    return labels
+
+
+def zonal_stats(labels: LabelRaster, data: np.ndarray, band_names=None, nodata=None):
+    """
+    Compute count, mean, min, max and std of every band of data (bands,
+    height, width) for every zone of labels. Pixels equal to nodata or
+    NaN are left out. Returns a DataFrame with one row per zone and the
+    columns <band>_<statistic>; zones without valid pixels get count 0
+    and NaN for everything else.
+    """
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    if band_names is None:
+        band_names = [f"B{band}" for band in range(1, data.shape[0] + 1)]
+    table = {"zone": np.arange(labels.n_zones)}
+    if labels.starts.size == 0:
+        for band_name in band_names:
+            for name in STATISTICS:
+                table[f"{band_name}_{name}"] = np.zeros(labels.n_zones, dtype=np.int64) if name == "count" \
+                    else np.full(labels.n_zones, np.nan)
+        return pd.DataFrame(table)
+
+    values = data.reshape(data.shape[0], -1)[:, labels.order].astype(np.float64)
+    valid = ~np.isnan(values)
+    if nodata is not None:
+        valid &= values != nodata
+
+    count = np.add.reduceat(valid, labels.starts, axis=1)
+    total = np.add.reduceat(np.where(valid, values, 0.0), labels.starts, axis=1)
+    squares = np.add.reduceat(np.where(valid, values * values, 0.0), labels.starts, axis=1)
+    minimum = np.minimum.reduceat(np.where(valid, values, np.inf), labels.starts, axis=1)
+    maximum = np.maximum.reduceat(np.where(valid, values, -np.inf), labels.starts, axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        std = np.sqrt(np.maximum(squares / count - mean * mean, 0.0))
+    empty = count == 0
+    for statistic in (mean, std, minimum, maximum):
+        statistic[empty] = np.nan
+
+    for band_index, band_name in enumerate(band_names):
+        for name, statistic in zip(STATISTICS, (count, mean, minimum, maximum, std)):
+            column = np.zeros(labels.n_zones, dtype=np.int64) if name == "count" \
+                else np.full(labels.n_zones, np.nan)
+            column[labels.zones] = statistic[band_index]
+            table[f"{band_name}_{name}"] = column
+    return pd.DataFrame(table)
+
+
+def file_band_names(path: pl.Path, dataset, layout=None):
+    """
+    Column prefixes for the bands of one file: the bands the
+    output_layouts.OutputLayout names for it, or the band descriptions,
+    or for a single band file its band id (scene_id_B02.tif -> B02).
+    The bands of any other stack are prefixed with the file id
+    (scene_id_bands.tif -> bands_B1, bands_B2, ...), so the generic
+    names of two stacks do not collide.
+    """
+    names = layout.band_names(path) if layout is not None else None
+    if names:
+        return names
+    names = ps.band_names(path, dataset)
+    if dataset.count > 1 and not all(dataset.descriptions):
+        file_id = pl.Path(path).stem.rsplit("_", 1)[-1]
+        names = [f"{file_id}_{name}" for name in names]
+    return names
+
+
+def zonal_stats_files(gdf, paths, cache_dir: pl.Path = None, layout=None):
+    """
+    Zonal statistics of the geometries of gdf over the rasters at paths,
+    which must all share one grid (e.g. the band tifs of one date
+    folder). The bands are named as in file_band_names.
+    Returns one DataFrame for all files.
+    """
+    tables = []
+    for path in paths:
+        with rio.open(path) as dataset:
+            geometries = gdf.to_crs(dataset.crs).geometry.values
+            labels = label_raster(geometries, dataset.shape, dataset.transform, cache_dir)
+            table = zonal_stats(labels, dataset.read(), file_band_names(path, dataset, layout), dataset.nodata)
+        tables.append(table.drop(columns="zone") if tables else table)
+    if not tables:
+        return pd.DataFrame()
+    table = pd.concat(tables, axis=1)
+    duplicates = table.columns[table.columns.duplicated()].unique()
+    if len(duplicates):
+        raise ValueError(f"Columns from more than one file: {', '.join(duplicates)}")
+    return table
+
+
+def zonal_stats_stack(gdf, date_folders, pattern: str = "*.tif", cache_dir: pl.Path = None, layout=None):
+    """
+    Zonal statistics for every date folder, with a date column added.
+    The label raster is only computed for the first date (or taken from
+    cache_dir), all other dates reuse it.
+    """
+    tables = []
+    for folder in date_folders:
+        table = zonal_stats_files(gdf, sorted(pl.Path(folder).glob(pattern)), cache_dir, layout)
+        table.insert(1, "date", pl.Path(folder).name)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)